@@ -3,8 +3,169 @@ from flask import Flask, render_template
 from flask_sqlalchemy import SQLAlchemy
 from config import Config
 from datetime import datetime
+from app.database import RoutingSession, configure_database
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+class SchemaDriftError(RuntimeError):
+    """The database differs from the models in a way upgrade_schema cannot apply"""
+
+def upgrade_schema():
+    """
+    Add columns and indexes introduced since the tables were created.
+
+    create_all skips tables that already exist. New columns must be nullable
+    or have a server default. Returns the (table, column) pairs added.
+    Nothing else is altered: see schema_drift for what has to be migrated
+    by hand.
+    """
+    from sqlalchemy import inspect
+    from sqlalchemy.schema import CreateColumn
+
+    inspector = inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer.quote
+    added = set()
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            # Compiled by the dialect, like create_all, so defaults come out as quoted literals
+            column_ddl = CreateColumn(column).compile(db.engine)
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql(f"ALTER TABLE {quote(table.name)} ADD COLUMN {column_ddl}")
+            added.add((table.name, column.name))
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    return added
+
+def _ddl_type(type_, dialect):
+    """A column type as DDL, with the spellings a dialect reflects back made to match the models'"""
+    import re
+
+    ddl = type_.compile(dialect).upper()
+    ddl = re.sub(r' (CHARACTER SET|COLLATE) \S+', '', ddl).replace(', ', ',')
+    if ddl in ('BOOL', 'TINYINT(1)'):
+        return 'BOOLEAN'
+    ddl = re.sub(r'^(TINYINT|SMALLINT|MEDIUMINT|INT|INTEGER|BIGINT)\(\d+\)', r'\1', ddl)
+    ddl = re.sub(r'^DECIMAL\b', 'NUMERIC', ddl)
+    return 'INTEGER' if ddl == 'INT' else ddl
+
+def schema_drift(inspector, table):
+    """
+    What upgrade_schema cannot bring an existing table up to: a list of differences.
+
+    Missing columns and indexes are not drift, they get added. A column
+    whose type or nullability changed, a column the model no longer has
+    (dropped or renamed) and an index whose columns changed are.
+    """
+    dialect = db.engine.dialect
+    live = {column['name']: column for column in inspector.get_columns(table.name)}
+    problems = []
+    for column in table.columns:
+        current = live.pop(column.name, None)
+        if current is None:
+            continue
+        model_type, live_type = _ddl_type(column.type, dialect), _ddl_type(current['type'], dialect)
+        if model_type != live_type:
+            problems.append(f"{table.name}.{column.name} is {live_type} in the database, {model_type} in the model")
+        if not column.primary_key and current['nullable'] != column.nullable:
+            problems.append(f"{table.name}.{column.name} is {'' if current['nullable'] else 'NOT '}NULL "
+                            f"in the database, {'' if column.nullable else 'NOT '}NULL in the model")
+    problems.extend(f"{table.name}.{name} is not in the model" for name in live)
+    indexes = {index['name']: index['column_names'] for index in inspector.get_indexes(table.name)}
+    for index in table.indexes:
+        columns = [column.name for column in index.columns]
+        if index.name in indexes and indexes[index.name] != columns:
+            problems.append(f"index {index.name} is on ({', '.join(indexes[index.name])}) in the database, "
+                            f"({', '.join(columns)}) in the model")
+    return problems
+
+def schema_fingerprint():
+    """Hash of the DDL the models and the search index compile to on this database's dialect"""
+    import hashlib
+    from sqlalchemy.schema import CreateIndex, CreateTable
+    from app.search import search_index
+
+    digest = hashlib.sha256()
+    for table in db.metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(db.engine)).encode())
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            digest.update(str(CreateIndex(index).compile(db.engine)).encode())
+    digest.update(search_index.schema_ddl().encode())
+    return digest.hexdigest()
+
+def migrate_schema(force=False):
+    """
+    Bring the database up to the models; returns True if any DDL ran.
+
+    The fingerprint of the last upgrade is kept in schema_version, so once a
+    database is current this costs a single SELECT. Missing tables are
+    created, new columns and indexes added, and data introduced with them
+    backfilled. The summary store is derived data and is recreated when its
+    definition changes. Any other change to an existing column or index
+    raises SchemaDriftError before DDL runs or the fingerprint is recorded:
+    those have to be migrated by hand.
+    """
+    from sqlalchemy import inspect, select
+    from sqlalchemy.exc import DatabaseError
+    from app.models import SchemaVersion
+    from app.search import search_index
+    from app.summaries import ROLLUPS
+
+    fingerprint = schema_fingerprint()
+    if not force:
+        try:
+            with db.engine.connect() as conn:
+                current = conn.execute(
+                    select(SchemaVersion.fingerprint).order_by(SchemaVersion.id.desc()).limit(1)
+                ).scalar()
+        except DatabaseError:
+            current = None  # schema_version does not exist yet
+        if current == fingerprint:
+            return False
+
+    inspector = inspect(db.engine)
+    rollup_tables = [rollup.__table__ for rollup in ROLLUPS]
+    has_summaries = all(inspector.has_table(table.name) for table in rollup_tables)
+    drift = []
+    for table in db.metadata.sorted_tables:
+        if table in rollup_tables or not inspector.has_table(table.name):
+            continue
+        drift.extend(schema_drift(inspector, table))
+    if drift:
+        raise SchemaDriftError("The database differs from the models in ways upgrade-db cannot change; "
+                               "migrate these by hand: " + '; '.join(drift))
+    if inspector.has_table('invoice_summary'):
+        # The per-invoice summary store was replaced by the rollups below
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql('DROP TABLE invoice_summary')
+    for table in rollup_tables:
+        if inspector.has_table(table.name) and (
+                schema_drift(inspector, table) or
+                {column['name'] for column in inspector.get_columns(table.name)} != set(table.columns.keys())):
+            # The rollups are derived data: recreate one when its definition changes instead of altering it
+            table.drop(db.engine)
+            has_summaries = False
+    db.create_all(bind_key=None)  # never DDL on the read replica
+    added = upgrade_schema()
+    search_index.create_index()  # fills itself when created for an existing database
+    if ('invoice', 'amount_paid') in added:
+        # Invoices paid before the payment ledger existed get one payment for their total
+        from app.services import backfill_payments
+        backfill_payments()
+    if ('invoice', 'currency') in added or ('customer', 'currency') in added:
+        # Existing rows were billed in the default currency, whatever the column default says
+        from app.services import backfill_currency
+        backfill_currency()
+    if not has_summaries or added:
+        # Fill the summary store once for databases created before it (or its columns) existed
+        from app.summaries import rebuild_summaries
+        rebuild_summaries()
+
+    db.session.add(SchemaVersion(fingerprint=fingerprint))
+    db.session.commit()
+    return True
 
 def create_app(config_class=Config):
     # Get absolute path to project root (one level up from app/)
@@ -15,17 +176,50 @@ def create_app(config_class=Config):
                static_folder=os.path.join(project_root, 'static'))
     
     app.config.from_object(config_class)
+    configure_database(app)
     db.init_app(app)
 
+    from app.pdf_generator import configure_renderer
+    configure_renderer(app.config['PDF_FAST_PATH_MIN_ITEMS'])
+
+    from app.pdf_cache import pdf_cache
+    pdf_cache.init_app(app)
+
+    from app.pdf_jobs import pdf_jobs
+    pdf_jobs.init_app(app)
+
+    from app.page_cache import page_cache
+    page_cache.init_app(app)
+
+    from app.numbering import invoice_numbers
+    invoice_numbers.init_app(app)
+
+    from app.search import search_index
+    search_index.init_app(app)
+
+    from app.currency import exchange_rates, format_money
+    exchange_rates.init_app(app)
+    app.add_template_filter(format_money, 'money')
+
+    from app.metrics import metrics
+    metrics.init_app(app)
+
     # Register blueprints
     from app.routes import main_routes, customer_routes, invoice_routes
     app.register_blueprint(main_routes)
     app.register_blueprint(customer_routes)
     app.register_blueprint(invoice_routes)
 
-    # Create database tables
-    with app.app_context():
-        db.create_all()
+    from app.api import api_routes
+    app.register_blueprint(api_routes)
+
+    from app.commands import register_commands
+    register_commands(app)
+
+    # Upgrade the schema on startup unless deployments run `flask upgrade-db` instead
+    if app.config['SCHEMA_AUTO_UPGRADE']:
+        with app.app_context():
+            migrate_schema()
 
     # Test template path (remove in production)
     @app.route('/template_test')
@@ -0,0 +1,388 @@
+import logging
+
+from flask import Blueprint, current_app, request
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload
+
+from app import db, services
+from app.database import replica_reads
+from app.forms import (CUSTOMER_FIELDS, customer_form, validate_invoice_payload, validate_payment_payload,
+                       validate_recurring_payload)
+from app.models import Customer, Invoice, Payment, RecurringInvoice, RecurringInvoiceItem
+from app.page_cache import page_cache
+from app.pagination import paginate_keyset
+from app.summaries import customer_balance
+from app.routes import CUSTOMER_SORTS, INVOICE_SORTS, conflict_payload, get_page_args, get_per_page, like_prefix
+from app.search import search_index
+from app.utils import apply_invoice_filters, parse_invoice_filters
+
+logger = logging.getLogger(__name__)
+
+RECURRING_SORTS = {
+    'next_issue_date': RecurringInvoice.next_issue_date,
+    'start_date': RecurringInvoice.start_date
+}
+
+api_routes = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+def _json_body():
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return None, ({'error': 'Request body must be JSON'}, 400)
+    return payload, None
+
+
+def _validation_error(errors):
+    return {'error': 'Validation failed', 'errors': errors}, 422
+
+
+def _validate_batch(payloads):
+    """Validate many invoice payloads, checking all referenced customers with one query"""
+    specs, errors = [], {}
+    for index, payload in enumerate(payloads):
+        spec, spec_errors = validate_invoice_payload(payload)
+        specs.append(spec)
+        if spec_errors:
+            errors[str(index)] = spec_errors
+
+    customer_ids = {spec['customer_id'] for spec in specs if spec and 'customer_id' in spec}
+    known = {row.id for row in Customer.query.with_entities(Customer.id).filter(Customer.id.in_(customer_ids))} \
+        if customer_ids else set()
+    for index, spec in enumerate(specs):
+        if spec and 'customer_id' in spec and spec['customer_id'] not in known:
+            errors.setdefault(str(index), {})['customer_id'] = 'Selected customer does not exist'
+    return specs, errors
+
+
+def _created_invoices(invoices):
+    """Reload freshly committed invoices with their customers in one query"""
+    ids = [inspect(invoice).identity[0] for invoice in invoices]
+    loaded = Invoice.query.options(joinedload(Invoice.customer)).filter(Invoice.id.in_(ids)).all()
+    by_id = {invoice.id: invoice for invoice in loaded}
+    return [by_id[invoice_id].to_dict() for invoice_id in ids]
+
+
+def _json_response(body):
+    return current_app.response_class(body, mimetype='application/json')
+
+
+def _cached_invoice_json(id, name, document):
+    """Serve document(), a JSON payload about one invoice, through the page cache"""
+    version = page_cache.invoice_version(id)
+    if version is None:
+        return {'error': 'Invoice not found'}, 404
+    return page_cache.serve(f"invoice_{id}", name, page_cache.key(name, id, version),
+                            page_cache.last_modified(version), lambda: current_app.json.dumps(document()),
+                            _json_response)
+
+
+# Customers
+@api_routes.route('/customers', methods=['GET'])
+@replica_reads
+def list_customers():
+    try:
+        sort_column, descending, cursor, per_page = get_page_args(CUSTOMER_SORTS, 'name', 'asc')
+        query = Customer.query
+        if request.args.get('q'):
+            query = query.filter(Customer.name.like(like_prefix(request.args['q']), escape='\\'))
+        page = paginate_keyset(query, sort_column, Customer.id, descending, cursor, per_page)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    return {'customers': [c.to_dict() for c in page.items], 'next_cursor': page.next_cursor}
+
+
+@api_routes.route('/customers', methods=['POST'])
+def create_customer():
+    payload, error = _json_body()
+    if error:
+        return error
+    if not isinstance(payload, dict):
+        return {'error': 'Body must be a JSON object'}, 400
+    form = customer_form(payload)
+    if not form.validate():
+        return _validation_error(form.errors)
+
+    customer = Customer(**{field: getattr(form, field).data for field in CUSTOMER_FIELDS})
+    db.session.add(customer)
+    db.session.commit()
+    return customer.to_dict(), 201
+
+
+@api_routes.route('/customers/<int:id>', methods=['GET'])
+def get_customer(id):
+    version = page_cache.customer_version(id)
+    if version is None:
+        return {'error': 'Customer not found'}, 404
+    return page_cache.serve(f"customer_{id}", 'json', page_cache.key('customer', id, version),
+                            page_cache.last_modified(version),
+                            lambda: current_app.json.dumps(db.session.get(Customer, id).to_dict()), _json_response)
+
+
+@api_routes.route('/customers/<int:id>', methods=['PUT'])
+def update_customer(id):
+    customer = db.session.get(Customer, id)
+    if customer is None:
+        return {'error': 'Customer not found'}, 404
+    payload, error = _json_body()
+    if error:
+        return error
+    if not isinstance(payload, dict):
+        return {'error': 'Body must be a JSON object'}, 400
+    form = customer_form(dict(customer.to_dict(), **payload))
+    if not form.validate():
+        return _validation_error(form.errors)
+
+    services.update_customer(customer, **{field: getattr(form, field).data for field in CUSTOMER_FIELDS})
+    return customer.to_dict()
+
+
+@api_routes.route('/customers/<int:id>/balance', methods=['GET'])
+def get_customer_balance(id):
+    if db.session.get(Customer, id) is None:
+        return {'error': 'Customer not found'}, 404
+    return {key: str(value) if key != 'customer_id' else value for key, value in customer_balance(id).items()}
+
+
+# Invoices
+@api_routes.route('/invoices', methods=['GET'])
+@replica_reads
+def list_invoices():
+    try:
+        filters = parse_invoice_filters(request.args)
+        sort_column, descending, cursor, per_page = get_page_args(INVOICE_SORTS, 'issue_date', 'desc')
+        query = apply_invoice_filters(Invoice.query.options(joinedload(Invoice.customer)), filters)
+        page = paginate_keyset(query, sort_column, Invoice.id, descending, cursor, per_page)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    return {'invoices': [invoice.to_dict() for invoice in page.items], 'next_cursor': page.next_cursor}
+
+
+@api_routes.route('/invoices/search', methods=['GET'])
+def search_invoices():
+    try:
+        page = search_index.search(request.args.get('q', ''), request.args.get('cursor'), get_per_page())
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    return {
+        'invoices': [dict(hit.invoice.to_dict(), score=hit.score) for hit in page.items],
+        'next_cursor': page.next_cursor
+    }
+
+
+@api_routes.route('/invoices/<int:id>', methods=['GET'])
+def get_invoice(id):
+    def document():
+        invoice = Invoice.query.options(
+            joinedload(Invoice.customer),
+            joinedload(Invoice.items)
+        ).filter(Invoice.id == id).one()
+        return invoice.to_dict(include_items=True)
+    return _cached_invoice_json(id, 'json', document)
+
+
+@api_routes.route('/invoices/<int:id>', methods=['PUT'])
+def update_invoice(id):
+    """
+    Update an invoice and its items; fields left out keep their saved values.
+
+    "items" is the full new list: items carrying the "id" of a saved item
+    change it, the others take the place of saved items left out or are
+    added, and saved items still left over are removed. "version" is the
+    version the client last read: if the invoice was saved since, nothing is
+    written and a 409 lists how this edit differs from the saved invoice.
+    """
+    invoice = Invoice.query.options(
+        joinedload(Invoice.customer),
+        joinedload(Invoice.items)
+    ).filter(Invoice.id == id).first()
+    if invoice is None:
+        return {'error': 'Invoice not found'}, 404
+    payload, error = _json_body()
+    if error:
+        return error
+    if not isinstance(payload, dict):
+        return {'error': 'Body must be a JSON object'}, 400
+
+    saved = invoice.to_dict(include_items=True)
+    del saved['currency']  # only checked against the rate table when the edit changes it
+    specs, errors = _validate_batch([dict(saved, **payload)])
+    errors = errors.get('0', {})
+    version = payload.get('version')
+    if version is not None and (isinstance(version, bool) or not str(version).isdigit()):
+        errors['version'] = 'must be the integer version of the invoice'
+    if errors:
+        return _validation_error(errors)
+
+    spec = specs[0]
+    items = spec.pop('items')
+    spec.pop('status')  # changed through payments and mark-paid, not by editing
+    try:
+        services.update_invoice(invoice, items, expected_version=version, **spec)
+    except services.InvoiceConflict as conflict:
+        return conflict_payload(conflict), 409
+    except ValueError as e:
+        return _validation_error({'items': str(e)})
+    except Exception as e:
+        logger.error(f"Error updating invoice: {str(e)}")
+        return {'error': 'Error updating invoice'}, 500
+    return invoice.to_dict(include_items=True)
+
+
+@api_routes.route('/invoices/<int:id>', methods=['DELETE'])
+def delete_invoice(id):
+    """Delete an invoice with its items and payments"""
+    invoice = db.session.get(Invoice, id)
+    if invoice is None:
+        return {'error': 'Invoice not found'}, 404
+    try:
+        services.delete_invoice(invoice)
+    except Exception as e:
+        logger.error(f"Error deleting invoice: {str(e)}")
+        return {'error': 'Error deleting invoice'}, 500
+    return '', 204
+
+
+@api_routes.route('/invoices/<int:id>/items', methods=['GET'])
+def get_invoice_items(id):
+    def document():
+        invoice = Invoice.query.options(joinedload(Invoice.items)).filter(Invoice.id == id).one()
+        return {'items': [item.to_dict() for item in invoice.items]}
+    return _cached_invoice_json(id, 'items', document)
+
+
+@api_routes.route('/invoices/<int:id>/payments', methods=['GET'])
+def get_invoice_payments(id):
+    def document():
+        invoice = Invoice.query.options(selectinload(Invoice.payments)).filter(Invoice.id == id).one()
+        return {'payments': [payment.to_dict() for payment in invoice.payments],
+                'amount_paid': str(invoice.amount_paid), 'balance_due': str(invoice.balance_due)}
+    return _cached_invoice_json(id, 'payments', document)
+
+
+@api_routes.route('/invoices/<int:id>/payments', methods=['POST'])
+def create_invoice_payment(id):
+    """Record a payment: {"amount": "10.00", "paid_on": "YYYY-MM-DD", "method": ..., "reference": ...}"""
+    if db.session.get(Invoice, id) is None:
+        return {'error': 'Invoice not found'}, 404
+    payload, error = _json_body()
+    if error:
+        return error
+    spec, errors = validate_payment_payload(payload)
+    if errors:
+        return _validation_error(errors)
+    try:
+        invoice = services.record_payments([dict(spec, invoice_id=id)])[0]
+    except ValueError as e:
+        return _validation_error({'amount': str(e)})
+    return invoice.to_dict(), 201
+
+
+@api_routes.route('/payments/<int:id>', methods=['DELETE'])
+def delete_payment(id):
+    payment = db.session.get(Payment, id)
+    if payment is None:
+        return {'error': 'Payment not found'}, 404
+    return services.delete_payment(payment).to_dict()
+
+
+@api_routes.route('/invoices', methods=['POST'])
+def create_invoice():
+    payload, error = _json_body()
+    if error:
+        return error
+    specs, errors = _validate_batch([payload])
+    if errors:
+        return _validation_error(errors['0'])
+
+    try:
+        invoice = services.create_invoice(**specs[0])
+    except Exception as e:
+        logger.error(f"Error creating invoice: {str(e)}")
+        return {'error': 'Error creating invoice'}, 500
+    return _created_invoices([invoice])[0], 201
+
+
+@api_routes.route('/invoices/batch', methods=['POST'])
+def create_invoice_batch():
+    """
+    Create many invoices at once: {"invoices": [...]}.
+
+    The whole batch is validated first and either every invoice is created in
+    one transaction or none is, with errors keyed by position in the batch.
+    """
+    payload, error = _json_body()
+    if error:
+        return error
+    payloads = payload.get('invoices') if isinstance(payload, dict) else None
+    if not isinstance(payloads, list) or not payloads:
+        return {'error': 'Body must contain a non-empty "invoices" list'}, 400
+    if len(payloads) > current_app.config['API_MAX_BATCH_SIZE']:
+        return {'error': f"At most {current_app.config['API_MAX_BATCH_SIZE']} invoices per batch"}, 413
+
+    specs, errors = _validate_batch(payloads)
+    if errors:
+        return _validation_error(errors)
+
+    try:
+        invoices = services.create_invoices(specs)
+    except Exception as e:
+        logger.error(f"Error creating invoice batch: {str(e)}")
+        return {'error': 'Error creating invoices'}, 500
+    return {'invoices': _created_invoices(invoices)}, 201
+
+
+# Recurring invoices
+@api_routes.route('/recurring-invoices', methods=['GET'])
+@replica_reads
+def list_recurring_invoices():
+    try:
+        sort_column, descending, cursor, per_page = get_page_args(RECURRING_SORTS, 'next_issue_date', 'asc')
+        query = RecurringInvoice.query.options(selectinload(RecurringInvoice.items))
+        if request.args.get('customer_id'):
+            query = query.filter(RecurringInvoice.customer_id == request.args.get('customer_id', type=int))
+        if request.args.get('active') in ('true', 'false'):
+            query = query.filter(RecurringInvoice.active.is_(request.args['active'] == 'true'))
+        page = paginate_keyset(query, sort_column, RecurringInvoice.id, descending, cursor, per_page)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    return {'recurring_invoices': [r.to_dict() for r in page.items], 'next_cursor': page.next_cursor}
+
+
+@api_routes.route('/recurring-invoices', methods=['POST'])
+def create_recurring_invoice():
+    """Create a recurring invoice template; its first invoice is issued on start_date"""
+    payload, error = _json_body()
+    if error:
+        return error
+    spec, errors = validate_recurring_payload(payload)
+    if spec and 'customer_id' in spec and db.session.get(Customer, spec['customer_id']) is None:
+        errors['customer_id'] = 'Selected customer does not exist'
+    if errors:
+        return _validation_error(errors)
+
+    items = spec.pop('items')
+    recurring = RecurringInvoice(next_issue_date=spec['start_date'], **spec)
+    recurring.items = [RecurringInvoiceItem(**item) for item in items]
+    db.session.add(recurring)
+    db.session.commit()
+    return recurring.to_dict(), 201
+
+
+@api_routes.route('/recurring-invoices/<int:id>', methods=['GET'])
+def get_recurring_invoice(id):
+    recurring = db.session.get(RecurringInvoice, id)
+    if recurring is None:
+        return {'error': 'Recurring invoice not found'}, 404
+    return recurring.to_dict()
+
+
+@api_routes.route('/recurring-invoices/<int:id>', methods=['DELETE'])
+def stop_recurring_invoice(id):
+    """Stop billing a template; invoices already generated from it are kept"""
+    recurring = db.session.get(RecurringInvoice, id)
+    if recurring is None:
+        return {'error': 'Recurring invoice not found'}, 404
+    recurring.active = False
+    db.session.commit()
+    return recurring.to_dict()
@@ -0,0 +1,199 @@
+import click
+from flask.cli import with_appcontext
+
+from app.utils import parse_invoice_filters
+
+
+def invoice_filter_options(command):
+    """Attach the standard invoice filter options to a CLI command"""
+    command = click.option('--max-total', help='Only invoices totalling at most this amount')(command)
+    command = click.option('--min-total', help='Only invoices totalling at least this amount')(command)
+    command = click.option('--status', help='Only invoices with this status')(command)
+    command = click.option('--customer-id', type=int, help='Only invoices for this customer')(command)
+    command = click.option('--end-date', help='Issued on or before YYYY-MM-DD')(command)
+    command = click.option('--start-date', help='Issued on or after YYYY-MM-DD')(command)
+    return command
+
+
+@click.command('export-pdfs')
+@invoice_filter_options
+@click.option('--output', '-o', required=True, type=click.Path(dir_okay=False, writable=True),
+              help='Path of the ZIP file to write')
+@click.option('--chunk-size', default=200, show_default=True, help='Invoices loaded per query')
+@with_appcontext
+def export_pdfs_command(output, chunk_size, **filter_args):
+    """Export invoice PDFs matching the filters into a ZIP file"""
+    from app.pdf_export import stream_invoice_zip
+
+    filters = parse_invoice_filters({k: str(v) for k, v in filter_args.items() if v is not None})
+    with open(output, 'wb') as f:
+        for data in stream_invoice_zip(filters, chunk_size):
+            f.write(data)
+    click.echo(f"Wrote {output}")
+
+
+@click.command('export-data')
+@click.argument('kind', type=click.Choice(['invoices', 'items', 'customers']))
+@invoice_filter_options
+@click.option('--format', '-f', 'export_format', type=click.Choice(['csv', 'xlsx']), default='csv',
+              show_default=True)
+@click.option('--output', '-o', required=True, type=click.Path(dir_okay=False, writable=True),
+              help='Path of the file to write')
+@click.option('--chunk-size', default=1000, show_default=True, help='Rows fetched per round trip')
+@click.option('--currency', help='Currency of the reporting_total column (default REPORTING_CURRENCY)')
+@with_appcontext
+def export_data_command(kind, export_format, output, chunk_size, currency, **filter_args):
+    """Export invoices, line items or customers matching the filters as CSV or XLSX"""
+    from app.data_export import stream_export
+
+    filters = parse_invoice_filters({k: str(v) for k, v in filter_args.items() if v is not None})
+    with open(output, 'wb') as f:
+        for data in stream_export(kind, export_format, filters, chunk_size, currency and currency.upper()):
+            f.write(data)
+    click.echo(f"Wrote {output}")
+
+
+@click.command('import-csv')
+@click.argument('kind', type=click.Choice(['customers', 'invoices', 'payments']))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', type=int, help='Rows (customers, payments) or invoices saved per transaction')
+@click.option('--dry-run', is_flag=True, help='Validate only, write nothing')
+@click.option('--report', type=click.Path(dir_okay=False, writable=True),
+              help='Write the per-row error report to this CSV file')
+@with_appcontext
+def import_csv_command(kind, path, batch_size, dry_run, report):
+    """Import customers or invoices, or reconcile payments from a bank statement CSV"""
+    from app.importer import import_csv
+
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        try:
+            result = import_csv(kind, f, batch_size, dry_run)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    if report:
+        with open(report, 'w', newline='', encoding='utf-8') as f:
+            result.write_report(f)
+    click.echo(f"{result.rows} rows: {result.created} {kind} {'valid' if dry_run else 'created'}, "
+               f"{len(result.skipped)} skipped, {len(result.errors)} errors")
+    for line, status, field, message in result.problems[:20]:
+        click.echo(f"  line {line}: {status} {field}: {message}")
+    if len(result.problems) > 20:
+        click.echo(f"  ... {len(result.problems) - 20} more{' in ' + report if report else ''}")
+
+
+@click.command('recalculate-totals')
+@invoice_filter_options
+@click.option('--chunk-size', default=500, show_default=True, help='Invoices loaded per query')
+@click.option('--dry-run', is_flag=True, help='Only report how many invoices would change')
+@with_appcontext
+def recalculate_totals_command(chunk_size, dry_run, **filter_args):
+    """Recompute item amounts and invoice totals with exact Decimal rounding"""
+    from app.services import recalculate_totals
+
+    filters = parse_invoice_filters({k: str(v) for k, v in filter_args.items() if v is not None})
+    checked, changed = recalculate_totals(filters, chunk_size, dry_run)
+    click.echo(f"{checked} invoices checked, {changed} {'would change' if dry_run else 'updated'}")
+
+
+@click.command('upgrade-db')
+@click.option('--force', is_flag=True, help='Check every table even if the schema fingerprint matches')
+@with_appcontext
+def upgrade_db_command(force):
+    """Create missing tables, add new columns and indexes, and backfill their data"""
+    from app import SchemaDriftError, migrate_schema
+
+    try:
+        upgraded = migrate_schema(force=force)
+    except SchemaDriftError as e:
+        raise click.ClickException(str(e))
+    if upgraded:
+        click.echo("Database schema upgraded")
+    else:
+        click.echo("Database schema is up to date")
+
+
+@click.command('rebuild-summaries')
+@with_appcontext
+def rebuild_summaries_command():
+    """Recompute the dashboard summary store from the invoice table"""
+    from app.summaries import rebuild_summaries
+
+    rows = rebuild_summaries()
+    click.echo(f"Rebuilt invoice summaries: {rows} rows")
+
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    """Rebuild the invoice search index from the invoice, item and customer tables"""
+    from app.search import search_index
+
+    count = search_index.rebuild()
+    click.echo(f"Rebuilt the search index: {count} invoices")
+
+
+@click.command('generate-recurring')
+@click.option('--date', 'run_date', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Generate invoices due on or before this date (default: today)')
+@click.option('--batch-size', default=500, show_default=True, help='Recurring invoices per transaction')
+@click.option('--queue-pdfs', is_flag=True, help='Render PDFs of the new invoices on the PDF worker pool')
+@click.option('--dry-run', is_flag=True, help='Only report how many invoices are due')
+@with_appcontext
+def generate_recurring_command(run_date, batch_size, queue_pdfs, dry_run):
+    """Create the invoices of every recurring invoice that is due; safe to rerun"""
+    from app.recurring import generate_recurring_invoices
+
+    result = generate_recurring_invoices(run_date.date() if run_date else None, batch_size, queue_pdfs, dry_run)
+    click.echo(f"{result.invoices} invoices {'due' if dry_run else 'created'} from {result.templates} "
+               f"recurring invoices for {result.run_date}")
+    if result.jobs:
+        # Wait for the renders, the worker pool is shut down when the command exits
+        failed = 0
+        for job in result.jobs:
+            try:
+                job.wait()
+            except Exception:
+                failed += 1
+        click.echo(f"Rendered {len(result.jobs) - failed} PDFs, {failed} failed")
+
+
+@click.command('mark-overdue')
+@click.option('--date', 'as_of', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Mark invoices due before this date (default: today)')
+@with_appcontext
+def mark_overdue_command(as_of):
+    """Flip unpaid invoices past their due date to OVERDUE"""
+    from app.services import mark_overdue
+
+    marked = mark_overdue(as_of.date() if as_of else None)
+    click.echo(f"Marked {marked} invoices as overdue")
+
+
+@click.command('export-statements')
+@click.option('--output', '-o', required=True, type=click.Path(dir_okay=False, writable=True),
+              help='Path of the ZIP file to write')
+@click.option('--customer-id', 'customer_ids', type=int, multiple=True, help='Only these customers (repeatable)')
+@click.option('--as-of', type=click.DateTime(formats=['%Y-%m-%d']), help='Statement date (default: today)')
+@click.option('--chunk-size', default=200, show_default=True, help='Customers loaded per query')
+@with_appcontext
+def export_statements_command(output, customer_ids, as_of, chunk_size):
+    """Render the statement of every customer that owes money into a ZIP file, in parallel"""
+    from app.statements import stream_statement_zip
+
+    with open(output, 'wb') as f:
+        for data in stream_statement_zip(list(customer_ids), as_of.date() if as_of else None, chunk_size):
+            f.write(data)
+    click.echo(f"Wrote {output}")
+
+
+def register_commands(app):
+    app.cli.add_command(export_pdfs_command)
+    app.cli.add_command(export_data_command)
+    app.cli.add_command(import_csv_command)
+    app.cli.add_command(recalculate_totals_command)
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(rebuild_summaries_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(generate_recurring_command)
+    app.cli.add_command(mark_overdue_command)
+    app.cli.add_command(export_statements_command)
@@ -0,0 +1,244 @@
+import bisect
+import csv
+import logging
+import os
+import re
+import threading
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from flask import current_app
+from sqlalchemy import Numeric, case, literal
+
+from app import money
+
+logger = logging.getLogger(__name__)
+
+CURRENCY_CODE = re.compile(r'^[A-Z]{3}$')
+# Symbols shown before amounts; other currencies are shown as "1,234.00 CHF"
+CURRENCY_SYMBOLS = {
+    'USD': '$', 'EUR': '€', 'GBP': '£', 'JPY': '¥', 'CNY': 'CN¥', 'INR': '₹', 'CAD': 'CA$', 'AUD': 'A$',
+    'NZD': 'NZ$', 'HKD': 'HK$', 'SGD': 'S$', 'MXN': 'MX$', 'BRL': 'R$', 'KRW': '₩', 'ILS': '₪'
+}
+FACTOR_TYPE = Numeric(24, 12)
+MAX_MEMOIZED_FACTORS = 100000
+
+
+class ExchangeRateError(ValueError):
+    """A rate that is needed is missing, or the rates file is malformed"""
+
+
+def format_money(amount, currency, encoding=None):
+    """
+    amount with the symbol or code of its currency, e.g. $1,234.50 or 1,234.50 CHF.
+
+    Symbols that cannot be written in encoding (e.g. 'cp1252', the encoding
+    of the standard PDF fonts) are replaced by the code.
+    """
+    amount = Decimal(str(amount or 0))
+    sign = '-' if amount < 0 else ''
+    symbol = CURRENCY_SYMBOLS.get(currency)
+    if symbol and encoding:
+        try:
+            symbol.encode(encoding)
+        except UnicodeEncodeError:
+            symbol = None
+    if symbol:
+        return f"{sign}{symbol}{abs(amount):,.2f}"
+    return f"{sign}{abs(amount):,.2f} {currency}"
+
+
+def default_currency():
+    return current_app.config['DEFAULT_CURRENCY']
+
+
+class RateTable:
+    """
+    Exchange rates by currency and date, against one base currency.
+
+    rate(currency, on) is the number of currency units one base unit buys,
+    from the latest row on or before `on`; dates before a currency's first
+    row use that first row. The base currency is always 1.
+    """
+
+    def __init__(self, base, rates=None):
+        self.base = base
+        self._dates = {}
+        self._rates = {}
+        for currency, rows in (rates or {}).items():
+            rows = sorted(rows)
+            self._dates[currency] = [day for day, _ in rows]
+            self._rates[currency] = [rate for _, rate in rows]
+
+    @classmethod
+    def load(cls, path, base):
+        """
+        Read a CSV file with date,currency,rate columns.
+
+        Each row says one unit of the base currency bought `rate` units of
+        `currency` from `date` on. Raises ExchangeRateError on a bad row.
+        """
+        rates = {}
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            missing = {'date', 'currency', 'rate'} - {name.strip() for name in reader.fieldnames or []}
+            if missing:
+                raise ExchangeRateError(f"{path} is missing columns: {', '.join(sorted(missing))}")
+            reader.fieldnames = [name.strip() for name in reader.fieldnames]
+            for row in reader:
+                try:
+                    day = date.fromisoformat(row['date'].strip())
+                    currency = row['currency'].strip().upper()
+                    rate = Decimal(row['rate'].strip())
+                except (AttributeError, ValueError, InvalidOperation):
+                    raise ExchangeRateError(f"{path} line {reader.line_num}: expected YYYY-MM-DD,CODE,rate")
+                if not CURRENCY_CODE.match(currency) or not rate.is_finite() or rate <= 0:
+                    raise ExchangeRateError(f"{path} line {reader.line_num}: expected a currency code and a "
+                                            f"positive rate")
+                rates.setdefault(currency, []).append((day, rate))
+        return cls(base, rates)
+
+    @property
+    def currencies(self):
+        return {self.base, *self._rates}
+
+    def rate(self, currency, on):
+        if currency == self.base:
+            return Decimal(1)
+        dates = self._dates.get(currency)
+        if not dates:
+            raise ExchangeRateError(f"No exchange rate for {currency}")
+        return self._rates[currency][max(bisect.bisect_right(dates, on) - 1, 0)]
+
+
+class Converter:
+    """
+    Converts many amounts to one currency.
+
+    Each (currency, date) factor is looked up once and kept for the life of
+    the converter, so a report or export over millions of rows does a few
+    hundred rate lookups at most. Results are rounded to cents.
+    """
+
+    def __init__(self, rates, to_currency, rounding):
+        self.rates = rates
+        self.currency = to_currency
+        self.rounding = rounding
+        self._factors = {}
+
+    def factor(self, currency, on=None):
+        key = (currency, on)
+        factor = self._factors.get(key)
+        if factor is None:
+            factor = self._factors[key] = self.rates.factor(currency, self.currency, on)
+        return factor
+
+    def __call__(self, amount, currency, on=None):
+        if amount is None:
+            return None
+        if currency == self.currency:
+            return money.quantize(amount, self.rounding)
+        return money.quantize(money.to_decimal(amount) * self.factor(currency, on), self.rounding)
+
+    def sql_factor(self, currency_column, currencies, on=None):
+        """
+        SQL expression of the factor for currency_column's value, for converting inside a query.
+
+        Multiplying an amount column by it lets the database convert and sum
+        every row in a single pass; currencies are the codes the rows can hold.
+        """
+        whens = [(currency_column == currency, literal(self.factor(currency, on), FACTOR_TYPE))
+                 for currency in sorted(currencies) if currency != self.currency]
+        return case(*whens, else_=literal(Decimal(1), FACTOR_TYPE)) if whens else literal(Decimal(1), FACTOR_TYPE)
+
+
+class ExchangeRates:
+    """
+    The local exchange-rate table and memoized conversion factors.
+
+    Rates come from EXCHANGE_RATES_FILE, quoted against
+    EXCHANGE_RATES_BASE; nothing is fetched over the network. The file is
+    read on first use and again whenever it changes on disk. Without a file
+    only amounts already in the target currency can be converted.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.base = None
+        self._table = None
+        self._stamp = None
+        self._factors = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        for setting in ('DEFAULT_CURRENCY', 'REPORTING_CURRENCY', 'EXCHANGE_RATES_BASE'):
+            if not CURRENCY_CODE.match(app.config[setting]):
+                raise ValueError(f"{setting} must be a three-letter currency code, not {app.config[setting]!r}")
+        self.path = app.config['EXCHANGE_RATES_FILE']
+        self.base = app.config['EXCHANGE_RATES_BASE']
+        self._table = self._stamp = None
+        self._factors = {}
+        app.extensions['exchange_rates'] = self
+
+    @property
+    def table(self):
+        """The rate table, re-read if the file changed since it was loaded"""
+        try:
+            status = os.stat(self.path) if self.path else None
+        except FileNotFoundError:
+            status = None
+        stamp = (status.st_mtime_ns, status.st_size) if status else None
+        if self._table is not None and stamp == self._stamp:
+            return self._table
+
+        with self._lock:
+            if self._table is None or stamp != self._stamp:
+                if stamp is None:
+                    if self.path:
+                        logger.warning(f"Exchange rates file {self.path} not found; only same-currency "
+                                       f"conversions are possible")
+                    table = RateTable(self.base)
+                else:
+                    try:
+                        table = RateTable.load(self.path, self.base)
+                    except ExchangeRateError:
+                        if self._table is None:
+                            raise
+                        logger.exception(f"Keeping the previous exchange rates: {self.path} could not be read")
+                        table = self._table
+                    else:
+                        logger.info(f"Loaded exchange rates for {len(table.currencies)} currencies from {self.path}")
+                self._table, self._stamp = table, stamp
+                self._factors = {}
+            return self._table
+
+    @property
+    def currencies(self):
+        """Codes that can be used on invoices and customers"""
+        config = current_app.config
+        return sorted(self.table.currencies | {config['DEFAULT_CURRENCY'], config['REPORTING_CURRENCY']})
+
+    def factor(self, from_currency, to_currency, on=None):
+        """What one unit of from_currency is worth in to_currency on a date (default today)"""
+        if from_currency == to_currency:
+            return Decimal(1)
+        on = on or date.today()
+        table = self.table
+        factors = self._factors
+        key = (from_currency, to_currency, on)
+        factor = factors.get(key)
+        if factor is None:
+            factor = table.rate(to_currency, on) / table.rate(from_currency, on)
+            if len(factors) >= MAX_MEMOIZED_FACTORS:
+                factors.clear()
+            factors[key] = factor
+        return factor
+
+    def converter(self, to_currency=None):
+        """A Converter to to_currency (default REPORTING_CURRENCY)"""
+        from app.utils import money_settings
+
+        return Converter(self, to_currency or current_app.config['REPORTING_CURRENCY'], money_settings()['rounding'])
+
+
+exchange_rates = ExchangeRates()
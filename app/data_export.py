@@ -0,0 +1,308 @@
+import csv
+import io
+import logging
+import re
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+from sqlalchemy import select
+
+from app import db
+from app.currency import exchange_rates
+from app.models import Customer, Invoice, InvoiceItem
+from app.utils import apply_invoice_filters, StreamBuffer
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+
+EXPORT_COLUMNS = {
+    'invoices': [
+        ('id', Invoice.id),
+        ('invoice_number', Invoice.invoice_number),
+        ('customer_id', Invoice.customer_id),
+        ('customer_name', Customer.name),
+        ('issue_date', Invoice.issue_date),
+        ('due_date', Invoice.due_date),
+        ('status', Invoice.status),
+        ('subtotal', Invoice.subtotal),
+        ('tax_rate', Invoice.tax_rate),
+        ('tax_amount', Invoice.tax_amount),
+        ('total', Invoice.total),
+        ('amount_paid', Invoice.amount_paid),
+        ('currency', Invoice.currency),
+        ('notes', Invoice.notes),
+        ('created_at', Invoice.created_at),
+    ],
+    'items': [
+        ('invoice_id', InvoiceItem.invoice_id),
+        ('invoice_number', Invoice.invoice_number),
+        ('item_id', InvoiceItem.id),
+        ('description', InvoiceItem.description),
+        ('quantity', InvoiceItem.quantity),
+        ('unit_price', InvoiceItem.unit_price),
+        ('amount', InvoiceItem.amount),
+        ('currency', Invoice.currency),
+    ],
+    'customers': [
+        ('id', Customer.id),
+        ('name', Customer.name),
+        ('email', Customer.email),
+        ('phone', Customer.phone),
+        ('address', Customer.address),
+        ('currency', Customer.currency),
+        ('created_at', Customer.created_at),
+    ],
+}
+# Invoice exports end with the total in the reporting currency, at the rates of each issue date
+REPORTING_COLUMNS = ('reporting_currency', 'reporting_total')
+_TOTAL, _CURRENCY, _ISSUE_DATE = ([name for name, _ in EXPORT_COLUMNS['invoices']].index(name)
+                                  for name in ('total', 'currency', 'issue_date'))
+
+
+def export_headers(kind):
+    return [name for name, _ in EXPORT_COLUMNS[kind]] + (list(REPORTING_COLUMNS) if kind == 'invoices' else [])
+
+
+def reporting_converter(filters, currency=None):
+    """
+    Converter for the reporting_total column of an invoice export.
+
+    Every currency in the export is checked up front, so a missing rate
+    raises ExchangeRateError before the download starts rather than midway.
+    """
+    converter = exchange_rates.converter(currency)
+    currencies = db.session.execute(apply_invoice_filters(select(Invoice.currency).distinct(), filters)).scalars()
+    for code in currencies:
+        converter.factor(code, date.today())
+    return converter
+
+
+def export_query(kind, filters):
+    """
+    SELECT of the export columns for kind, narrowed by the invoice filters.
+
+    Customers are limited to those with a matching invoice when any filter
+    is given. Rows come back as plain tuples so nothing is kept in the session.
+    """
+    columns = [column.label(name) for name, column in EXPORT_COLUMNS[kind]]
+    if kind == 'invoices':
+        query = select(*columns).join_from(Invoice, Customer, Invoice.customer_id == Customer.id)
+        return apply_invoice_filters(query, filters).order_by(Invoice.id)
+    if kind == 'items':
+        query = select(*columns).join_from(InvoiceItem, Invoice, InvoiceItem.invoice_id == Invoice.id)
+        return apply_invoice_filters(query, filters).order_by(InvoiceItem.invoice_id, InvoiceItem.id)
+    query = select(*columns).order_by(Customer.id)
+    if filters:
+        query = query.filter(Customer.id.in_(apply_invoice_filters(select(Invoice.customer_id), filters)))
+    return query
+
+
+def iter_export_rows(kind, filters, chunk_size=1000, converter=None):
+    """
+    Yield lists of row tuples read through a server-side cursor, chunk_size at a time.
+
+    Invoice rows get the REPORTING_COLUMNS from converter; its factors are
+    memoized per currency and date, so there is no rate lookup per row.
+    """
+    result = db.session.execute(
+        export_query(kind, filters),
+        execution_options={'yield_per': chunk_size, 'stream_results': True}
+    )
+    try:
+        for partition in result.partitions():
+            if converter is not None:
+                partition = [(*row, converter.currency, converter(row[_TOTAL], row[_CURRENCY], row[_ISSUE_DATE]))
+                             for row in partition]
+            yield partition
+    finally:
+        result.close()
+
+
+def stream_csv(kind, filters, chunk_size=1000, converter=None):
+    """Yield a CSV export as UTF-8 bytes, one piece per chunk of rows"""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(export_headers(kind))
+    count = 0
+    for rows in iter_export_rows(kind, filters, chunk_size, converter):
+        writer.writerows(rows)
+        count += len(rows)
+        yield out.getvalue().encode('utf-8')
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue().encode('utf-8')
+    logger.info(f"Exported {count} {kind} rows as CSV")
+
+
+# SpreadsheetML parts. Only the worksheets depend on the data; they are
+# written first and the parts that list them at the end, which is fine in a
+# ZIP archive and lets the export spill onto extra sheets as it goes.
+XLSX_MAX_ROWS = 1048576
+# Sheets are split past this size. Their entries are opened with force_zip64: the size is not known
+# up front, and without it zipfile refuses to close an entry once it passes 2 GiB
+XLSX_MAX_SHEET_BYTES = 3 * 1024 ** 3
+XLSX_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+XLSX_REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+XLSX_PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+XLSX_EPOCH = date(1899, 12, 30)
+XLSX_ILLEGAL_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+XLSX_STYLES = (
+    f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<styleSheet xmlns="{XLSX_NS}">'
+    '<numFmts count="2"><numFmt numFmtId="164" formatCode="yyyy-mm-dd"/>'
+    '<numFmt numFmtId="165" formatCode="yyyy-mm-dd hh:mm:ss"/></numFmts>'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="4"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+XLSX_DATE_STYLE, XLSX_DATETIME_STYLE, XLSX_HEADER_STYLE = 1, 2, 3
+
+XLSX_SHEET_START = (
+    f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<worksheet xmlns="{XLSX_NS}">'
+    '<sheetViews><sheetView workbookViewId="0">'
+    '<pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/>'
+    '</sheetView></sheetViews><sheetData>'
+)
+XLSX_SHEET_END = '</sheetData></worksheet>'
+
+
+def xlsx_cell(value, style=0):
+    """One <c> element; the cell reference is optional and left out"""
+    style_attr = f' s="{style}"' if style else ''
+    if value is None:
+        return '<c/>'
+    if isinstance(value, bool):
+        return f'<c t="b"{style_attr}><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float, Decimal)):
+        return f'<c{style_attr}><v>{value}</v></c>'
+    if isinstance(value, datetime):
+        serial = (value - datetime(1899, 12, 30)).total_seconds() / 86400
+        return f'<c s="{XLSX_DATETIME_STYLE}"><v>{serial:.6f}</v></c>'
+    if isinstance(value, date):
+        return f'<c s="{XLSX_DATE_STYLE}"><v>{(value - XLSX_EPOCH).days}</v></c>'
+    text = escape(XLSX_ILLEGAL_CHARS.sub('', str(value)))
+    return f'<c t="inlineStr"{style_attr}><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def xlsx_row(values, style=0):
+    return '<row>' + ''.join(xlsx_cell(value, style) for value in values) + '</row>'
+
+
+def stream_xlsx(kind, filters, chunk_size=1000, converter=None):
+    """
+    Yield an .xlsx workbook piece by piece.
+
+    Rows are written as inline strings straight into a deflated worksheet
+    entry, so memory use does not grow with the export. A new sheet is started
+    when one reaches Excel's row limit.
+    """
+    headers = export_headers(kind)
+    header_row = xlsx_row(headers, XLSX_HEADER_STYLE)
+    buffer = StreamBuffer()
+    sheet_names = []
+    count = 0
+
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        def start_sheet():
+            sheet_names.append(kind.title() if not sheet_names else f"{kind.title()} {len(sheet_names) + 1}")
+            entry = archive.open(f"xl/worksheets/sheet{len(sheet_names)}.xml", 'w', force_zip64=True)
+            data = (XLSX_SHEET_START + header_row).encode('utf-8')
+            entry.write(data)
+            return entry, 1, len(data)
+
+        sheet, sheet_rows, sheet_bytes = start_sheet()
+        try:
+            for rows in iter_export_rows(kind, filters, chunk_size, converter):
+                for row in rows:
+                    data = xlsx_row(row).encode('utf-8')
+                    if sheet_rows >= XLSX_MAX_ROWS or sheet_bytes + len(data) > XLSX_MAX_SHEET_BYTES:
+                        sheet.write(XLSX_SHEET_END.encode('utf-8'))
+                        sheet.close()
+                        sheet, sheet_rows, sheet_bytes = start_sheet()
+                    sheet.write(data)
+                    sheet_rows += 1
+                    sheet_bytes += len(data)
+                count += len(rows)
+                yield buffer.drain()
+            sheet.write(XLSX_SHEET_END.encode('utf-8'))
+        finally:
+            # Also runs when the client goes away mid-download; ZipFile refuses
+            # to close while an entry is still open for writing
+            sheet.close()
+
+        for name, data in _xlsx_package_parts(sheet_names):
+            archive.writestr(name, data)
+    yield buffer.drain()
+    logger.info(f"Exported {count} {kind} rows as XLSX on {len(sheet_names)} sheet(s)")
+
+
+def _xlsx_package_parts(sheet_names):
+    numbers = range(1, len(sheet_names) + 1)
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        + ''.join(
+            f'<Override PartName="/xl/worksheets/sheet{n}.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for n in numbers
+        ) + '</Types>'
+    )
+    root_rels = (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Relationships xmlns="{XLSX_PKG_REL_NS}">'
+        f'<Relationship Id="rId1" Type="{XLSX_REL_NS}/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    )
+    workbook = (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        f'<workbook xmlns="{XLSX_NS}" xmlns:r="{XLSX_REL_NS}"><sheets>'
+        + ''.join(f'<sheet name="{escape(name)}" sheetId="{n}" r:id="rId{n}"/>'
+                  for n, name in zip(numbers, sheet_names))
+        + '</sheets></workbook>'
+    )
+    workbook_rels = (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Relationships xmlns="{XLSX_PKG_REL_NS}">'
+        + ''.join(f'<Relationship Id="rId{n}" Type="{XLSX_REL_NS}/worksheet" Target="worksheets/sheet{n}.xml"/>'
+                  for n in numbers)
+        + f'<Relationship Id="rId{len(sheet_names) + 1}" Type="{XLSX_REL_NS}/styles" Target="styles.xml"/>'
+        '</Relationships>'
+    )
+    return [
+        ('[Content_Types].xml', content_types),
+        ('_rels/.rels', root_rels),
+        ('xl/workbook.xml', workbook),
+        ('xl/_rels/workbook.xml.rels', workbook_rels),
+        ('xl/styles.xml', XLSX_STYLES),
+    ]
+
+
+def stream_export(kind, export_format, filters, chunk_size=1000, currency=None):
+    """
+    Yield an export of invoices, items or customers as CSV or XLSX bytes.
+
+    Invoice totals are also converted to currency (default REPORTING_CURRENCY).
+    """
+    if kind not in EXPORT_COLUMNS:
+        raise ValueError(f"Unknown export: {kind}")
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+    converter = reporting_converter(filters, currency) if kind == 'invoices' else None
+    stream = stream_csv if export_format == 'csv' else stream_xlsx
+    return stream(kind, filters, chunk_size, converter)
@@ -0,0 +1,89 @@
+import logging
+from functools import wraps
+
+from flask_sqlalchemy.session import Session
+from sqlalchemy.engine import make_url
+
+logger = logging.getLogger(__name__)
+
+REPLICA = 'replica'
+
+
+def engine_options(url, config):
+    """
+    Engine keyword arguments for a database URL, from the DB_* settings.
+
+    Pool sizing only applies to server databases; SQLite keeps the pool
+    Flask-SQLAlchemy picks for it. The statement timeout is set per
+    connection: max_execution_time on MySQL (SELECTs only), statement_timeout
+    on PostgreSQL. SQLite has no equivalent and ignores it.
+    """
+    backend = make_url(url).get_backend_name()
+    options = {
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'pool_recycle': config['DB_POOL_RECYCLE']
+    }
+    if backend != 'sqlite':
+        options.update(
+            pool_size=config['DB_POOL_SIZE'],
+            max_overflow=config['DB_MAX_OVERFLOW'],
+            pool_timeout=config['DB_POOL_TIMEOUT']
+        )
+
+    timeout = config['DB_STATEMENT_TIMEOUT_MS']
+    if timeout and backend == 'mysql':
+        options['connect_args'] = {'init_command': f"SET SESSION max_execution_time={int(timeout)}"}
+    elif timeout and backend == 'postgresql':
+        options['connect_args'] = {'options': f"-c statement_timeout={int(timeout)}"}
+    return options
+
+
+def configure_database(app):
+    """Fill in engine options and the read-replica bind before db.init_app"""
+    options = engine_options(app.config['SQLALCHEMY_DATABASE_URI'], app.config)
+    # Options set explicitly in the config class win over the DB_* settings
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    replica_url = app.config['READ_REPLICA_URL']
+    if replica_url:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds[REPLICA] = dict(engine_options(replica_url, app.config), url=replica_url)
+        app.config['SQLALCHEMY_BINDS'] = binds
+        logger.info(f"Read replica configured: {make_url(replica_url).render_as_string(hide_password=True)}")
+
+
+class RoutingSession(Session):
+    """
+    db.session, with SELECTs sent to the read replica inside replica_reads views.
+
+    Flushes, writes and SELECT ... FOR UPDATE always use the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get(REPLICA) and not self._flushing \
+                and getattr(clause, 'is_select', False) and getattr(clause, '_for_update_arg', None) is None:
+            engine = self._db.engines.get(REPLICA)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def replica_reads(view):
+    """
+    Run a read-only view's queries on the read replica, when one is configured.
+
+    Only for list and report pages that can show data a few seconds old.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        from app import db
+
+        info = db.session.info
+        previous = info.get(REPLICA, False)
+        info[REPLICA] = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            info[REPLICA] = previous
+    return wrapper
@@ -10,22 +10,37 @@ from wtforms import (
     FormField,
     HiddenField
 )
-from wtforms.validators import DataRequired, Email, Optional, NumberRange
+from wtforms.validators import DataRequired, Email, Length, Optional, NumberRange, ValidationError
+from werkzeug.datastructures import MultiDict
 from datetime import date
+from decimal import Decimal, InvalidOperation
+from app import db
+from app.currency import default_currency, exchange_rates
+from app.models import Customer
+
+def _upper(value):
+    return value.strip().upper() if isinstance(value, str) else value
 
 class CustomerForm(FlaskForm):
     """Form for adding/editing customers"""
-    name = StringField('Full Name', validators=[DataRequired()],
+    name = StringField('Full Name', validators=[DataRequired(), Length(max=100)],
                      render_kw={"class": "form-control"})
-    email = StringField('Email', validators=[Optional(), Email()],
+    email = StringField('Email', validators=[Optional(), Email(), Length(max=100)],
                       render_kw={"class": "form-control", "type": "email"})
-    phone = StringField('Phone', validators=[Optional()],
+    phone = StringField('Phone', validators=[Optional(), Length(max=20)],
                       render_kw={"class": "form-control", "type": "tel"})
     address = TextAreaField('Address', validators=[Optional()],
                           render_kw={"class": "form-control", "rows": 3})
+    # Invoices for the customer are billed in this currency unless they say otherwise
+    currency = SelectField('Currency', default=default_currency, filters=[_upper],
+                           render_kw={"class": "form-select"})
     submit = SubmitField('Save Customer',
                        render_kw={"class": "btn btn-primary"})
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.currency.choices = exchange_rates.currencies
+
 class InvoiceItemForm(FlaskForm):
     """Subform for individual invoice items"""
     description = StringField('Description', validators=[DataRequired()],
@@ -53,9 +68,11 @@ class InvoiceItemForm(FlaskForm):
 
 class InvoiceForm(FlaskForm):
     """Main invoice form"""
+    # Choices only hold the selected customer (see validate_customer_id)
     customer_id = SelectField(
         'Customer',
         coerce=int,
+        validate_choice=False,
         validators=[DataRequired(message="Please select a customer")],
         render_kw={
             "class": "form-select",
@@ -90,8 +107,13 @@ class InvoiceForm(FlaskForm):
             "max": "100"
         }
     )
+    # Blank bills the invoice in the customer's currency
+    currency = SelectField('Currency', validators=[Optional()], filters=[_upper],
+                           render_kw={"class": "form-select"})
     notes = TextAreaField('Notes', validators=[Optional()],
                         render_kw={"class": "form-control", "rows": 3})
+    # Row version the editor started from; a stale one makes the save a conflict
+    version = HiddenField()
     subtotal = DecimalField(
         'Subtotal',
         render_kw={
@@ -120,4 +142,193 @@ class InvoiceForm(FlaskForm):
         }
     )
     submit = SubmitField('Save Invoice',
-                       render_kw={"class": "btn btn-primary"})
\ No newline at end of file
+                       render_kw={"class": "btn btn-primary"})
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.currency.choices = [('', "Customer's currency")] + [(code, code) for code in exchange_rates.currencies]
+
+    def validate_customer_id(self, field):
+        """Check the one selected customer exists instead of matching a full choice list"""
+        if field.data and db.session.get(Customer, field.data) is None:
+            raise ValidationError('Selected customer does not exist')
+
+# Validation of plain dicts (JSON bodies, CSV rows) with the rules of the forms above
+CUSTOMER_FIELDS = ('name', 'email', 'phone', 'address', 'currency')
+
+def customer_formdata(data):
+    return MultiDict({key: str(value) for key, value in data.items()
+                      if key in CUSTOMER_FIELDS and value is not None})
+
+def customer_form(data):
+    """
+    CustomerForm bound to a dict, without CSRF, so callers share the HTML form's rules.
+
+    To check many dicts, rebind one form with form.process(customer_formdata(data)).
+    """
+    return CustomerForm(formdata=customer_formdata(data), meta={'csrf': False})
+
+def _decimal(value, minimum=None, maximum=None):
+    try:
+        number = Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        raise ValueError('must be a number')
+    if not number.is_finite():
+        raise ValueError('must be a number')
+    if minimum is not None and number < minimum:
+        raise ValueError(f"must be at least {minimum}")
+    if maximum is not None and number > maximum:
+        raise ValueError(f"must be at most {maximum}")
+    return number
+
+def validate_invoice_payload(payload):
+    """
+    Check one invoice payload with the same rules as InvoiceForm/InvoiceItemForm.
+
+    Returns (spec, errors): a spec for services.create_invoices, and a dict of
+    field errors that is empty when the payload is valid. Whether the customer
+    exists is checked by the caller, once for a whole batch.
+    """
+    errors = {}
+    if not isinstance(payload, dict):
+        return None, {'invoice': 'must be an object'}
+
+    spec = {'notes': payload.get('notes') or None, 'status': 'DRAFT'}
+
+    try:
+        spec['customer_id'] = int(payload['customer_id'])
+    except (KeyError, TypeError, ValueError):
+        errors['customer_id'] = 'Please select a customer'
+
+    for field in ('issue_date', 'due_date'):
+        try:
+            spec[field] = date.fromisoformat(payload[field])
+        except (KeyError, TypeError, ValueError):
+            errors[field] = 'must be a date (YYYY-MM-DD)'
+
+    try:
+        spec['tax_rate'] = _decimal(payload.get('tax_rate') or 0, 0, 100)
+    except ValueError as e:
+        errors['tax_rate'] = str(e)
+
+    # Without a currency the invoice is billed in the customer's
+    if payload.get('currency'):
+        currency = _upper(payload['currency'])
+        if currency in exchange_rates.currencies:
+            spec['currency'] = currency
+        else:
+            errors['currency'] = 'must be a currency with an exchange rate'
+
+    spec['items'] = _validate_items(payload.get('items'), errors, with_ids=True)
+    return spec, errors
+
+def _validate_items(items, errors, with_ids=False):
+    """
+    Item dicts checked with the InvoiceItemForm rules; problems go into errors under items[i].
+
+    with_ids keeps the id of items that name one, to match them to saved items.
+    """
+    if not isinstance(items, list) or not items:
+        errors['items'] = 'At least one invoice item is required'
+        items = []
+
+    valid = []
+    for index, item in enumerate(items):
+        item_errors = {}
+        if not isinstance(item, dict):
+            errors[f"items[{index}]"] = {'item': 'must be an object'}
+            continue
+        description = item.get('description')
+        if not isinstance(description, str) or not description.strip():
+            item_errors['description'] = 'This field is required.'
+        elif len(description) > 255:
+            item_errors['description'] = 'must be at most 255 characters'
+        values = {}
+        for field in ('quantity', 'unit_price'):
+            try:
+                values[field] = _decimal(item.get(field), Decimal('0.01'))
+            except ValueError as e:
+                item_errors[field] = str(e)
+        item_id = item.get('id') if with_ids else None
+        if item_id is not None and (isinstance(item_id, bool) or not isinstance(item_id, int)):
+            item_errors['id'] = 'must be the integer id of an item of this invoice'
+        if item_errors:
+            errors[f"items[{index}]"] = item_errors
+        else:
+            valid.append({'description': description.strip(), **values, **({'id': item_id} if item_id else {})})
+    return valid
+
+def validate_item_rows(items):
+    """Check the item rows of the HTML invoice forms; returns (items, errors) keyed like the payload errors"""
+    errors = {}
+    return _validate_items(items, errors, with_ids=True), errors
+
+RECURRING_INTERVALS = ('weekly', 'monthly', 'quarterly', 'yearly')
+
+def validate_recurring_payload(payload):
+    """
+    Check a recurring invoice template payload.
+
+    Returns (spec, errors) like validate_invoice_payload; the spec holds
+    RecurringInvoice columns plus an 'items' list.
+    """
+    errors = {}
+    if not isinstance(payload, dict):
+        return None, {'recurring_invoice': 'must be an object'}
+
+    spec = {'notes': payload.get('notes') or None, 'interval': payload.get('interval') or 'monthly'}
+    if spec['interval'] not in RECURRING_INTERVALS:
+        errors['interval'] = f"must be one of {', '.join(RECURRING_INTERVALS)}"
+
+    try:
+        spec['customer_id'] = int(payload['customer_id'])
+    except (KeyError, TypeError, ValueError):
+        errors['customer_id'] = 'Please select a customer'
+
+    try:
+        spec['start_date'] = date.fromisoformat(payload['start_date'])
+    except (KeyError, TypeError, ValueError):
+        errors['start_date'] = 'must be a date (YYYY-MM-DD)'
+    spec['end_date'] = None
+    if payload.get('end_date'):
+        try:
+            spec['end_date'] = date.fromisoformat(payload['end_date'])
+        except (TypeError, ValueError):
+            errors['end_date'] = 'must be a date (YYYY-MM-DD)'
+        else:
+            if spec.get('start_date') and spec['end_date'] < spec['start_date']:
+                errors['end_date'] = 'must not be before the start date'
+
+    try:
+        spec['due_days'] = int(_decimal(payload.get('due_days', 30), 0, 365))
+    except ValueError as e:
+        errors['due_days'] = str(e)
+    try:
+        spec['tax_rate'] = _decimal(payload.get('tax_rate') or 0, 0, 100)
+    except ValueError as e:
+        errors['tax_rate'] = str(e)
+
+    spec['items'] = _validate_items(payload.get('items'), errors)
+    return spec, errors
+
+PAYMENT_METHODS = ('manual', 'bank', 'card', 'cash', 'check', 'other')
+
+def validate_payment_payload(payload):
+    """Check one payment payload; returns (spec, errors) like validate_invoice_payload"""
+    if not isinstance(payload, dict):
+        return None, {'payment': 'must be an object'}
+    errors = {}
+    spec = {'method': payload.get('method') or 'manual', 'reference': payload.get('reference') or None}
+    try:
+        spec['amount'] = _decimal(payload.get('amount'), Decimal('0.01'))
+    except ValueError as e:
+        errors['amount'] = str(e)
+    try:
+        spec['paid_on'] = date.fromisoformat(payload['paid_on']) if payload.get('paid_on') else None
+    except (TypeError, ValueError):
+        errors['paid_on'] = 'must be a date (YYYY-MM-DD)'
+    if spec['method'] not in PAYMENT_METHODS:
+        errors['method'] = f"must be one of {', '.join(PAYMENT_METHODS)}"
+    if spec['reference'] is not None and (not isinstance(spec['reference'], str) or len(spec['reference']) > 100):
+        errors['reference'] = 'must be text of at most 100 characters'
+    return spec, errors
@@ -0,0 +1,374 @@
+import csv
+import logging
+import re
+from datetime import date
+
+from sqlalchemy import insert, select
+
+from app import db, money, services
+from app.forms import CUSTOMER_FIELDS, customer_form, customer_formdata, validate_invoice_payload
+from app.models import Customer, Invoice, Payment
+from app.numbering import invoice_numbers
+
+logger = logging.getLogger(__name__)
+
+IMPORT_KINDS = ('customers', 'invoices', 'payments')
+
+INVOICE_HEADER_FIELDS = ('customer_id', 'issue_date', 'due_date', 'tax_rate', 'currency', 'notes')
+INVOICE_REQUIRED_COLUMNS = ('issue_date', 'due_date', 'description', 'quantity', 'unit_price')
+PAYMENT_REQUIRED_COLUMNS = ('date', 'amount')
+
+
+class ImportResult:
+    """Counts and per-row problems of one import; rows are numbered by CSV line"""
+
+    def __init__(self, kind, dry_run=False):
+        self.kind = kind
+        self.dry_run = dry_run
+        self.rows = 0
+        self.created = 0
+        self.problems = []
+
+    def error(self, line, field, message):
+        self.problems.append((line, 'error', field or '', message))
+
+    def skip(self, line, field, message):
+        self.problems.append((line, 'skipped', field or '', message))
+
+    @property
+    def errors(self):
+        return [problem for problem in self.problems if problem[1] == 'error']
+
+    @property
+    def skipped(self):
+        return [problem for problem in self.problems if problem[1] == 'skipped']
+
+    def write_report(self, f):
+        writer = csv.writer(f)
+        writer.writerow(['line', 'status', 'field', 'message'])
+        writer.writerows(sorted(self.problems, key=lambda problem: problem[0]))
+
+    def to_dict(self, max_problems=None):
+        problems = self.problems if max_problems is None else self.problems[:max_problems]
+        return {
+            'kind': self.kind,
+            'dry_run': self.dry_run,
+            'rows': self.rows,
+            'created': self.created,
+            'errors': len(self.errors),
+            'skipped': len(self.skipped),
+            'problems': [
+                {'line': line, 'status': status, 'field': field, 'message': message}
+                for line, status, field, message in problems
+            ]
+        }
+
+
+def read_csv(stream, required):
+    """DictReader over a text stream, after checking the header has the required columns"""
+    reader = csv.DictReader(stream)
+    columns = {name.strip() for name in reader.fieldnames or []}
+    missing = [name for name in required if name not in columns]
+    if missing:
+        raise ValueError(f"CSV is missing required columns: {', '.join(missing)}")
+    reader.fieldnames = [name.strip() for name in reader.fieldnames]
+    return reader
+
+
+def _cell(row, column):
+    value = row.get(column)
+    if value is None:
+        return None
+    return value.strip() or None
+
+
+def _customer_ids_by_email():
+    """Lower-cased email -> customer id for every customer with an email, read in one pass"""
+    rows = db.session.execute(
+        select(Customer.email, Customer.id).where(Customer.email.isnot(None)),
+        execution_options={'yield_per': 10000}
+    )
+    return {email.lower(): customer_id for email, customer_id in rows}
+
+
+def import_customers(stream, batch_size=1000, dry_run=False):
+    """
+    Import customers from a CSV with name, email, phone, address and (optional) currency columns.
+
+    Every row is validated with CustomerForm. Rows whose email belongs to an
+    existing customer, or to an earlier row of the file, are skipped. Valid
+    rows are inserted batch_size at a time, one transaction per batch.
+    """
+    result = ImportResult('customers', dry_run)
+    reader = read_csv(stream, ('name',))
+    known = _customer_ids_by_email()
+    form = customer_form({})
+    batch = []
+
+    for row in reader:
+        line = reader.line_num
+        result.rows += 1
+        form.process(customer_formdata({field: _cell(row, field) for field in CUSTOMER_FIELDS}))
+        if not form.validate():
+            for field, messages in form.errors.items():
+                for message in messages:
+                    result.error(line, field, message)
+            continue
+
+        values = {field: getattr(form, field).data or None for field in CUSTOMER_FIELDS}
+        email = values['email'].lower() if values['email'] else None
+        if email in known:
+            result.skip(line, 'email', 'A customer with this email already exists')
+            continue
+        if email:
+            known[email] = None
+        batch.append((line, values))
+        if len(batch) >= batch_size:
+            _insert_customers(batch, result)
+            batch = []
+
+    if batch:
+        _insert_customers(batch, result)
+    logger.info(f"Customer import: {result.rows} rows, {result.created} created, "
+                f"{len(result.skipped)} skipped, {len(result.errors)} errors")
+    return result
+
+
+def _insert_customers(batch, result):
+    if result.dry_run:
+        result.created += len(batch)
+        return
+    try:
+        db.session.execute(insert(Customer), [values for _, values in batch])
+        db.session.commit()
+        result.created += len(batch)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error importing customers on lines {batch[0][0]}-{batch[-1][0]}: {str(e)}")
+        for line, _ in batch:
+            result.error(line, None, 'Not saved: the batch containing this row failed')
+
+
+def _invoice_groups(reader, result):
+    """
+    Yield lists of (line, row) that make up one invoice.
+
+    Adjacent rows with the same invoice_ref are the line items of one invoice;
+    rows without an invoice_ref are invoices of their own.
+    """
+    seen = set()
+    group, group_ref = [], None
+    for row in reader:
+        line = reader.line_num
+        result.rows += 1
+        ref = _cell(row, 'invoice_ref')
+        if group and ref is not None and ref == group_ref:
+            group.append((line, row))
+            continue
+        if group:
+            yield group
+        if ref is not None and ref in seen:
+            result.error(line, 'invoice_ref', f"Rows of invoice {ref} must be adjacent")
+            group, group_ref = [], None
+            continue
+        if ref is not None:
+            seen.add(ref)
+        group, group_ref = [(line, row)], ref
+    if group:
+        yield group
+
+
+def import_invoices(stream, batch_size=500, dry_run=False):
+    """
+    Import invoices from a CSV with one row per line item.
+
+    Columns: invoice_ref, customer_email or customer_id, issue_date, due_date,
+    tax_rate, currency, notes, description, quantity, unit_price. Invoice fields are
+    read from the first row of each invoice. Every invoice is validated with
+    the InvoiceForm rules and batch_size invoices are created per transaction
+    through services.create_invoices.
+    """
+    result = ImportResult('invoices', dry_run)
+    reader = read_csv(stream, INVOICE_REQUIRED_COLUMNS)
+    if 'customer_email' not in reader.fieldnames and 'customer_id' not in reader.fieldnames:
+        raise ValueError('CSV needs a customer_email or customer_id column')
+    emails = _customer_ids_by_email() if 'customer_email' in reader.fieldnames else {}
+    batch = []
+
+    for group in _invoice_groups(reader, result):
+        first_line, first = group[0]
+        payload = {field: _cell(first, field) for field in INVOICE_HEADER_FIELDS}
+        payload['items'] = [{
+            'description': _cell(row, 'description'),
+            'quantity': _cell(row, 'quantity'),
+            'unit_price': _cell(row, 'unit_price')
+        } for _, row in group]
+
+        email = _cell(first, 'customer_email')
+        if email:
+            payload['customer_id'] = emails.get(email.lower())
+            if payload['customer_id'] is None:
+                result.error(first_line, 'customer_email', 'No customer with this email')
+                continue
+
+        spec, errors = validate_invoice_payload(payload)
+        if errors:
+            _report_invoice_errors(group, errors, result)
+            continue
+        batch.append(([line for line, _ in group], spec))
+        if len(batch) >= batch_size:
+            _create_invoices(batch, result)
+            batch = []
+
+    if batch:
+        _create_invoices(batch, result)
+    logger.info(f"Invoice import: {result.rows} rows, {result.created} invoices created, "
+                f"{len(result.errors)} errors")
+    return result
+
+
+def _report_invoice_errors(group, errors, result):
+    for key, message in errors.items():
+        if key.startswith('items['):
+            line = group[int(key[6:-1])][0]
+            for field, item_message in message.items():
+                result.error(line, field, item_message)
+        else:
+            result.error(group[0][0], key, message)
+
+
+def _create_invoices(batch, result):
+    customer_ids = {spec['customer_id'] for _, spec in batch}
+    known = set(db.session.execute(select(Customer.id).where(Customer.id.in_(customer_ids))).scalars())
+    valid = []
+    for lines, spec in batch:
+        if spec['customer_id'] in known:
+            valid.append((lines, spec))
+        else:
+            result.error(lines[0], 'customer_id', 'Selected customer does not exist')
+    if not valid:
+        return
+
+    if result.dry_run:
+        result.created += len(valid)
+        return
+    try:
+        services.create_invoices([spec for _, spec in valid])
+        result.created += len(valid)
+    except Exception as e:
+        logger.error(f"Error importing invoices on lines {valid[0][0][0]}-{valid[-1][0][-1]}: {str(e)}")
+        for lines, _ in valid:
+            result.error(lines[0], None, 'Not saved: the batch containing this invoice failed')
+
+
+def invoice_number_pattern():
+    """Regex finding invoice numbers of the configured series in free text"""
+    return re.compile(rf"\b{re.escape(invoice_numbers.prefix)}-(?:\d{{4}}-)?\d{{4,}}\b", re.IGNORECASE)
+
+
+def import_payments(stream, batch_size=1000, dry_run=False):
+    """
+    Reconcile a bank statement CSV against open invoices.
+
+    Columns: date (YYYY-MM-DD), amount, and invoice_number or a reference /
+    description text that contains one. Debits and zero amounts are skipped,
+    as are rows whose reference was already recorded, so a statement can be
+    imported again safely. Each batch is matched with one invoice query and
+    recorded with services.record_payments in one transaction.
+    """
+    result = ImportResult('payments', dry_run)
+    reader = read_csv(stream, PAYMENT_REQUIRED_COLUMNS)
+    pattern = invoice_number_pattern()
+    seen_references = set()
+    batch = []
+
+    for row in reader:
+        line = reader.line_num
+        result.rows += 1
+        try:
+            amount = money.quantize(money.to_decimal((_cell(row, 'amount') or '').replace(',', '').replace('$', '')))
+        except ValueError as e:
+            result.error(line, 'amount', str(e))
+            continue
+        if amount <= 0:
+            result.skip(line, 'amount', 'Not a credit')
+            continue
+        try:
+            paid_on = date.fromisoformat(_cell(row, 'date') or '')
+        except ValueError:
+            result.error(line, 'date', 'must be a date (YYYY-MM-DD)')
+            continue
+
+        number = _cell(row, 'invoice_number')
+        if not number:
+            match = pattern.search(' '.join(filter(None, (_cell(row, 'reference'), _cell(row, 'description')))))
+            number = match.group(0) if match else None
+        if not number:
+            result.skip(line, 'invoice_number', 'No invoice number found')
+            continue
+
+        reference = (_cell(row, 'reference') or '')[:100] or None
+        if reference is not None:
+            if reference in seen_references:
+                result.skip(line, 'reference', 'Duplicate of an earlier row')
+                continue
+            seen_references.add(reference)
+        batch.append((line, {'invoice_number': number.upper(), 'amount': amount, 'paid_on': paid_on,
+                             'method': 'bank', 'reference': reference}))
+        if len(batch) >= batch_size:
+            _record_payments(batch, result)
+            batch = []
+
+    if batch:
+        _record_payments(batch, result)
+    logger.info(f"Payment import: {result.rows} rows, {result.created} payments recorded, "
+                f"{len(result.skipped)} skipped, {len(result.errors)} errors")
+    return result
+
+
+def _record_payments(batch, result):
+    numbers = {payment['invoice_number'] for _, payment in batch}
+    references = [payment['reference'] for _, payment in batch if payment['reference']]
+    invoices = {number: [invoice_id, balance] for invoice_id, number, balance in db.session.execute(
+        select(Invoice.id, Invoice.invoice_number, Invoice.total - Invoice.amount_paid)
+        .where(Invoice.invoice_number.in_(numbers))
+    )}
+    recorded = set(db.session.execute(
+        select(Payment.reference).where(Payment.reference.in_(references))
+    ).scalars()) if references else set()
+
+    valid = []
+    for line, payment in batch:
+        invoice = invoices.get(payment.pop('invoice_number'))
+        if payment['reference'] in recorded:
+            result.skip(line, 'reference', 'Payment already recorded')
+        elif invoice is None:
+            result.error(line, 'invoice_number', 'No invoice with this number')
+        elif payment['amount'] > money.to_decimal(invoice[1]):
+            result.error(line, 'amount', f"More than the {money.quantize(invoice[1])} still due")
+        else:
+            invoice[1] = money.to_decimal(invoice[1]) - payment['amount']
+            valid.append((line, dict(payment, invoice_id=invoice[0])))
+    if not valid:
+        return
+
+    if result.dry_run:
+        result.created += len(valid)
+        return
+    try:
+        services.record_payments([payment for _, payment in valid])
+        result.created += len(valid)
+    except Exception as e:
+        logger.error(f"Error recording payments on lines {valid[0][0]}-{valid[-1][0]}: {str(e)}")
+        for line, _ in valid:
+            result.error(line, None, 'Not saved: the batch containing this row failed')
+
+
+def import_csv(kind, stream, batch_size=None, dry_run=False):
+    if kind not in IMPORT_KINDS:
+        raise ValueError(f"Unknown import: {kind}")
+    if kind == 'customers':
+        return import_customers(stream, batch_size or 1000, dry_run)
+    if kind == 'payments':
+        return import_payments(stream, batch_size or 1000, dry_run)
+    return import_invoices(stream, batch_size or 500, dry_run)
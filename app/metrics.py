@@ -0,0 +1,229 @@
+import logging
+import threading
+import time
+from collections import Counter as Tally
+
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+NO_ENDPOINT = '(none)'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing value per label set"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_labels(self.labels, labels)} {_number(value)}"
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observations per label set"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts, total = self._values.get(labels, (None, 0.0))
+            if counts is None:
+                counts = [0] * len(self.buckets)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[labels] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.labels, labels, ('le', _number(bound)))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+
+class Metrics:
+    """
+    Opt-in request, SQL and PDF render instrumentation.
+
+    With METRICS_ENABLED, request latency, SQL query counts and time (from
+    SQLAlchemy cursor events) and PDF render times are kept in memory and
+    served in Prometheus text format at /metrics. With METRICS_DETECT_N_PLUS_ONE
+    (or when the app starts in debug mode, e.g. FLASK_DEBUG=1) a request that runs the same statement many times is
+    logged as a likely N+1 query pattern.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.detect_n_plus_one = False
+        self.n_plus_one_threshold = 10
+        self._listening = False
+        self._lock = threading.Lock()
+
+        self.request_duration = Histogram(
+            'http_request_duration_seconds', 'Time spent handling a request', ('endpoint', 'method'))
+        self.requests = Counter(
+            'http_requests_total', 'Requests handled', ('endpoint', 'method', 'status'))
+        self.request_queries = Histogram(
+            'sql_queries_per_request', 'SQL statements executed per request', ('endpoint',),
+            buckets=QUERY_COUNT_BUCKETS)
+        self.queries = Counter(
+            'sql_queries_total', 'SQL statements executed', ('endpoint',))
+        self.query_seconds = Counter(
+            'sql_query_seconds_total', 'Time spent executing SQL statements', ('endpoint',))
+        self.n_plus_one = Counter(
+            'sql_n_plus_one_total', 'Requests that repeated one statement past the N+1 threshold', ('endpoint',))
+        self.pdf_render = Histogram(
+            'pdf_render_seconds', 'Time spent rendering invoice PDFs', ('mode', 'stage'))
+        self.registry = [
+            self.request_duration, self.requests, self.request_queries, self.queries,
+            self.query_seconds, self.n_plus_one, self.pdf_render
+        ]
+
+    def init_app(self, app):
+        self.enabled = app.config['METRICS_ENABLED']
+        self.detect_n_plus_one = app.config['METRICS_DETECT_N_PLUS_ONE']
+        self.n_plus_one_threshold = app.config['METRICS_N_PLUS_ONE_THRESHOLD']
+        app.extensions['metrics'] = self
+        if not (self.enabled or self.detect_n_plus_one or app.debug):
+            return
+
+        self._listen()
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        if self.enabled:
+            app.add_url_rule('/metrics', 'metrics', self.render_response)
+
+    def _listen(self):
+        # Engine-wide listeners, registered once however many apps are created
+        with self._lock:
+            if self._listening:
+                return
+            event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(Engine, 'handle_error', self._handle_error)
+            self._listening = True
+
+    def _start_request(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_statements = Tally()
+
+    def _finish_request(self, response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        endpoint = request.endpoint or NO_ENDPOINT
+        queries = g.pop('metrics_queries', 0)
+        statements = g.pop('metrics_statements', None)
+
+        if self.enabled:
+            self.request_duration.observe(time.perf_counter() - started, endpoint, request.method)
+            self.requests.inc(endpoint, request.method, str(response.status_code))
+            self.request_queries.observe(queries, endpoint)
+
+        if statements and (self.detect_n_plus_one or current_app.debug):
+            repeated = [(sql, count) for sql, count in statements.items() if count >= self.n_plus_one_threshold]
+            for sql, count in repeated:
+                logger.warning(f"Possible N+1 query in {endpoint}: statement ran {count} times "
+                               f"({queries} queries in total): {' '.join(sql.split())[:200]}")
+            if repeated and self.enabled:
+                self.n_plus_one.inc(endpoint)
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_query_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('metrics_query_started')
+        if not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+
+        endpoint = NO_ENDPOINT
+        if has_request_context() and 'metrics_started' in g:
+            endpoint = request.endpoint or NO_ENDPOINT
+            g.metrics_queries += 1
+            g.metrics_statements[statement] += 1
+        if self.enabled:
+            self.queries.inc(endpoint)
+            self.query_seconds.inc(endpoint, amount=elapsed)
+
+    def _handle_error(self, context):
+        # A failed statement never reaches after_cursor_execute; drop its start time so the
+        # stack, kept with the pooled connection, does not grow or time later statements from it
+        started = context.connection.info.get('metrics_query_started') if context.connection is not None else None
+        if started:
+            started.pop()
+
+    def observe_pdf_render(self, timings, mode):
+        """Record the stage timings reported by generate_pdf"""
+        if not self.enabled:
+            return
+        for stage, seconds in timings.items():
+            self.pdf_render.observe(seconds, mode, stage)
+
+    def render(self):
+        lines = []
+        for metric in self.registry:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def render_response(self):
+        return Response(self.render(), content_type=CONTENT_TYPE)
+
+
+metrics = Metrics()
@@ -1,44 +1,252 @@
 from app import db
+from app.currency import default_currency
 from datetime import datetime
+from sqlalchemy.dialects import mysql
+
+# Microsecond precision on MySQL too, so two changes within a second get different stamps
+Timestamp = db.DateTime().with_variant(mysql.DATETIME(fsp=6), 'mysql')
 
 class Customer(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    email = db.Column(db.String(100))
-    phone = db.Column(db.String(20))
+    name = db.Column(db.String(100), nullable=False, index=True)
+    email = db.Column(db.String(100), index=True)
+    phone = db.Column(db.String(20), index=True)
     address = db.Column(db.Text)
+    # Currency new invoices for this customer are billed in
+    currency = db.Column(db.String(3), nullable=False, default=default_currency, server_default='USD')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Version stamp for cached pages and the search index; NULL on rows not changed since the column was added
+    updated_at = db.Column(Timestamp, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     invoices = db.relationship('Invoice', backref='customer', lazy=True)
 
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'email': self.email,
+            'phone': self.phone,
+            'address': self.address,
+            'currency': self.currency,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
     def __repr__(self):
         return f'<Customer {self.name}>'
 
 class Invoice(db.Model):
+    # Serves the overdue sweep and unpaid-by-due-date lookups
+    __table_args__ = (db.Index('ix_invoice_status_due_date', 'status', 'due_date'),)
+
     id = db.Column(db.Integer, primary_key=True)
     invoice_number = db.Column(db.String(20), unique=True, nullable=False)
-    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
-    issue_date = db.Column(db.Date, nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False, index=True)
+    issue_date = db.Column(db.Date, nullable=False, index=True)
     due_date = db.Column(db.Date, nullable=False)
     subtotal = db.Column(db.Numeric(10, 2), nullable=False)
     tax_rate = db.Column(db.Numeric(5, 2), default=0.00)
     tax_amount = db.Column(db.Numeric(10, 2), default=0.00)
     total = db.Column(db.Numeric(10, 2), nullable=False)
+    # Sum of the invoice's payments, kept up to date by app.services
+    amount_paid = db.Column(db.Numeric(10, 2), nullable=False, default=0, server_default='0')
+    # Every amount of the invoice, its items and payments is in this currency
+    currency = db.Column(db.String(3), nullable=False, default=default_currency, server_default='USD')
     notes = db.Column(db.Text)
-    status = db.Column(db.String(20), default='DRAFT')
+    status = db.Column(db.String(20), default='DRAFT', index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Version stamp for cached pages and the search index; bumped by every UPDATE, and by app.services when
+    # only items change
+    updated_at = db.Column(Timestamp, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # Row version: ORM updates check and bump it, bulk UPDATEs in app.services bump it themselves
+    version = db.Column(db.Integer, nullable=False, server_default='1')
     items = db.relationship('InvoiceItem', backref='invoice', lazy=True, cascade='all, delete-orphan')
+    payments = db.relationship('Payment', backref='invoice', lazy=True, cascade='all, delete-orphan',
+                               order_by='Payment.paid_on, Payment.id')
+    __mapper_args__ = {'version_id_col': version}
     def is_paid(self):
         return self.status.upper() == 'PAID'
+    @property
+    def balance_due(self):
+        return (self.total or 0) - (self.amount_paid or 0)
+    def to_dict(self, include_items=False):
+        data = {
+            'id': self.id,
+            'invoice_number': self.invoice_number,
+            'customer_id': self.customer_id,
+            'customer_name': self.customer.name if self.customer else None,
+            'issue_date': self.issue_date.isoformat(),
+            'due_date': self.due_date.isoformat(),
+            'subtotal': str(self.subtotal),
+            'tax_rate': str(self.tax_rate),
+            'tax_amount': str(self.tax_amount),
+            'total': str(self.total),
+            'currency': self.currency,
+            'amount_paid': str(self.amount_paid),
+            'balance_due': str(self.balance_due),
+            'notes': self.notes,
+            'status': self.status,
+            'version': self.version
+        }
+        if include_items:
+            data['items'] = [item.to_dict() for item in self.items]
+        return data
     def __repr__(self):
         return f'<Invoice {self.invoice_number}>'
 
 class InvoiceItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False, index=True)
     description = db.Column(db.String(255), nullable=False)
     quantity = db.Column(db.Numeric(10, 2), nullable=False)
     unit_price = db.Column(db.Numeric(10, 2), nullable=False)
     amount = db.Column(db.Numeric(10, 2), nullable=False)
 
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'description': self.description,
+            'quantity': str(self.quantity),
+            'unit_price': str(self.unit_price),
+            'amount': str(self.amount)
+        }
+
+    def __repr__(self):
+        return f'<InvoiceItem {self.description}>'
+
+class InvoiceSequence(db.Model):
+    """Next free invoice number per numbering series (prefix, and year when numbers reset yearly)"""
+    name = db.Column(db.String(40), primary_key=True)
+    next_value = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<InvoiceSequence {self.name}={self.next_value}>'
+
+class SummaryTotals:
+    """Invoice count and summed amounts of a summary rollup row, in the row's currency"""
+    invoice_count = db.Column(db.Integer, nullable=False, default=0)
+    subtotal = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    tax_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    total = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    amount_paid = db.Column(db.Numeric(14, 2), nullable=False, default=0, server_default='0')
+
+class InvoiceDaySummary(SummaryTotals, db.Model):
+    """Invoice totals per issue date, currency and status; kept up to date by app.services"""
+    issue_date = db.Column(db.Date, primary_key=True)
+    currency = db.Column(db.String(3), primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+
+    def __repr__(self):
+        return f'<InvoiceDaySummary {self.issue_date} {self.currency} {self.status}: {self.invoice_count}>'
+
+class InvoiceCustomerSummary(SummaryTotals, db.Model):
+    """Invoice totals per customer, currency and status; kept up to date by app.services"""
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), primary_key=True)
+    currency = db.Column(db.String(3), primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+
+    def __repr__(self):
+        return f'<InvoiceCustomerSummary {self.customer_id} {self.currency} {self.status}: {self.invoice_count}>'
+
+class InvoiceDueSummary(SummaryTotals, db.Model):
+    """Invoice totals per due date, currency and status, for overdue and aging figures"""
+    due_date = db.Column(db.Date, primary_key=True)
+    currency = db.Column(db.String(3), primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+
+    def __repr__(self):
+        return f'<InvoiceDueSummary {self.due_date} {self.currency} {self.status}: {self.invoice_count}>'
+
+class Payment(db.Model):
+    """Money received against an invoice; an invoice may have several partial payments"""
+    id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False, index=True)
+    amount = db.Column(db.Numeric(10, 2), nullable=False)
+    paid_on = db.Column(db.Date, nullable=False, index=True)
+    method = db.Column(db.String(20), nullable=False, default='manual')
+    # Bank transaction id or similar; reconciliation skips references it has already recorded
+    reference = db.Column(db.String(100), index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'invoice_id': self.invoice_id,
+            'amount': str(self.amount),
+            'paid_on': self.paid_on.isoformat(),
+            'method': self.method,
+            'reference': self.reference,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+    def __repr__(self):
+        return f'<Payment {self.amount} for {self.invoice_id}>'
+
+class RecurringInvoice(db.Model):
+    """Template for an invoice billed to a customer every interval, turned into invoices by app.recurring"""
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False, index=True)
+    interval = db.Column(db.String(10), nullable=False, default='monthly')
+    start_date = db.Column(db.Date, nullable=False)
+    next_issue_date = db.Column(db.Date, nullable=False, index=True)
+    end_date = db.Column(db.Date)
+    due_days = db.Column(db.Integer, nullable=False, default=30)
+    tax_rate = db.Column(db.Numeric(5, 2), default=0.00)
+    notes = db.Column(db.Text)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    customer = db.relationship('Customer', backref=db.backref('recurring_invoices', cascade='all, delete-orphan'))
+    items = db.relationship('RecurringInvoiceItem', backref='recurring_invoice', lazy=True,
+                            cascade='all, delete-orphan', order_by='RecurringInvoiceItem.id')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'customer_id': self.customer_id,
+            'interval': self.interval,
+            'start_date': self.start_date.isoformat(),
+            'next_issue_date': self.next_issue_date.isoformat(),
+            'end_date': self.end_date.isoformat() if self.end_date else None,
+            'due_days': self.due_days,
+            'tax_rate': str(self.tax_rate),
+            'notes': self.notes,
+            'active': self.active,
+            'items': [item.to_dict() for item in self.items]
+        }
+
+    def __repr__(self):
+        return f'<RecurringInvoice {self.id} {self.interval} for {self.customer_id}>'
+
+class RecurringInvoiceItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    recurring_id = db.Column(db.Integer, db.ForeignKey('recurring_invoice.id'), nullable=False, index=True)
+    description = db.Column(db.String(255), nullable=False)
+    quantity = db.Column(db.Numeric(10, 2), nullable=False)
+    unit_price = db.Column(db.Numeric(10, 2), nullable=False)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'description': self.description,
+            'quantity': str(self.quantity),
+            'unit_price': str(self.unit_price)
+        }
+
+    def __repr__(self):
+        return f'<RecurringInvoiceItem {self.description}>'
+
+class RecurringInvoiceRun(db.Model):
+    """The invoice generated for one period of a recurring invoice; the primary key stops duplicates"""
+    recurring_id = db.Column(db.Integer, db.ForeignKey('recurring_invoice.id'), primary_key=True)
+    period = db.Column(db.Date, primary_key=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id', ondelete='SET NULL'), index=True)
+
+    def __repr__(self):
+        return f'<RecurringInvoiceRun {self.recurring_id} {self.period}>'
+
+class SchemaVersion(db.Model):
+    """Fingerprint of the models each time the schema was upgraded; startup skips DDL when the latest matches"""
+    id = db.Column(db.Integer, primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    upgraded_at = db.Column(db.DateTime, default=datetime.utcnow)
+
     def __repr__(self):
-        return f'<InvoiceItem {self.description}>'
\ No newline at end of file
+        return f'<SchemaVersion {self.fingerprint[:12]} at {self.upgraded_at}>'
@@ -0,0 +1,229 @@
+"""
+Exact money arithmetic for invoices.
+
+Amounts are Decimals with two places (or integer cents in the batch path) and
+every rounding step uses an explicit rounding mode, so computed totals match
+the Numeric(10, 2) columns they are stored in.
+"""
+from decimal import Decimal, Inexact, InvalidOperation, ROUND_HALF_EVEN, ROUND_HALF_UP, localcontext
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; batch_totals falls back to Python ints
+    np = None
+
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+ROUNDING_MODES = (ROUND_HALF_UP, ROUND_HALF_EVEN)
+DEFAULT_ROUNDING = ROUND_HALF_UP
+
+# Largest cents x cents product that still fits in an int64 with room for summing
+_INT64_SAFE = 2 ** 62
+
+
+def to_decimal(value):
+    """Convert a number or numeric string to Decimal without going through float"""
+    if isinstance(value, Decimal):
+        return value
+    if value is None or value == '':
+        return ZERO
+    try:
+        number = Decimal(str(value))
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount: {value!r}")
+    if not number.is_finite():
+        raise ValueError(f"Invalid amount: {value!r}")
+    return number
+
+
+def quantize(value, rounding=DEFAULT_ROUNDING):
+    """Round a value to cents"""
+    return to_decimal(value).quantize(CENT, rounding=rounding)
+
+
+def to_cents(value, rounding=DEFAULT_ROUNDING):
+    value = to_decimal(value)
+    numerator, denominator = value.as_integer_ratio()
+    if 100 % denominator == 0:
+        # Already a whole number of cents, the common case for stored amounts
+        return numerator * (100 // denominator)
+    return int(value.scaleb(2).to_integral_value(rounding=rounding))
+
+
+def from_cents(cents):
+    return Decimal(int(cents)).scaleb(-2)
+
+
+def line_amount(quantity, unit_price, rounding=DEFAULT_ROUNDING):
+    """
+    Amount of one line item, rounded to cents.
+
+    Quantity and price are rounded to cents first, as they are when stored.
+    """
+    return quantize(quantize(quantity, rounding) * quantize(unit_price, rounding), rounding)
+
+
+def line_tax(amount, tax_rate, rounding=DEFAULT_ROUNDING):
+    """Tax on an amount at a percentage rate, rounded to cents"""
+    return quantize(to_decimal(amount) * quantize(tax_rate, rounding) / 100, rounding)
+
+
+def invoice_totals(items, tax_rate, rounding=DEFAULT_ROUNDING, per_line_tax=False):
+    """
+    Subtotal, tax and total of a list of {quantity, unit_price} items.
+
+    Each line is rounded to cents before summing. Tax is computed on the
+    subtotal, or with per_line_tax on every line separately and then summed.
+    Returns Decimals.
+    """
+    _check_rounding(rounding)
+    amounts = [line_amount(item['quantity'], item['unit_price'], rounding) for item in items]
+    subtotal = sum(amounts, ZERO)
+    if per_line_tax:
+        tax_amount = sum((line_tax(amount, tax_rate, rounding) for amount in amounts), ZERO)
+    else:
+        tax_amount = line_tax(subtotal, tax_rate, rounding)
+    return {
+        'subtotal': subtotal,
+        'tax_amount': tax_amount,
+        'total': subtotal + tax_amount,
+        'amounts': amounts
+    }
+
+
+def batch_totals(invoices, rounding=DEFAULT_ROUNDING, per_line_tax=False, use_numpy=None):
+    """
+    Totals for many invoices at once.
+
+    invoices is a sequence of dicts with 'items' and 'tax_rate' (the specs
+    taken by services.create_invoices). All items are flattened into integer
+    cents and rounded with integer arithmetic, using numpy arrays when it is
+    installed and the values fit in int64. Results are identical to calling
+    invoice_totals on each invoice.
+    """
+    _check_rounding(rounding)
+    counts = [len(invoice['items']) for invoice in invoices]
+    rates = _cents_list([invoice.get('tax_rate') or 0 for invoice in invoices], rounding)
+    quantities = _cents_list([item['quantity'] for invoice in invoices for item in invoice['items']], rounding)
+    prices = _cents_list([item['unit_price'] for invoice in invoices for item in invoice['items']], rounding)
+
+    if use_numpy is None:
+        use_numpy = np is not None and _fits_int64(quantities, prices, rates)
+    elif use_numpy and np is None:
+        raise RuntimeError('numpy is not installed')
+
+    if use_numpy:
+        amounts, subtotals, taxes = _batch_numpy(counts, quantities, prices, rates, rounding, per_line_tax)
+    else:
+        amounts, subtotals, taxes = _batch_python(counts, quantities, prices, rates, rounding, per_line_tax)
+
+    amounts = _decimal_list(amounts)
+    results = []
+    start = 0
+    for count, subtotal, tax in zip(counts, subtotals, taxes):
+        results.append({
+            'subtotal': from_cents(subtotal),
+            'tax_amount': from_cents(tax),
+            'total': from_cents(subtotal + tax),
+            'amounts': amounts[start:start + count]
+        })
+        start += count
+    return results
+
+
+def _cents_list(values, rounding):
+    """
+    to_cents over a list.
+
+    Whole-cent Decimals (everything read from the database) are converted by
+    truncation, then checked all at once: truncation never grows a magnitude,
+    so the conversion was exact iff the sums of magnitudes match. Anything
+    else goes through to_cents value by value.
+    """
+    try:
+        cents = [int(value.scaleb(2)) for value in values]
+        with localcontext() as ctx:
+            ctx.traps[Inexact] = True
+            if sum(map(abs, values), ZERO).scaleb(2) == sum(map(abs, cents)):
+                return cents
+    except (AttributeError, ArithmeticError, ValueError):
+        pass
+    return [to_cents(value, rounding) for value in values]
+
+
+def _decimal_list(cents):
+    scale = CENT
+    return [Decimal(value) * scale for value in cents]
+
+
+def _check_rounding(rounding):
+    if rounding not in ROUNDING_MODES:
+        raise ValueError(f"Unsupported rounding mode: {rounding}")
+
+
+def _fits_int64(quantities, prices, rates):
+    if not quantities:
+        return True
+    largest = max(map(abs, quantities)) * max(map(abs, prices))
+    return largest * max(len(quantities), 1) < _INT64_SAFE and \
+        largest * max(map(abs, rates), default=0) < _INT64_SAFE
+
+
+def _round_div(numerator, denominator, rounding):
+    """
+    numerator / denominator rounded to an integer, for ints or numpy arrays.
+
+    Works on magnitudes so halves round away from zero (HALF_UP) or to the
+    even neighbour (HALF_EVEN) regardless of sign.
+    """
+    negative = numerator < 0
+    quotient, remainder = divmod(abs(numerator), denominator)
+    twice = remainder * 2
+    if rounding == ROUND_HALF_UP:
+        bump = twice >= denominator
+    else:
+        bump = (twice > denominator) | ((twice == denominator) & (quotient % 2 == 1))
+    quotient = quotient + bump
+    return quotient * (1 - 2 * negative)
+
+
+def _batch_python(counts, quantities, prices, rates, rounding, per_line_tax):
+    # cents x cents is in 1/10000ths, one division brings each line back to cents
+    amounts = [_round_div(q * p, 100, rounding) for q, p in zip(quantities, prices)]
+    subtotals, taxes = [], []
+    start = 0
+    for count, rate in zip(counts, rates):
+        lines = amounts[start:start + count]
+        subtotal = sum(lines)
+        # rate is in hundredths of a percent
+        if per_line_tax:
+            tax = sum(_round_div(amount * rate, 10000, rounding) for amount in lines)
+        else:
+            tax = _round_div(subtotal * rate, 10000, rounding)
+        subtotals.append(subtotal)
+        taxes.append(tax)
+        start += count
+    return amounts, subtotals, taxes
+
+
+def _batch_numpy(counts, quantities, prices, rates, rounding, per_line_tax):
+    counts = np.asarray(counts, dtype=np.int64)
+    rates = np.asarray(rates, dtype=np.int64)
+    amounts = _round_div(np.asarray(quantities, dtype=np.int64) * np.asarray(prices, dtype=np.int64),
+                         100, rounding)
+    starts = np.cumsum(counts) - counts
+    filled = counts > 0
+
+    def per_invoice(values):
+        sums = np.zeros(len(counts), dtype=np.int64)
+        if filled.any():
+            sums[filled] = np.add.reduceat(values, starts[filled])
+        return sums
+
+    subtotals = per_invoice(amounts)
+    if per_line_tax:
+        taxes = per_invoice(_round_div(amounts * np.repeat(rates, counts), 10000, rounding))
+    else:
+        taxes = _round_div(subtotals * rates, 10000, rounding)
+    return amounts.tolist(), subtotals.tolist(), taxes.tolist()
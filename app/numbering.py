@@ -0,0 +1,97 @@
+import logging
+import threading
+from datetime import date
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models import Invoice, InvoiceSequence
+
+logger = logging.getLogger(__name__)
+
+
+class InvoiceNumberAllocator:
+    """
+    Hands out invoice numbers from the invoice_sequence table.
+
+    Each process reserves a block of numbers with a single atomic UPDATE on the
+    series row, committed in its own short transaction, and then serves numbers
+    from that block under a thread lock. The row lock is held only for the
+    reservation, so concurrent requests on any number of threads, processes or
+    app nodes never see the same number. Numbers left in a block when a process
+    exits are skipped; set INVOICE_NUMBER_BLOCK_SIZE=1 for gap-free numbering.
+    """
+
+    def __init__(self):
+        self.prefix = 'INV'
+        self.block_size = 10
+        self.yearly_reset = False
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.prefix = app.config['INVOICE_NUMBER_PREFIX']
+        self.block_size = max(1, app.config['INVOICE_NUMBER_BLOCK_SIZE'])
+        self.yearly_reset = app.config['INVOICE_NUMBER_RESET'] == 'yearly'
+        with self._lock:
+            self._blocks.clear()
+        app.extensions['invoice_numbers'] = self
+
+    def series_for(self, issue_date=None):
+        """Name of the numbering series an invoice issued on issue_date belongs to"""
+        if self.yearly_reset:
+            return f"{self.prefix}-{(issue_date or date.today()).year}"
+        return self.prefix
+
+    def allocate(self, issue_date=None):
+        return self.allocate_many(1, issue_date)[0]
+
+    def allocate_many(self, count, issue_date=None):
+        """Return count consecutive-as-possible invoice numbers for one series"""
+        series = self.series_for(issue_date)
+        values = []
+        with self._lock:
+            block = self._blocks.get(series)
+            while len(values) < count:
+                if block is None or block[0] >= block[1]:
+                    size = max(self.block_size, count - len(values))
+                    start = self._reserve(series, size)
+                    block = [start, start + size]
+                    self._blocks[series] = block
+                take = min(count - len(values), block[1] - block[0])
+                values.extend(range(block[0], block[0] + take))
+                block[0] += take
+        return [f"{series}-{value:04d}" for value in values]
+
+    def _reserve(self, series, size):
+        """Atomically advance the series by size and return the first reserved value"""
+        table = InvoiceSequence.__table__
+        for _ in range(3):
+            with db.engine.begin() as conn:
+                updated = conn.execute(
+                    table.update()
+                    .where(table.c.name == series)
+                    .values(next_value=table.c.next_value + size)
+                ).rowcount
+                if updated:
+                    end = conn.execute(select(table.c.next_value).where(table.c.name == series)).scalar_one()
+                    return end - size
+            self._create_series(series)
+        raise RuntimeError(f"Could not reserve invoice numbers for series {series}")
+
+    def _create_series(self, series):
+        table = InvoiceSequence.__table__
+        try:
+            with db.engine.begin() as conn:
+                # A fresh non-yearly series continues where MAX(id)-based numbering left off
+                start = 1
+                if not self.yearly_reset:
+                    start = (conn.execute(select(func.max(Invoice.id))).scalar() or 0) + 1
+                conn.execute(table.insert().values(name=series, next_value=start))
+                logger.info(f"Created invoice number series {series} starting at {start}")
+        except IntegrityError:
+            pass  # another worker created it first
+
+
+invoice_numbers = InvoiceNumberAllocator()
@@ -0,0 +1,220 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import date, datetime
+from glob import glob
+
+from flask import Response, make_response, request, session
+from sqlalchemy import select
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever a cached template or JSON layout changes so old entries are not served
+RENDER_VERSION = '3'
+
+InvoiceVersion = namedtuple('InvoiceVersion', 'invoice_number version updated_at customer_updated_at')
+
+
+class MemoryBackend:
+    """In-process LRU of the latest entries per invoice or customer"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, namespace, name, key):
+        with self._lock:
+            entries = self._entries.get(namespace)
+            if entries is None:
+                return None
+            self._entries.move_to_end(namespace)
+            entry = entries.get(name)
+            return entry[1] if entry and entry[0] == key else None
+
+    def set(self, namespace, name, key, value):
+        with self._lock:
+            self._entries.setdefault(namespace, {})[name] = (key, value)
+            self._entries.move_to_end(namespace)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *namespaces):
+        with self._lock:
+            for namespace in namespaces:
+                self._entries.pop(namespace, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileBackend:
+    """Entries as files in a local directory, shared by every worker process on the host"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path_for(self, namespace, name, key):
+        return os.path.join(self.cache_dir, f"{namespace}.{name}.{key}.cache")
+
+    def get(self, namespace, name, key):
+        try:
+            with open(self.path_for(namespace, name, key), 'rb') as f:
+                return f.read().decode('utf-8')
+        except FileNotFoundError:
+            return None
+
+    def set(self, namespace, name, key, value):
+        path = self.path_for(namespace, name, key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value.encode('utf-8'))
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._remove(f"{namespace}.{name}.*.cache", keep=path)
+
+    def delete(self, *namespaces):
+        for namespace in namespaces:
+            self._remove(f"{namespace}.*.cache")
+
+    def clear(self):
+        self._remove('*.cache')
+
+    def _remove(self, pattern, keep=None):
+        for path in glob(os.path.join(self.cache_dir, pattern)):
+            if path != keep:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+class PageCache:
+    """
+    Cache of rendered invoice pages and read-only JSON documents.
+
+    Entries are keyed on the row version and updated_at stamp of the invoice
+    and the stamp of its customer, read with one primary-key query per
+    request, so a changed invoice misses the cache in every process. The same key is the ETag:
+    a client revalidating an unchanged page gets a 304 without the invoice
+    being loaded at all. app.services also drops entries when it changes an
+    invoice or customer, which frees them at once.
+    """
+
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        backend = app.config['PAGE_CACHE_BACKEND']
+        if backend == 'memory':
+            self.backend = MemoryBackend(app.config['PAGE_CACHE_SIZE'])
+        elif backend == 'file':
+            self.backend = FileBackend(app.config['PAGE_CACHE_DIR'])
+        elif backend == 'none':
+            self.backend = None
+        else:
+            raise ValueError(f"PAGE_CACHE_BACKEND must be 'memory', 'file' or 'none', not {backend!r}")
+        app.extensions['page_cache'] = self
+
+    def invoice_version(self, invoice_id):
+        """The invoice number, row version and stamps of an invoice, or None if it does not exist"""
+        from app import db
+        from app.models import Customer, Invoice
+
+        row = db.session.execute(
+            select(Invoice.invoice_number, Invoice.version, Invoice.updated_at, Customer.updated_at)
+            .outerjoin(Customer, Customer.id == Invoice.customer_id)
+            .where(Invoice.id == invoice_id)
+        ).first()
+        return InvoiceVersion(*row) if row else None
+
+    def customer_version(self, customer_id):
+        """The version stamp of a customer as a one-element tuple, or None if it does not exist"""
+        from app import db
+        from app.models import Customer
+
+        row = db.session.execute(select(Customer.updated_at).where(Customer.id == customer_id)).first()
+        return tuple(row) if row else None
+
+    @staticmethod
+    def key(name, object_id, version, daily=False):
+        """
+        Cache key and ETag of one document.
+
+        Pages that show today's date (through `now`) are keyed on it too.
+        """
+        parts = [RENDER_VERSION, name, object_id, *version]
+        if daily:
+            parts.append(date.today())
+        return hashlib.sha256('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+
+    @staticmethod
+    def last_modified(version):
+        stamps = [stamp for stamp in version if isinstance(stamp, datetime)]
+        return max(stamps).replace(microsecond=0) if stamps else None
+
+    def fetch(self, namespace, name, key, render):
+        """The cached document, or render() stored under key"""
+        if self.backend is None:
+            return render()
+        value = self.backend.get(namespace, name, key)
+        if value is None:
+            value = render()
+            self.backend.set(namespace, name, key, str(value))
+        return value
+
+    def serve(self, namespace, name, key, last_modified, render, build):
+        """
+        Answer a GET for a cached document.
+
+        render() produces the document (an HTML fragment or JSON text) on a
+        miss; build(document) wraps it in the response. Clients that already
+        hold this version get a 304 and nothing is rendered. No validators are
+        sent while flash messages are waiting, as the page shows them.
+        """
+        flashes = bool(session.get('_flashes'))
+        if not flashes and self._fresh(key, last_modified):
+            return self._validators(Response(status=304), key, last_modified)
+        response = make_response(build(self.fetch(namespace, name, key, render)))
+        return response if flashes else self._validators(response, key, last_modified)
+
+    @staticmethod
+    def _fresh(key, last_modified):
+        if request.if_none_match:
+            return request.if_none_match.contains(key)
+        return bool(last_modified and request.if_modified_since
+                    and last_modified <= request.if_modified_since.replace(tzinfo=None))
+
+    @staticmethod
+    def _validators(response, key, last_modified):
+        # Browsers may keep the page but must revalidate it on every visit
+        response.set_etag(key)
+        if last_modified:
+            response.last_modified = last_modified
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    def invalidate_invoices(self, *invoice_ids):
+        if self.backend is not None and invoice_ids:
+            self.backend.delete(*(f"invoice_{invoice_id}" for invoice_id in invoice_ids))
+
+    def invalidate_customers(self, *customer_ids):
+        if self.backend is not None and customer_ids:
+            self.backend.delete(*(f"customer_{customer_id}" for customer_id in customer_ids))
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+page_cache = PageCache()
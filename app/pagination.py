@@ -0,0 +1,93 @@
+import base64
+import json
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import and_, or_
+
+
+class KeysetPage:
+    """One page of results from paginate_keyset"""
+
+    def __init__(self, items, next_cursor, per_page):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.per_page = per_page
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def encode_cursor(values):
+    """Serialize the sort key of the last row of a page into an opaque token"""
+    def default(value):
+        if isinstance(value, (date, datetime)):
+            return value.isoformat()
+        if isinstance(value, Decimal):
+            return str(value)
+        raise TypeError(f"Cannot encode {type(value).__name__} in a cursor")
+    raw = json.dumps(values, default=default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Turn a cursor token back into typed values for the given columns"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        raise ValueError('Malformed cursor')
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('Malformed cursor')
+
+    typed = []
+    for column, value in zip(columns, values):
+        python_type = column.type.python_type
+        try:
+            if python_type is datetime:
+                value = datetime.fromisoformat(value)
+            elif python_type is date:
+                value = date.fromisoformat(value)
+            elif python_type is Decimal:
+                value = Decimal(value)
+                if not value.is_finite():
+                    raise ValueError(value)
+            elif isinstance(value, bool) or not isinstance(value, (int, float) if python_type is float else python_type):
+                raise TypeError(value)
+        except (TypeError, ValueError, InvalidOperation):
+            # A tampered cursor must not get past here as anything but a ValueError
+            raise ValueError('Malformed cursor')
+        typed.append(value)
+    return typed
+
+
+def paginate_keyset(query, sort_column, id_column, descending=False, cursor=None, per_page=50):
+    """
+    Paginate a query by (sort_column, id_column) without OFFSET.
+
+    The cursor carries the sort key of the last row already seen, so each page
+    is a range scan on the sort index no matter how deep the client pages.
+    sort_column must not be nullable.
+    """
+    if cursor:
+        last_value, last_id = decode_cursor(cursor, [sort_column, id_column])
+        if descending:
+            query = query.filter(or_(sort_column < last_value,
+                                     and_(sort_column == last_value, id_column < last_id)))
+        else:
+            query = query.filter(or_(sort_column > last_value,
+                                     and_(sort_column == last_value, id_column > last_id)))
+
+    if descending:
+        query = query.order_by(sort_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(sort_column.asc(), id_column.asc())
+
+    rows = query.limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, sort_column.key), getattr(last, id_column.key)])
+    return KeysetPage(rows, next_cursor, per_page)
@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from glob import glob
+
+from app.metrics import metrics
+from app.pdf_generator import generate_pdf
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the PDF layout changes so old cached files are not served
+RENDER_VERSION = '1'
+
+
+def invoice_fingerprint(invoice):
+    """Hash everything that ends up in the rendered PDF of an invoice"""
+    customer = invoice.customer
+    parts = [
+        RENDER_VERSION,
+        invoice.id, invoice.invoice_number, invoice.issue_date, invoice.due_date,
+        invoice.subtotal, invoice.tax_rate, invoice.tax_amount, invoice.total, invoice.currency,
+        invoice.notes, invoice.status,
+    ]
+    if customer is not None:
+        parts += [customer.id, customer.name, customer.email, customer.phone, customer.address]
+    for item in sorted(invoice.items, key=lambda i: i.id or 0):
+        parts += [item.id, item.description, item.quantity, item.unit_price, item.amount]
+
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\x1f')
+    return digest.hexdigest()
+
+
+class PDFCache:
+    """
+    Two-level cache of rendered invoice PDFs.
+
+    Files on disk are named after the invoice id and its fingerprint, so a
+    changed invoice simply misses the cache. The in-memory LRU maps invoice ids
+    to the fingerprint/path of the last render to skip the disk lookup.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=256):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.cache_dir = app.config['PDF_CACHE_DIR']
+        self.max_entries = app.config['PDF_CACHE_SIZE']
+        os.makedirs(self.cache_dir, exist_ok=True)
+        app.extensions['pdf_cache'] = self
+
+    def path_for(self, invoice_id, fingerprint):
+        return os.path.join(self.cache_dir, f"invoice_{invoice_id}_{fingerprint}.pdf")
+
+    def get(self, invoice_id, fingerprint):
+        """Return the cached PDF path, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(invoice_id)
+            if entry and entry[0] == fingerprint:
+                self._entries.move_to_end(invoice_id)
+                if os.path.exists(entry[1]):
+                    return entry[1]
+                del self._entries[invoice_id]
+
+        path = self.path_for(invoice_id, fingerprint)
+        if os.path.exists(path):
+            self._remember(invoice_id, fingerprint, path)
+            return path
+        return None
+
+    def put(self, invoice_id, fingerprint, data):
+        """Atomically write PDF bytes into the cache and return the file path"""
+        path = self.path_for(invoice_id, fingerprint)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self._remove_files(invoice_id, keep=path)
+        self._remember(invoice_id, fingerprint, path)
+        return path
+
+    def fetch(self, invoice, fingerprint=None):
+        """Return the PDF path for an invoice, rendering it on a cache miss"""
+        fingerprint = fingerprint or invoice_fingerprint(invoice)
+        path = self.get(invoice.id, fingerprint)
+        if path:
+            return path
+
+        timings = {}
+        buffer = generate_pdf(invoice, timings=timings)
+        metrics.observe_pdf_render(timings, 'sync')
+        logger.info(f"PDF cache miss for invoice {invoice.invoice_number}: rendered in "
+                    f"{timings['total'] * 1000:.1f}ms (flowables {timings['flowables'] * 1000:.1f}ms, "
+                    f"layout {timings['layout'] * 1000:.1f}ms)")
+        return self.put(invoice.id, fingerprint, buffer.getbuffer())
+
+    def invalidate(self, *invoice_ids):
+        """Drop cached PDFs for the given invoices from memory and disk"""
+        with self._lock:
+            for invoice_id in invoice_ids:
+                self._entries.pop(invoice_id, None)
+        for invoice_id in invoice_ids:
+            self._remove_files(invoice_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        for path in glob(os.path.join(self.cache_dir, 'invoice_*_*.pdf')):
+            self._safe_remove(path)
+
+    def _remember(self, invoice_id, fingerprint, path):
+        with self._lock:
+            self._entries[invoice_id] = (fingerprint, path)
+            self._entries.move_to_end(invoice_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _remove_files(self, invoice_id, keep=None):
+        for path in glob(os.path.join(self.cache_dir, f"invoice_{invoice_id}_*.pdf")):
+            if path != keep:
+                self._safe_remove(path)
+
+    @staticmethod
+    def _safe_remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+pdf_cache = PDFCache()
@@ -0,0 +1,84 @@
+import logging
+import zipfile
+from concurrent.futures import as_completed
+
+from sqlalchemy.orm import joinedload
+
+from app import db
+from app.metrics import metrics
+from app.models import Invoice
+from app.pdf_cache import pdf_cache, invoice_fingerprint
+from app.pdf_jobs import pdf_jobs, invoice_snapshot, render_pdf_bytes
+from app.utils import apply_invoice_filters, StreamBuffer
+
+logger = logging.getLogger(__name__)
+
+
+def iter_invoice_chunks(filters, chunk_size=200):
+    """
+    Yield lists of matching invoices with customer and items eager loaded.
+
+    Chunks are read in id order using the last id seen as the next lower bound,
+    and each chunk is expunged from the session once the caller moves on.
+    """
+    last_id = 0
+    while True:
+        chunk = apply_invoice_filters(Invoice.query, filters).options(
+            joinedload(Invoice.customer),
+            joinedload(Invoice.items)
+        ).filter(Invoice.id > last_id).order_by(Invoice.id).limit(chunk_size).all()
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1].id
+        for invoice in chunk:
+            db.session.expunge(invoice)
+
+
+def render_invoice_pdfs(filters, chunk_size=200, timings=None):
+    """
+    Yield (filename, pdf_bytes) for every matching invoice.
+
+    Cached PDFs are read straight from disk; the rest of each chunk is rendered
+    in parallel on the PDF worker pool and yielded in completion order. If a
+    timings dict is passed, per-stage render times are summed into it along
+    with the number of cached and rendered PDFs.
+    """
+    if timings is None:
+        timings = {}
+    for chunk in iter_invoice_chunks(filters, chunk_size):
+        cached, futures = [], {}
+        for invoice in chunk:
+            filename = f"invoice_{invoice.invoice_number}.pdf"
+            path = pdf_cache.get(invoice.id, invoice_fingerprint(invoice))
+            if path:
+                cached.append((filename, path))
+            else:
+                futures[pdf_jobs.executor.submit(render_pdf_bytes, invoice_snapshot(invoice))] = filename
+
+        timings['cached'] = timings.get('cached', 0) + len(cached)
+        for filename, path in cached:
+            with open(path, 'rb') as f:
+                yield filename, f.read()
+        for future in as_completed(futures):
+            data, render_timings = future.result()
+            metrics.observe_pdf_render(render_timings, 'export')
+            timings['rendered'] = timings.get('rendered', 0) + 1
+            for stage, seconds in render_timings.items():
+                timings[stage] = timings.get(stage, 0.0) + seconds
+            yield futures[future], data
+
+
+def stream_invoice_zip(filters, chunk_size=200):
+    """Yield a ZIP archive of invoice PDFs piece by piece as renders finish"""
+    buffer = StreamBuffer()
+    timings = {}
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for filename, data in render_invoice_pdfs(filters, chunk_size, timings):
+            archive.writestr(filename, data)
+            yield buffer.drain()
+    yield buffer.drain()
+    logger.info(f"Exported {timings.get('cached', 0) + timings.get('rendered', 0)} invoice PDFs "
+                f"({timings.get('cached', 0)} cached, {timings.get('rendered', 0)} rendered, "
+                f"{timings.get('total', 0.0):.2f}s worker render time, "
+                f"{timings.get('layout', 0.0):.2f}s of it in layout)")
@@ -1,28 +1,248 @@
+import copy
+import threading
+import time
+from bisect import bisect_right
 from io import BytesIO
+from itertools import accumulate
 from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, TableStyle, Spacer
+from reportlab.lib.utils import simpleSplit
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, TableStyle, Spacer, Flowable
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib import colors
 from reportlab.lib.units import inch
-from datetime import datetime
+from reportlab.pdfbase import pdfmetrics
 from typing import Union, Optional
 
-def generate_pdf(invoice, output_path: Optional[str] = None) -> Union[BytesIO, str]:
+from app.currency import format_money
+
+ITEM_COL_WIDTHS = [3.5*inch, 0.75*inch, inch, inch]
+ITEM_HEADERS = ['Description', 'Qty', 'Unit Price', 'Amount']
+STATEMENT_COL_WIDTHS = [3.75*inch, inch, inch, inch]
+STATEMENT_HEADERS = ['Description', 'Charges', 'Payments', 'Balance']
+# The standard Helvetica fonts only draw cp1252 characters; other currency symbols become codes
+PDF_ENCODING = 'cp1252'
+
+
+def pdf_money(amount, currency):
+    return format_money(amount, currency, PDF_ENCODING)
+
+
+class LineItemGrid(Flowable):
     """
-    Generate a PDF invoice from an invoice object.
-    
-    Args:
-        invoice: The invoice object containing all necessary data
-        output_path: Optional path to save the PDF directly to a file
-        
-    Returns:
-        BytesIO buffer if no output_path provided, otherwise returns the file path
+    Line-item table drawn straight onto the canvas.
+
+    Produces the same layout as the Platypus items Table (cell paddings, 10pt
+    Helvetica with 12pt leading, header and row backgrounds, grid) without a
+    Paragraph per cell. Row heights are computed once from font metrics, a page
+    split is a bisect over the cumulative heights, and each page only draws the
+    rows that land on it. Like the Table, the header is not repeated on
+    continuation pages.
     """
-    try:
-        # Initialize buffer or file path
+
+    FONT = 'Helvetica'
+    BOLD_FONT = 'Helvetica-Bold'
+    FONT_SIZE = 10
+    LEADING = 12
+    PAD_X = 6
+    PAD_TOP = 3
+    PAD_BOTTOM = 3
+    HEADER_PAD_BOTTOM = 8
+    HEADER_BACKGROUND = colors.HexColor('#404040')
+    ROW_BACKGROUND = colors.HexColor('#F5F5F5')
+    GRID_COLOR = colors.lightgrey
+    GRID_WIDTH = 0.5
+    HEADERS = ITEM_HEADERS
+    REPEAT_HEADER = False
+
+    def __init__(self, items=None, col_widths=ITEM_COL_WIDTHS, currency='USD', _rows=None, _offsets=None,
+                 _start=0, _end=None, _header=True):
+        super().__init__()
+        self.col_widths = col_widths
+        self.currency = currency
+        self.col_x = [0] + list(accumulate(col_widths))
+        self.hAlign = 'LEFT'
+        if _rows is None:
+            _rows, heights = self._measure(items)
+            _offsets = [0] + list(accumulate(heights))
+        self._rows = _rows
+        self._offsets = _offsets
+        self._start = _start
+        self._end = len(_rows) if _end is None else _end
+        self._header = _header
+        self._header_height = self.LEADING + self.PAD_TOP + self.HEADER_PAD_BOTTOM if _header else 0
+
+    def _measure(self, items):
+        text_width = self.col_widths[0] - 2 * self.PAD_X
+        rows, heights = [], []
+        for item in items:
+            description = ' '.join(str(item.description).split())
+            lines = simpleSplit(description, self.FONT, self.FONT_SIZE, text_width) or ['']
+            rows.append((lines, str(item.quantity), pdf_money(item.unit_price, self.currency),
+                         pdf_money(item.amount, self.currency)))
+            heights.append(len(lines) * self.LEADING + self.PAD_TOP + self.PAD_BOTTOM)
+        return rows, heights
+
+    def _part(self, start, end, header):
+        return type(self)(col_widths=self.col_widths, currency=self.currency, _rows=self._rows,
+                          _offsets=self._offsets, _start=start, _end=end, _header=header)
+
+    def wrap(self, availWidth, availHeight):
+        self.width = self.col_x[-1]
+        self.height = self._header_height + self._offsets[self._end] - self._offsets[self._start]
+        return self.width, self.height
+
+    def split(self, availWidth, availHeight):
+        budget = availHeight - self._header_height + self._offsets[self._start]
+        cut = bisect_right(self._offsets, budget, lo=self._start, hi=self._end + 1) - 1
+        if cut <= self._start:
+            return []
+        return [self._part(self._start, cut, self._header), self._part(cut, self._end, self.REPEAT_HEADER)]
+
+    def draw(self):
+        canv = self.canv
+        width, top = self.col_x[-1], self.height
+        body_top = top - self._header_height
+        row_tops = [body_top - (offset - self._offsets[self._start])
+                    for offset in self._offsets[self._start:self._end + 1]]
+
+        # Backgrounds, then grid lines, then text, in the same order as Table
+        canv.saveState()
+        if self._header:
+            canv.setFillColor(self.HEADER_BACKGROUND)
+            canv.rect(0, body_top, width, self._header_height, stroke=0, fill=1)
+        if self._end > self._start:
+            canv.setFillColor(self.ROW_BACKGROUND)
+            canv.rect(0, 0, width, body_top, stroke=0, fill=1)
+
+        canv.setStrokeColor(self.GRID_COLOR)
+        canv.setLineWidth(self.GRID_WIDTH)
+        path = canv.beginPath()
+        for y in ([top] if self._header else []) + row_tops:
+            path.moveTo(0, y)
+            path.lineTo(width, y)
+        for x in self.col_x:
+            path.moveTo(x, 0)
+            path.lineTo(x, top)
+        canv.drawPath(path, stroke=1, fill=0)
+
+        canv.setFillColor(colors.black)
+        if self._header:
+            canv.setFont(self.BOLD_FONT, self.FONT_SIZE)
+            baseline = top - self.PAD_TOP - self.FONT_SIZE
+            for x, label in zip(self.col_x, self.HEADERS):
+                canv.drawString(x + self.PAD_X, baseline, label)
+
+        canv.setFont(self.FONT, self.FONT_SIZE)
+        right_edges = [x - self.PAD_X for x in self.col_x[2:]]
+        for row, row_top in zip(self._rows[self._start:self._end], row_tops):
+            lines, *numbers = row
+            baseline = row_top - self.PAD_TOP - self.FONT_SIZE
+            for i, line in enumerate(lines):
+                canv.drawString(self.PAD_X, baseline - i * self.LEADING, line)
+            for right, text in zip(right_edges, numbers):
+                canv.drawRightString(right, baseline, text)
+        canv.restoreState()
+
+
+class StatementGrid(LineItemGrid):
+    """
+    Account statement ledger in the LineItemGrid layout, header repeated on every page.
+
+    Rows are (description, charges, payments, balance) tuples of text; the
+    description wraps, the amounts are right aligned.
+    """
+
+    HEADERS = STATEMENT_HEADERS
+    REPEAT_HEADER = True
+
+    def __init__(self, rows=None, col_widths=STATEMENT_COL_WIDTHS, **kwargs):
+        super().__init__(rows, col_widths, **kwargs)
+
+    def _measure(self, rows):
+        text_width = self.col_widths[0] - 2 * self.PAD_X
+        measured, heights = [], []
+        for description, *amounts in rows:
+            lines = simpleSplit(' '.join(description.split()), self.FONT, self.FONT_SIZE, text_width) or ['']
+            measured.append((lines, *amounts))
+            heights.append(len(lines) * self.LEADING + self.PAD_TOP + self.PAD_BOTTOM)
+        return measured, heights
+
+
+class PDFRenderer:
+    """
+    Invoice PDF renderer that keeps its static parts between renders.
+
+    Stylesheets, table styles, font metrics and the flowables that never change
+    (title, headings, the line-item header row) are built once in __init__. Each
+    render only creates the flowables that depend on the invoice, and shallow
+    copies of the static ones so Platypus can lay them out independently.
+
+    Invoices with at least fast_path_min_items line items use LineItemGrid
+    instead of a Platypus Table for the items.
+    """
+
+    def __init__(self, fast_path_min_items=500):
+        self.fast_path_min_items = fast_path_min_items
+
+        # Load font metrics up front instead of on the first render
+        for font in ('Helvetica', 'Helvetica-Bold'):
+            pdfmetrics.getFont(font)
+
+        self.styles = getSampleStyleSheet()
+        self.styles.add(ParagraphStyle(
+            name='RightAlign',
+            parent=self.styles['Normal'],
+            alignment=2  # 0=left, 1=center, 2=right
+        ))
+
+        self.items_table_style = TableStyle([
+            ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#404040')),
+            ('TEXTCOLOR', (0,0), (-1,0), colors.whitesmoke),
+            ('ALIGN', (0,0), (-1,-1), 'RIGHT'),
+            ('ALIGN', (0,0), (0,-1), 'LEFT'),
+            ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0,0), (-1,0), 10),
+            ('BOTTOMPADDING', (0,0), (-1,0), 8),
+            ('BACKGROUND', (0,1), (-1,-1), colors.HexColor('#F5F5F5')),
+            ('GRID', (0,0), (-1,-1), 0.5, colors.lightgrey),
+            ('VALIGN', (0,0), (-1,-1), 'TOP')
+        ])
+
+        normal, right, heading = self.styles['Normal'], self.styles['RightAlign'], self.styles['Heading3']
+        self._title = Paragraph("INVOICE", self.styles['Title'])
+        self._bill_to = Paragraph("<b>Bill To:</b>", heading)
+        self._item_header = [
+            Paragraph('<b>Description</b>', normal),
+            Paragraph('<b>Qty</b>', normal),
+            Paragraph('<b>Unit Price</b>', normal),
+            Paragraph('<b>Amount</b>', normal)
+        ]
+        self._subtotal_label = Paragraph('<b>Subtotal:</b>', right)
+        self._total_label = Paragraph('<b>Total:</b>', heading)
+        self._notes_label = Paragraph("<b>Notes:</b>", heading)
+        self._terms_label = Paragraph("<b>Terms:</b>", heading)
+
+    @staticmethod
+    def _static(flowable):
+        return copy.copy(flowable)
+
+    def render(self, invoice, output_path: Optional[str] = None,
+               timings: Optional[dict] = None, fast_path: Optional[bool] = None) -> Union[BytesIO, str]:
+        """
+        Render an invoice to a BytesIO buffer, or to output_path if given.
+
+        fast_path forces (True) or disables (False) the LineItemGrid backend;
+        by default it is used once the item count reaches fast_path_min_items.
+
+        If a timings dict is passed it is filled with the seconds spent building
+        flowables ('flowables'), laying out and writing the document ('layout')
+        and in total ('total').
+        """
+        started = time.perf_counter()
+        styles = self.styles
+        currency = invoice.currency
         buffer = BytesIO() if output_path is None else None
-        
-        # Create document with margins
+
         doc = SimpleDocTemplate(
             buffer if buffer else output_path,
             pagesize=letter,
@@ -31,136 +251,232 @@ def generate_pdf(invoice, output_path: Optional[str] = None) -> Union[BytesIO, s
             topMargin=0.5*inch,
             bottomMargin=0.5*inch
         )
-        
-        styles = getSampleStyleSheet()
-        
-        # Add custom styles
-        styles.add(ParagraphStyle(
-            name='RightAlign',
-            parent=styles['Normal'],
-            alignment=2  # 0=left, 1=center, 2=right
-        ))
-        
+
         elements = []
-        
+
         # Header section
         header_table = Table([
             [
-                Paragraph("INVOICE", styles['Title']),
+                self._static(self._title),
                 Paragraph(f"<b>Invoice #:</b> {invoice.invoice_number}<br/>"
                          f"<b>Date:</b> {invoice.issue_date.strftime('%B %d, %Y')}<br/>"
                          f"<b>Due Date:</b> {invoice.due_date.strftime('%B %d, %Y')}",
                          styles['Normal'])
             ]
         ], colWidths=[4*inch, 2*inch])
-        
+
         elements.append(header_table)
         elements.append(Spacer(1, 0.25*inch))
-        
+
         # Customer Info
         customer_info = [
-            Paragraph("<b>Bill To:</b>", styles['Heading3']),
+            self._static(self._bill_to),
             Paragraph(invoice.customer.name, styles['Normal'])
         ]
-        
+
         if invoice.customer.address:
             address_lines = invoice.customer.address.split('\n')
             for line in address_lines:
                 customer_info.append(Paragraph(line, styles['Normal']))
-        
+
         if invoice.customer.email:
             customer_info.append(Paragraph(invoice.customer.email, styles['Normal']))
-        
+
         if invoice.customer.phone:
             customer_info.append(Paragraph(invoice.customer.phone, styles['Normal']))
-        
+
         elements.extend(customer_info)
         elements.append(Spacer(1, 0.5*inch))
-        
+
         # Line Items Table
-        data = [
-            [
-                Paragraph('<b>Description</b>', styles['Normal']),
-                Paragraph('<b>Qty</b>', styles['Normal']),
-                Paragraph('<b>Unit Price</b>', styles['Normal']),
-                Paragraph('<b>Amount</b>', styles['Normal'])
-            ]
-        ]
-        
-        for item in invoice.items:
-            data.append([
-                Paragraph(item.description, styles['Normal']),
-                Paragraph(str(item.quantity), styles['RightAlign']),
-                Paragraph(f"${item.unit_price:,.2f}", styles['RightAlign']),
-                Paragraph(f"${item.amount:,.2f}", styles['RightAlign'])
-            ])
-        
-        # Configure table
-        table = Table(
-            data,
-            colWidths=[3.5*inch, 0.75*inch, inch, inch],
-            hAlign='LEFT'
-        )
-        
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0,0), (-1,0), colors.HexColor('#404040')),
-            ('TEXTCOLOR', (0,0), (-1,0), colors.whitesmoke),
-            ('ALIGN', (0,0), (-1,-1), 'RIGHT'),
-            ('ALIGN', (0,0), (0,-1), 'LEFT'),
-            ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0,0), (-1,0), 10),
-            ('BOTTOMPADDING', (0,0), (-1,0), 8),
-            ('BACKGROUND', (0,1), (-1,-1), colors.HexColor('#F5F5F5')),
-            ('GRID', (0,0), (-1,-1), 0.5, colors.lightgrey),
-            ('VALIGN', (0,0), (-1,-1), 'TOP')
-        ]))
-        
+        if fast_path is None:
+            fast_path = len(invoice.items) >= self.fast_path_min_items
+
+        if fast_path:
+            table = LineItemGrid(invoice.items, currency=currency)
+        else:
+            data = [[self._static(cell) for cell in self._item_header]]
+
+            for item in invoice.items:
+                data.append([
+                    Paragraph(item.description, styles['Normal']),
+                    Paragraph(str(item.quantity), styles['RightAlign']),
+                    Paragraph(pdf_money(item.unit_price, currency), styles['RightAlign']),
+                    Paragraph(pdf_money(item.amount, currency), styles['RightAlign'])
+                ])
+
+            table = Table(data, colWidths=ITEM_COL_WIDTHS, hAlign='LEFT')
+            table.setStyle(self.items_table_style)
+
         elements.append(table)
         elements.append(Spacer(1, 0.25*inch))
-        
+
         # Totals Section
         totals_data = [
-            ['', '', Paragraph('<b>Subtotal:</b>', styles['RightAlign']), 
-             Paragraph(f"${invoice.subtotal:,.2f}", styles['RightAlign'])],
+            ['', '', self._static(self._subtotal_label),
+             Paragraph(pdf_money(invoice.subtotal, currency), styles['RightAlign'])],
         ]
-        
+
         if invoice.tax_rate > 0:
             totals_data.append([
                 '', '', Paragraph(f'<b>Tax ({invoice.tax_rate}%):</b>', styles['RightAlign']),
-                Paragraph(f"${invoice.tax_amount:,.2f}", styles['RightAlign'])
+                Paragraph(pdf_money(invoice.tax_amount, currency), styles['RightAlign'])
             ])
-        
+
         totals_data.append([
-            '', '', Paragraph('<b>Total:</b>', styles['Heading3']),
-            Paragraph(f"${invoice.total:,.2f}", styles['Heading3'])
+            '', '', self._static(self._total_label),
+            Paragraph(pdf_money(invoice.total, currency), styles['Heading3'])
         ])
-        
-        totals_table = Table(
-            totals_data,
-            colWidths=[3.5*inch, 0.75*inch, inch, inch]
-        )
-        
-        elements.append(totals_table)
+
+        elements.append(Table(totals_data, colWidths=ITEM_COL_WIDTHS))
         elements.append(Spacer(1, 0.5*inch))
-        
+
         # Terms and Notes
         if invoice.notes:
-            elements.append(Paragraph("<b>Notes:</b>", styles['Heading3']))
+            elements.append(self._static(self._notes_label))
             elements.append(Paragraph(invoice.notes, styles['Normal']))
             elements.append(Spacer(1, 0.25*inch))
-        
-        if invoice.terms:
-            elements.append(Paragraph("<b>Terms:</b>", styles['Heading3']))
-            elements.append(Paragraph(invoice.terms, styles['Normal']))
-        
-        # Build the document
+
+        terms = getattr(invoice, 'terms', None)
+        if terms:
+            elements.append(self._static(self._terms_label))
+            elements.append(Paragraph(terms, styles['Normal']))
+
+        built = time.perf_counter()
         doc.build(elements)
-        
+        finished = time.perf_counter()
+
+        if timings is not None:
+            timings['flowables'] = built - started
+            timings['layout'] = finished - built
+            timings['total'] = finished - started
+
         if buffer:
             buffer.seek(0)
             return buffer
         return output_path
-        
+
+
+    def render_statement(self, statement, output_path: Optional[str] = None,
+                         timings: Optional[dict] = None) -> Union[BytesIO, str]:
+        """
+        Render a customer statement (see app.statements.statement_snapshot).
+
+        The ledger is a StatementGrid, so statements of any length lay out in
+        linear time and repeat the column header on every page. timings is
+        filled like render().
+        """
+        started = time.perf_counter()
+        styles = self.styles
+        buffer = BytesIO() if output_path is None else None
+
+        doc = SimpleDocTemplate(
+            buffer if buffer else output_path,
+            pagesize=letter,
+            leftMargin=0.75*inch,
+            rightMargin=0.75*inch,
+            topMargin=0.5*inch,
+            bottomMargin=0.5*inch
+        )
+
+        customer = statement.customer
+        elements = [
+            Table([[
+                Paragraph("STATEMENT", styles['Title']),
+                Paragraph(f"<b>Date:</b> {statement.as_of.strftime('%B %d, %Y')}<br/>"
+                          f"<b>Open invoices:</b> {statement.invoice_count}<br/>"
+                          f"<b>Balance due:</b> {pdf_money(statement.balance_due, statement.currency)}",
+                          styles['Normal'])
+            ]], colWidths=[4*inch, 2.5*inch]),
+            Spacer(1, 0.25*inch),
+            self._static(self._bill_to),
+            Paragraph(customer.name, styles['Normal'])
+        ]
+        for line in (customer.address or '').split('\n'):
+            if line.strip():
+                elements.append(Paragraph(line, styles['Normal']))
+        for value in (customer.email, customer.phone):
+            if value:
+                elements.append(Paragraph(value, styles['Normal']))
+        elements.append(Spacer(1, 0.4*inch))
+
+        elements.append(StatementGrid(statement.rows))
+        elements.append(Spacer(1, 0.25*inch))
+        elements.append(Table([
+            ['', Paragraph('<b>Charges:</b>', styles['RightAlign']),
+             Paragraph(pdf_money(statement.total_charges, statement.currency), styles['RightAlign'])],
+            ['', Paragraph('<b>Payments:</b>', styles['RightAlign']),
+             Paragraph(pdf_money(statement.total_payments, statement.currency), styles['RightAlign'])],
+            ['', self._static(self._total_label),
+             Paragraph(pdf_money(statement.balance_due, statement.currency), styles['Heading3'])],
+        ], colWidths=[3.75*inch, 1.75*inch, inch]))
+
+        if statement.aging:
+            elements.append(Spacer(1, 0.25*inch))
+            amounts = [pdf_money(amount, statement.currency) for amount in statement.aging.values()]
+            aging = Table([list(statement.aging), amounts],
+                          colWidths=[6.75*inch / len(statement.aging)] * len(statement.aging))
+            aging.setStyle(self.items_table_style)
+            elements.append(aging)
+
+        built = time.perf_counter()
+        doc.build(elements)
+        finished = time.perf_counter()
+
+        if timings is not None:
+            timings['flowables'] = built - started
+            timings['layout'] = finished - built
+            timings['total'] = finished - started
+
+        if buffer:
+            buffer.seek(0)
+            return buffer
+        return output_path
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_renderer() -> PDFRenderer:
+    """Return the process-wide renderer, building it on first use"""
+    global _renderer
+    if _renderer is None:
+        with _renderer_lock:
+            if _renderer is None:
+                _renderer = PDFRenderer()
+    return _renderer
+
+
+def configure_renderer(fast_path_min_items):
+    """Apply app settings to the process-wide renderer (also used as a pool initializer)"""
+    get_renderer().fast_path_min_items = fast_path_min_items
+
+
+def generate_pdf(invoice, output_path: Optional[str] = None,
+                 timings: Optional[dict] = None) -> Union[BytesIO, str]:
+    """
+    Generate a PDF invoice from an invoice object.
+
+    Args:
+        invoice: The invoice object containing all necessary data
+        output_path: Optional path to save the PDF directly to a file
+        timings: Optional dict filled with a per-stage timing breakdown
+
+    Returns:
+        BytesIO buffer if no output_path provided, otherwise returns the file path
+    """
+    try:
+        return get_renderer().render(invoice, output_path, timings)
     except Exception as e:
         # Log the error in production
-        raise RuntimeError(f"Failed to generate PDF: {str(e)}")
\ No newline at end of file
+        raise RuntimeError(f"Failed to generate PDF: {str(e)}")
+
+
+def generate_statement_pdf(statement, output_path: Optional[str] = None,
+                           timings: Optional[dict] = None) -> Union[BytesIO, str]:
+    """Generate a customer statement PDF; arguments and return value as generate_pdf"""
+    try:
+        return get_renderer().render_statement(statement, output_path, timings)
+    except Exception as e:
+        raise RuntimeError(f"Failed to generate statement: {str(e)}")
@@ -0,0 +1,220 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+from app.metrics import metrics
+from app.pdf_cache import pdf_cache, invoice_fingerprint
+from app.pdf_generator import generate_pdf, configure_renderer
+
+logger = logging.getLogger(__name__)
+
+
+def invoice_snapshot(invoice):
+    """Copy the fields the PDF renderer needs into a picklable, detached object"""
+    customer = invoice.customer
+    return SimpleNamespace(
+        id=invoice.id,
+        invoice_number=invoice.invoice_number,
+        issue_date=invoice.issue_date,
+        due_date=invoice.due_date,
+        subtotal=invoice.subtotal,
+        tax_rate=invoice.tax_rate,
+        tax_amount=invoice.tax_amount,
+        total=invoice.total,
+        currency=invoice.currency,
+        notes=invoice.notes,
+        status=invoice.status,
+        customer=SimpleNamespace(
+            id=customer.id,
+            name=customer.name,
+            email=customer.email,
+            phone=customer.phone,
+            address=customer.address
+        ) if customer is not None else None,
+        items=[
+            SimpleNamespace(
+                id=item.id,
+                description=item.description,
+                quantity=item.quantity,
+                unit_price=item.unit_price,
+                amount=item.amount
+            ) for item in invoice.items
+        ]
+    )
+
+
+def render_pdf_bytes(snapshot):
+    """Worker entry point: render an invoice snapshot, return (pdf_bytes, timings)"""
+    timings = {}
+    buffer = generate_pdf(snapshot, timings=timings)
+    return buffer.getvalue(), timings
+
+
+class PDFJob:
+    """A queued PDF render and its outcome"""
+
+    def __init__(self, invoice_id, invoice_number, fingerprint, output_path=None):
+        self.id = uuid.uuid4().hex
+        self.invoice_id = invoice_id
+        self.invoice_number = invoice_number
+        self.fingerprint = fingerprint
+        self.output_path = output_path
+        self.created_at = datetime.utcnow()
+        self.finished_at = None
+        self.path = None
+        self.error = None
+        self.future = None
+        self._done = threading.Event()
+
+    @property
+    def status(self):
+        if self.error is not None:
+            return 'failed'
+        if self.path is not None:
+            return 'done'
+        if self.future is not None and self.future.running():
+            return 'running'
+        return 'queued'
+
+    def wait(self, timeout=None):
+        """Block until the render finishes and return the cached PDF path"""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"PDF job {self.id} did not finish in time")
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return self.path
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'invoice_id': self.invoice_id,
+            'invoice_number': self.invoice_number,
+            'status': self.status,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+class PDFJobQueue:
+    """
+    Local job queue that renders PDFs in a process pool.
+
+    Finished renders are stored in the PDF cache, so the result of a job is
+    served exactly like a cache hit. Identical pending renders are coalesced.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.max_workers = None
+        self.history = 1000
+        self.fast_path_min_items = 500
+        self._executor = None
+        self._jobs = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config['PDF_RENDER_MODE'] == 'background'
+        self.max_workers = app.config['PDF_WORKERS'] or None
+        self.history = app.config['PDF_JOB_HISTORY']
+        self.fast_path_min_items = app.config['PDF_FAST_PATH_MIN_ITEMS']
+        app.extensions['pdf_jobs'] = self
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Spawn rather than fork so workers never inherit DB connections
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=configure_renderer,
+                    initargs=(self.fast_path_min_items,)
+                )
+                atexit.register(self.shutdown)
+            return self._executor
+
+    def submit(self, invoice, output_path=None):
+        """Queue a render of an invoice and return its job"""
+        snapshot = invoice_snapshot(invoice)
+        fingerprint = invoice_fingerprint(snapshot)
+
+        with self._lock:
+            pending = self._pending.get((snapshot.id, fingerprint))
+            if pending is not None and output_path is None:
+                return pending
+
+        job = PDFJob(snapshot.id, snapshot.invoice_number, fingerprint, output_path)
+
+        cached = pdf_cache.get(snapshot.id, fingerprint)
+        if cached and output_path is None:
+            job.path = cached
+            job.finished_at = datetime.utcnow()
+            job.future = Future()
+            job.future.set_result(None)
+            job._done.set()
+            self._register(job, pending=False)
+            return job
+
+        self._register(job, pending=True)
+        job.future = self.executor.submit(render_pdf_bytes, snapshot)
+        job.future.add_done_callback(lambda future: self._finish(job, future))
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _register(self, job, pending):
+        with self._lock:
+            self._jobs[job.id] = job
+            if pending:
+                self._pending[(job.invoice_id, job.fingerprint)] = job
+            while len(self._jobs) > self.history:
+                old_id, old_job = next(iter(self._jobs.items()))
+                if old_job.status in ('queued', 'running'):
+                    break
+                del self._jobs[old_id]
+
+    def _finish(self, job, future):
+        try:
+            if future.cancelled():
+                # Pending renders are cancelled when the pool shuts down; result() would raise CancelledError
+                logger.warning(f"PDF job {job.id} for invoice {job.invoice_number} was cancelled")
+                job.error = 'The render was cancelled before it ran'
+                return
+            data, timings = future.result()
+            metrics.observe_pdf_render(timings, 'background')
+            logger.info(f"PDF job {job.id} rendered invoice {job.invoice_number} in {timings['total'] * 1000:.1f}ms")
+            path = pdf_cache.put(job.invoice_id, job.fingerprint, data)
+            if job.output_path:
+                os.makedirs(os.path.dirname(job.output_path), exist_ok=True)
+                with open(job.output_path, 'wb') as f:
+                    f.write(data)
+            job.path = path
+        except Exception as e:
+            logger.error(f"PDF job {job.id} for invoice {job.invoice_number} failed: {str(e)}")
+            job.error = str(e)
+        finally:
+            job.finished_at = datetime.utcnow()
+            with self._lock:
+                if self._pending.get((job.invoice_id, job.fingerprint)) is job:
+                    del self._pending[(job.invoice_id, job.fingerprint)]
+            job._done.set()
+
+
+pdf_jobs = PDFJobQueue()
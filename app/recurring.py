@@ -0,0 +1,168 @@
+import calendar
+import logging
+from datetime import date, timedelta
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+
+from app import db, services
+from app.models import Invoice, RecurringInvoice, RecurringInvoiceRun
+
+logger = logging.getLogger(__name__)
+
+# Months between invoices; weekly templates step by days instead
+INTERVALS = {'weekly': 0, 'monthly': 1, 'quarterly': 3, 'yearly': 12}
+
+
+def add_months(start, months):
+    """start moved by a number of months, clamped to the last day of shorter months"""
+    month = start.month - 1 + months
+    year = start.year + month // 12
+    month = month % 12 + 1
+    return date(year, month, min(start.day, calendar.monthrange(year, month)[1]))
+
+
+def next_period(template, period):
+    """
+    The issue date that follows period.
+
+    Months are counted from start_date, so a template starting on the 31st
+    bills on the 28th/29th/30th of short months and the 31st again after.
+    """
+    if template.interval == 'weekly':
+        return period + timedelta(days=7)
+    start = template.start_date
+    elapsed = (period.year - start.year) * 12 + period.month - start.month
+    return add_months(start, elapsed + INTERVALS[template.interval])
+
+
+def due_periods(template, run_date):
+    """Issue dates of template due on or before run_date, and the next issue date after them"""
+    periods = []
+    period = template.next_issue_date
+    while period <= run_date and (template.end_date is None or period <= template.end_date):
+        periods.append(period)
+        period = next_period(template, period)
+    return periods, period
+
+
+class GenerationResult:
+    """Outcome of one scheduler run"""
+
+    def __init__(self, run_date, dry_run=False):
+        self.run_date = run_date
+        self.dry_run = dry_run
+        self.templates = 0
+        self.invoices = 0
+        self.invoice_ids = []
+        self.jobs = []
+
+
+def generate_recurring_invoices(run_date=None, batch_size=500, queue_pdfs=False, dry_run=False):
+    """
+    Create every recurring invoice due on or before run_date.
+
+    Due templates are read batch_size at a time. Each batch is one
+    transaction: its invoices are created with services.add_invoices (bulk
+    numbering, totals and item inserts), a RecurringInvoiceRun row is written
+    per period and next_issue_date is advanced. Missed periods are caught up.
+    Rerunning for the same date finds nothing due, and the run table's
+    primary key rejects a batch that a concurrent run already generated.
+    """
+    run_date = run_date or date.today()
+    result = GenerationResult(run_date, dry_run)
+    last_id = 0
+    retried = False
+
+    while True:
+        templates = db.session.scalars(
+            select(RecurringInvoice)
+            .options(selectinload(RecurringInvoice.items))
+            .where(RecurringInvoice.active.is_(True),
+                   RecurringInvoice.next_issue_date <= run_date,
+                   RecurringInvoice.id > last_id)
+            .order_by(RecurringInvoice.id)
+            .limit(batch_size)
+        ).all()
+        if not templates:
+            break
+
+        specs, runs, advances = _batch_specs(templates, run_date)
+        if dry_run:
+            result.templates += len({run['recurring_id'] for run in runs})
+            result.invoices += len(specs)
+            last_id = templates[-1].id
+            continue
+
+        try:
+            invoices = services.add_invoices(specs) if specs else []
+            ids = [invoice.id for invoice in invoices]
+            if runs:
+                db.session.execute(insert(RecurringInvoiceRun), [
+                    dict(run, invoice_id=invoice_id) for run, invoice_id in zip(runs, ids)
+                ])
+            if advances:
+                db.session.execute(update(RecurringInvoice), advances)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if retried:
+                raise
+            # Another run generated some of these periods first; read the batch again
+            logger.warning(f"Recurring invoices {templates[0].id}-{templates[-1].id} were generated "
+                           f"concurrently, retrying the batch")
+            retried = True
+            continue
+        except Exception:
+            db.session.rollback()
+            raise
+
+        retried = False
+        last_id = templates[-1].id
+        result.templates += len({run['recurring_id'] for run in runs})
+        result.invoices += len(ids)
+        result.invoice_ids += ids
+        if queue_pdfs and ids:
+            result.jobs += _queue_pdfs(ids)
+
+    logger.info(f"Recurring invoices for {run_date}: {result.invoices} invoices from {result.templates} "
+                f"templates{' (dry run)' if dry_run else ''}")
+    return result
+
+
+def _batch_specs(templates, run_date):
+    """Invoice specs, run rows and next_issue_date updates for a batch of templates"""
+    specs, runs, advances = [], [], []
+    for template in templates:
+        periods, next_date = due_periods(template, run_date)
+        if periods and not template.items:
+            logger.warning(f"Recurring invoice {template.id} has no items, skipping")
+            continue
+        items = [{'description': item.description, 'quantity': item.quantity, 'unit_price': item.unit_price}
+                 for item in template.items]
+        for period in periods:
+            specs.append({
+                'customer_id': template.customer_id,
+                'issue_date': period,
+                'due_date': period + timedelta(days=template.due_days),
+                'tax_rate': template.tax_rate or 0,
+                'notes': template.notes,
+                'items': items
+            })
+            runs.append({'recurring_id': template.id, 'period': period})
+        finished = template.end_date is not None and next_date > template.end_date
+        advances.append({'id': template.id, 'next_issue_date': next_date, 'active': not finished})
+    return specs, runs, advances
+
+
+def _queue_pdfs(invoice_ids, chunk_size=500):
+    """Hand freshly generated invoices to the PDF job queue, loading them a chunk at a time"""
+    from app.pdf_jobs import pdf_jobs
+
+    jobs = []
+    for start in range(0, len(invoice_ids), chunk_size):
+        chunk = Invoice.query.options(joinedload(Invoice.customer), selectinload(Invoice.items)) \
+            .filter(Invoice.id.in_(invoice_ids[start:start + chunk_size])).all()
+        jobs += [pdf_jobs.submit(invoice) for invoice in chunk]
+    return jobs
@@ -1,14 +1,23 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, send_file
+from flask import Blueprint, Response, abort, current_app, render_template, redirect, url_for, flash, request, send_file, stream_with_context
 from app import db
-from app.models import Customer, Invoice, InvoiceItem
-from app.forms import CustomerForm, InvoiceForm
-from app.utils import generate_invoice_number, calculate_totals
-from app.pdf_generator import generate_pdf
+from app.models import Customer, Invoice, Payment
+from app import money, services
+from app.database import replica_reads
+from app.forms import CustomerForm, InvoiceForm, validate_item_rows
+from app.utils import parse_invoice_filters, apply_invoice_filters
+from app.pagination import paginate_keyset
+from app.summaries import aging_report, dashboard_stats
+from app.currency import ExchangeRateError, exchange_rates
+from app.pdf_cache import pdf_cache, invoice_fingerprint
+from app.pdf_jobs import pdf_jobs
+from app.page_cache import page_cache
+from app.search import search_index
+from markupsafe import Markup
 from datetime import datetime, timedelta
-import os
 import logging
-from io import BytesIO
-from sqlalchemy.orm import joinedload
+import csv
+import io
+from sqlalchemy.orm import joinedload, selectinload
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -19,15 +28,103 @@ main_routes = Blueprint('main', __name__)
 customer_routes = Blueprint('customers', __name__, url_prefix='/customers')
 invoice_routes = Blueprint('invoices', __name__, url_prefix='/invoices')
 
-# PDF Configuration
-PDF_DIR = os.path.join(os.path.dirname(__file__), '..', 'static', 'pdfs')
-os.makedirs(PDF_DIR, exist_ok=True)
-
-def get_customer_choices():
-    """Get customer choices for dropdown with formatted display"""
+# Sortable columns for the list views (must be non-nullable for keyset pagination)
+INVOICE_SORTS = {
+    'issue_date': Invoice.issue_date,
+    'due_date': Invoice.due_date,
+    'total': Invoice.total,
+    'invoice_number': Invoice.invoice_number
+}
+CUSTOMER_SORTS = {
+    'name': Customer.name,
+    'created_at': Customer.id  # date added: ids follow creation order, and created_at is nullable
+}
+
+def wants_json():
+    return request.args.get('format') == 'json'
+
+def get_page_args(sorts, default_sort, default_order):
+    """Read sort, order, cursor and per_page from the query string"""
+    sort = request.args.get('sort', default_sort)
+    if sort not in sorts:
+        raise ValueError(f"Unknown sort field: {sort}")
+    order = request.args.get('order', default_order)
+    if order not in ('asc', 'desc'):
+        raise ValueError(f"Unknown sort order: {order}")
+    return sorts[sort], order == 'desc', request.args.get('cursor'), get_per_page()
+
+def get_per_page():
+    per_page = request.args.get('per_page', type=int) or current_app.config['PAGE_SIZE']
+    return max(1, min(per_page, current_app.config['MAX_PAGE_SIZE']))
+
+def get_report_currency():
+    """?currency=XXX of a report, or None for REPORTING_CURRENCY"""
+    currency = request.args.get('currency', '').strip().upper()
+    if currency and currency not in exchange_rates.currencies:
+        raise ExchangeRateError(f"No exchange rate for {currency}")
+    return currency or None
+
+def next_page_url(endpoint, page):
+    if not page.has_next:
+        return None
+    args = request.args.to_dict()
+    args['cursor'] = page.next_cursor
+    return url_for(endpoint, **args)
+
+def get_item_rows():
+    """
+    Read the repeated item inputs of the invoice forms into checked item dicts.
+
+    Returns (items, errors) like forms.validate_item_rows, with errors keyed
+    by the row's position on the page. Rows without a description are the
+    form's blank rows and skipped.
+    """
+    descriptions = request.form.getlist('description')
+    quantities = request.form.getlist('quantity')
+    prices = request.form.getlist('unit_price')
+    item_ids = request.form.getlist('item_id')
+    item_ids += [''] * (len(descriptions) - len(item_ids))
+
+    rows, positions = [], []
+    for position, (item_id, desc, qty, price) in enumerate(zip(item_ids, descriptions, quantities, prices), 1):
+        if desc:
+            rows.append({
+                'id': int(item_id) if item_id.isdigit() else item_id or None,
+                'description': desc,
+                'quantity': qty,
+                'unit_price': price
+            })
+            positions.append(position)
+    items, errors = validate_item_rows(rows)
+    return items, {(f"Item {positions[int(key[6:-1])]}" if key.startswith('items[') else key): problems
+                   for key, problems in errors.items()}
+
+def flash_item_errors(errors):
+    for row, problems in errors.items():
+        if isinstance(problems, str):
+            flash(problems, 'danger')
+            continue
+        for field, message in problems.items():
+            flash(f"{row} {field.replace('_', ' ')}: {message}", 'danger')
+
+def customer_label(customer):
+    return f"{customer.name} ({customer.email})" if customer.email else customer.name
+
+def like_prefix(value):
+    """LIKE pattern matching values that start with value, with wildcards escaped"""
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"{escaped}%"
+
+def get_customer_choices(selected_id=None):
+    """
+    Choices for the customer dropdown.
+
+    Only the currently selected customer is loaded; the rest of the list is
+    filled in by the type-ahead search in the browser.
+    """
     try:
-        customers = Customer.query.order_by(Customer.name).all()
-        return [(c.id, f"{c.name} ({c.email})" if c.email else c.name) for c in customers]
+        customer = db.session.get(Customer, selected_id) if selected_id else None
+        return [(customer.id, customer_label(customer))] if customer else []
     except Exception as e:
         logger.error(f"Error fetching customers: {str(e)}")
         flash('Error loading customer list', 'danger')
@@ -39,20 +136,95 @@ def index():
     return render_template('index.html')
 
 @main_routes.route('/dashboard')
+@replica_reads
 def dashboard():
     try:
-        total_customers = Customer.query.count()
-        total_invoices = Invoice.query.count()
-        recent_invoices = Invoice.query.order_by(Invoice.issue_date.desc()).limit(5).all()
-        return render_template('dashboard.html', 
-                            total_customers=total_customers,
-                            total_invoices=total_invoices, 
-                            recent_invoices=recent_invoices)
+        stats = dashboard_stats(currency=get_report_currency())
+        recent_invoices = Invoice.query.options(joinedload(Invoice.customer)) \
+            .order_by(Invoice.issue_date.desc(), Invoice.id.desc()).limit(5).all()
+        return render_template('dashboard.html', stats=stats, recent_invoices=recent_invoices)
+    except ExchangeRateError as e:
+        flash(f'Cannot show the dashboard in this currency: {str(e)}', 'danger')
+        return redirect(url_for('main.index'))
     except Exception as e:
         logger.error(f"Dashboard error: {str(e)}")
         flash('Error loading dashboard', 'danger')
         return redirect(url_for('main.index'))
 
+@main_routes.route('/reports/aging')
+@replica_reads
+def aging():
+    """Unpaid amounts per customer by days past due; ?as_of=YYYY-MM-DD, ?currency=EUR, ?format=json"""
+    try:
+        as_of = datetime.strptime(request.args['as_of'], '%Y-%m-%d').date() if request.args.get('as_of') else None
+        report = aging_report(as_of, request.args.get('customer_id', type=int), get_report_currency())
+    except ExchangeRateError as e:
+        if wants_json():
+            return {'error': str(e)}, 400
+        # Not back to this page: without the rate it would fail again
+        flash(f'Cannot show the aging report in this currency: {str(e)}', 'danger')
+        return redirect(url_for('main.index'))
+    except ValueError:
+        if wants_json():
+            return {'error': 'as_of must be a date (YYYY-MM-DD)'}, 400
+        flash('As of must be a date (YYYY-MM-DD)', 'danger')
+        return redirect(url_for('main.aging'))
+
+    if wants_json():
+        return {
+            'as_of': report['as_of'].isoformat(),
+            'currency': report['currency'],
+            'buckets': report['buckets'],
+            'customers': [dict(row, outstanding=str(row['outstanding']),
+                               buckets={k: str(v) for k, v in row['buckets'].items()})
+                          for row in report['customers']],
+            'totals': dict(report['totals'], outstanding=str(report['totals']['outstanding']),
+                           buckets={k: str(v) for k, v in report['totals']['buckets'].items()})
+        }
+    return render_template('aging.html', report=report)
+
+@main_routes.route('/reports/aging/mark-overdue', methods=['POST'])
+def mark_overdue():
+    try:
+        marked = services.mark_overdue()
+        flash(f"Marked {marked} invoices as overdue", 'success')
+    except Exception as e:
+        logger.error(f"Error marking invoices overdue: {str(e)}")
+        flash('Error marking invoices overdue', 'danger')
+    return redirect(url_for('main.aging'))
+
+@main_routes.route('/import', methods=['GET', 'POST'])
+def import_data():
+    """Upload a customers or invoices CSV; ?format=json returns the full report"""
+    if request.method == 'GET':
+        return render_template('import.html', result=None)
+
+    from app.importer import IMPORT_KINDS, import_csv
+
+    kind = request.form.get('kind', 'customers')
+    upload = request.files.get('file')
+    if kind not in IMPORT_KINDS or upload is None or not upload.filename:
+        if wants_json():
+            return {'error': 'Choose a CSV file and what it contains'}, 400
+        flash('Choose a CSV file and what it contains', 'danger')
+        return redirect(url_for('main.import_data'))
+
+    try:
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        result = import_csv(kind, stream, dry_run=bool(request.form.get('dry_run')))
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        if wants_json():
+            return {'error': str(e)}, 400
+        flash(f"Could not import the file: {str(e)}", 'danger')
+        return redirect(url_for('main.import_data'))
+
+    if wants_json():
+        return result.to_dict()
+    flash(f"{'Checked' if result.dry_run else 'Imported'} {result.rows} rows: {result.created} {kind} "
+          f"{'valid' if result.dry_run else 'created'}, {len(result.skipped)} skipped, "
+          f"{len(result.errors)} errors", 'warning' if result.errors else 'success')
+    return render_template('import.html', result=result.to_dict(max_problems=500))
+
 # Customer Routes
 @customer_routes.route('/', methods=['GET', 'POST'])
 def list_customers():
@@ -63,7 +235,8 @@ def list_customers():
                 name=form.name.data,
                 email=form.email.data,
                 phone=form.phone.data,
-                address=form.address.data
+                address=form.address.data,
+                currency=form.currency.data
             )
             db.session.add(customer)
             db.session.commit()
@@ -73,8 +246,50 @@ def list_customers():
             logger.error(f"Error creating customer: {str(e)}")
             flash('Error creating customer', 'danger')
 
-    customers = Customer.query.order_by(Customer.name).all()
-    return render_template('customers/list.html', customers=customers, form=form)
+    try:
+        sort_column, descending, cursor, per_page = get_page_args(CUSTOMER_SORTS, 'name', 'asc')
+        query = Customer.query
+        if request.args.get('q'):
+            query = query.filter(Customer.name.like(like_prefix(request.args['q']), escape='\\'))
+        page = paginate_keyset(query, sort_column, Customer.id, descending, cursor, per_page)
+    except ValueError as e:
+        if wants_json():
+            return {'error': str(e)}, 400
+        flash(f'Invalid list parameters: {str(e)}', 'danger')
+        return redirect(url_for('customers.list_customers'))
+
+    next_url = next_page_url('customers.list_customers', page)
+    if wants_json():
+        return {
+            'customers': [c.to_dict() for c in page.items],
+            'next_cursor': page.next_cursor,
+            'next_url': next_url
+        }
+    return render_template('customers/list.html', customers=page.items, form=form, next_url=next_url)
+
+@customer_routes.route('/search')
+@replica_reads
+def search_customers():
+    """Type-ahead search: customers whose name, email or phone starts with q"""
+    q = request.args.get('q', '').strip()
+    try:
+        _, _, cursor, per_page = get_page_args(CUSTOMER_SORTS, 'name', 'asc')
+        query = Customer.query
+        if q:
+            pattern = like_prefix(q)
+            query = query.filter(db.or_(
+                Customer.name.like(pattern, escape='\\'),
+                Customer.email.like(pattern, escape='\\'),
+                Customer.phone.like(pattern, escape='\\')
+            ))
+        page = paginate_keyset(query, Customer.name, Customer.id, False, cursor, min(per_page, 50))
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    return {
+        'results': [dict(c.to_dict(), text=customer_label(c)) for c in page.items],
+        'next_cursor': page.next_cursor
+    }
 
 @customer_routes.route('/<int:id>/edit', methods=['GET', 'POST'])
 def edit_customer(id):
@@ -83,8 +298,14 @@ def edit_customer(id):
     
     if form.validate_on_submit():
         try:
-            form.populate_obj(customer)
-            db.session.commit()
+            services.update_customer(
+                customer,
+                name=form.name.data,
+                email=form.email.data,
+                phone=form.phone.data,
+                address=form.address.data,
+                currency=form.currency.data
+            )
             flash('Customer updated successfully!', 'success')
             return redirect(url_for('customers.list_customers'))
         except Exception as e:
@@ -105,23 +326,107 @@ def delete_customer(id):
         flash('Error deleting customer', 'danger')
     return redirect(url_for('customers.list_customers'))
 
+def statement_as_of():
+    value = request.args.get('as_of')
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+
+@customer_routes.route('/<int:id>/statement')
+def customer_statement(id):
+    """PDF statement of a customer's open invoices and payments; ?as_of=YYYY-MM-DD"""
+    from app.metrics import metrics
+    from app.pdf_generator import generate_statement_pdf
+    from app.statements import customer_statement as build_statement
+
+    customer = Customer.query.get_or_404(id)
+    try:
+        statement = build_statement(customer, statement_as_of())
+        timings = {}
+        buffer = generate_statement_pdf(statement, timings=timings)
+        metrics.observe_pdf_render(timings, 'statement')
+    except ValueError:
+        flash('As of must be a date (YYYY-MM-DD)', 'danger')
+        return redirect(url_for('customers.list_customers'))
+    except Exception as e:
+        logger.error(f"Error generating statement for customer {id}: {str(e)}", exc_info=True)
+        flash('Error generating statement', 'danger')
+        return redirect(url_for('customers.list_customers'))
+    return send_file(
+        buffer,
+        as_attachment=True,
+        download_name=f"statement_{customer.id}_{statement.as_of.isoformat()}.pdf",
+        mimetype='application/pdf'
+    )
+
+@customer_routes.route('/statements')
+def export_statements():
+    """ZIP of the statements of every customer that owes money, streamed as they render"""
+    from app.statements import stream_statement_zip
+
+    try:
+        as_of = statement_as_of()
+    except ValueError:
+        return {'error': 'as_of must be a date (YYYY-MM-DD)'}, 400
+    return Response(
+        stream_with_context(stream_statement_zip(as_of=as_of)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=statements.zip'}
+    )
+
 # Invoice Routes
 @invoice_routes.route('/')
+@replica_reads
 def list_invoices():
     try:
-        invoices = Invoice.query.options(
-            joinedload(Invoice.customer)
-        ).order_by(Invoice.issue_date.desc()).all()
-        return render_template('invoices/list.html', invoices=invoices)
+        try:
+            filters = parse_invoice_filters(request.args)
+            sort_column, descending, cursor, per_page = get_page_args(INVOICE_SORTS, 'issue_date', 'desc')
+            query = apply_invoice_filters(Invoice.query.options(joinedload(Invoice.customer)), filters)
+            page = paginate_keyset(query, sort_column, Invoice.id, descending, cursor, per_page)
+        except ValueError as e:
+            if wants_json():
+                return {'error': str(e)}, 400
+            flash(f'Invalid list parameters: {str(e)}', 'danger')
+            return redirect(url_for('invoices.list_invoices'))
+
+        next_url = next_page_url('invoices.list_invoices', page)
+        if wants_json():
+            return {
+                'invoices': [invoice.to_dict() for invoice in page.items],
+                'next_cursor': page.next_cursor,
+                'next_url': next_url
+            }
+        return render_template('invoices/list.html', invoices=page.items, next_url=next_url,
+                               args=request.args, sorts=INVOICE_SORTS)
     except Exception as e:
         logger.error(f"Error listing invoices: {str(e)}")
         flash('Error loading invoices', 'danger')
         return redirect(url_for('main.index'))
 
+@invoice_routes.route('/search')
+def search_invoices():
+    """Invoices whose number, notes, items or customer match q, best match first"""
+    q = request.args.get('q', '').strip()
+    try:
+        page = search_index.search(q, request.args.get('cursor'), get_per_page())
+    except ValueError as e:
+        if wants_json():
+            return {'error': str(e)}, 400
+        flash(f'Invalid search parameters: {str(e)}', 'danger')
+        return redirect(url_for('invoices.search_invoices', q=q))
+
+    next_url = next_page_url('invoices.search_invoices', page)
+    if wants_json():
+        return {
+            'results': [dict(hit.invoice.to_dict(), score=hit.score) for hit in page.items],
+            'next_cursor': page.next_cursor,
+            'next_url': next_url
+        }
+    return render_template('invoices/search.html', hits=page.items, q=q, next_url=next_url)
+
 @invoice_routes.route('/create', methods=['GET', 'POST'])
 def create_invoice():
     form = InvoiceForm()
-    form.customer_id.choices = [(0, "-- Select Customer --")] + get_customer_choices()
+    form.customer_id.choices = [(0, "-- Select Customer --")] + get_customer_choices(form.customer_id.data)
     
     if request.method == 'GET':
         form.issue_date.data = datetime.today()
@@ -132,52 +437,22 @@ def create_invoice():
             if form.customer_id.data == 0:
                 flash('Please select a customer', 'danger')
                 return render_template('invoices/create.html', form=form)
-            
-            descriptions = request.form.getlist('description')
-            quantities = request.form.getlist('quantity')
-            prices = request.form.getlist('unit_price')
-
-            items = []
-            for desc, qty, price in zip(descriptions, quantities, prices):
-                if desc:
-                    items.append({
-                        'description': desc,
-                        'quantity': float(qty),
-                        'unit_price': float(price)
-                    })
-
-            if not items:
-                flash('At least one invoice item is required', 'danger')
-                return render_template('invoices/create.html', form=form)
 
-            totals = calculate_totals(items, float(form.tax_rate.data))
+            items, item_errors = get_item_rows()
+            if item_errors:
+                flash_item_errors(item_errors)
+                return render_template('invoices/create.html', form=form)
 
-            invoice = Invoice(
-                invoice_number=generate_invoice_number(),
+            invoice = services.create_invoice(
+                items,
                 customer_id=form.customer_id.data,
                 issue_date=form.issue_date.data,
                 due_date=form.due_date.data,
-                subtotal=totals['subtotal'],
                 tax_rate=form.tax_rate.data,
-                tax_amount=totals['tax_amount'],
-                total=totals['total'],
+                currency=form.currency.data or None,
                 notes=form.notes.data,
                 status='DRAFT'
             )
-            
-            db.session.add(invoice)
-            db.session.commit()
-
-            for item in items:
-                db.session.add(InvoiceItem(
-                    invoice_id=invoice.id,
-                    description=item['description'],
-                    quantity=item['quantity'],
-                    unit_price=item['unit_price'],
-                    amount=item['quantity'] * item['unit_price']
-                ))
-
-            db.session.commit()
             flash('Invoice created successfully!', 'success')
             return redirect(url_for('invoices.view_invoice', id=invoice.id))
             
@@ -190,29 +465,48 @@ def create_invoice():
 
 @invoice_routes.route('/<int:id>')
 def view_invoice(id):
+    version = page_cache.invoice_version(id)
+    if version is None:
+        abort(404)  # outside the try below, which turns errors into a flash and redirect
+
     try:
-        invoice = db.session.query(Invoice).\
-            options(
-                joinedload(Invoice.customer),
-                joinedload(Invoice.items)
-            ).\
-            filter(Invoice.id == id).\
-            one()
-        
-        logger.info(f"Invoice loaded - ID: {invoice.id}, Customer: {invoice.customer.name if invoice.customer else 'None'}, Items: {len(invoice.items)}")
-        
-        # Add debug output
-        print(f"Invoice Status: {invoice.status}")  # Check status case sensitivity
-        print(f"Customer Exists: {invoice.customer is not None}")
-        print(f"Items Count: {len(invoice.items)}")
-        
-        return render_template('invoices/view.html', invoice=invoice)
+        def render():
+            invoice = db.session.query(Invoice).\
+                options(
+                    joinedload(Invoice.customer),
+                    joinedload(Invoice.items),
+                    selectinload(Invoice.payments)
+                ).\
+                filter(Invoice.id == id).\
+                one()
+            logger.debug(f"Invoice loaded - ID: {invoice.id}, Status: {invoice.status}, "
+                         f"Customer: {invoice.customer.name if invoice.customer else 'None'}, Items: {len(invoice.items)}")
+            return render_template('invoices/_view.html', invoice=invoice)
+
+        return page_cache.serve(
+            f"invoice_{id}", 'view', page_cache.key('view', id, version, daily=True), page_cache.last_modified(version),
+            render, lambda body: render_template('invoices/view.html', invoice_number=version.invoice_number,
+                                                 body=Markup(body))
+        )
     
     except Exception as e:
         logger.error(f"Error viewing invoice {id}: {str(e)}", exc_info=True)
         flash('Error loading invoice', 'danger')
         return redirect(url_for('invoices.list_invoices'))
 
+def conflict_payload(conflict):
+    diff = conflict.diff
+    return {
+        'error': str(conflict),
+        'version': conflict.invoice.version,
+        'fields': [{'field': change['field'], 'yours': str(change['yours'] or ''), 'saved': str(change['saved'] or '')}
+                   for change in diff['fields']],
+        'items_only_yours': [{'description': d, 'quantity': str(q), 'unit_price': str(p)}
+                             for d, q, p in diff['items_only_yours']],
+        'items_only_saved': [{'description': d, 'quantity': str(q), 'unit_price': str(p)}
+                             for d, q, p in diff['items_only_saved']]
+    }
+
 @invoice_routes.route('/<int:id>/edit', methods=['GET', 'POST'])
 def edit_invoice(id):
     invoice = Invoice.query.options(
@@ -221,48 +515,41 @@ def edit_invoice(id):
     ).get_or_404(id)
     
     form = InvoiceForm(obj=invoice)
-    form.customer_id.choices = get_customer_choices()
+    form.customer_id.choices = get_customer_choices(form.customer_id.data)
     
     if form.validate_on_submit():
         try:
-            form.populate_obj(invoice)
-            InvoiceItem.query.filter_by(invoice_id=invoice.id).delete()
-
-            descriptions = request.form.getlist('description')
-            quantities = request.form.getlist('quantity')
-            prices = request.form.getlist('unit_price')
-
-            items = []
-            for desc, qty, price in zip(descriptions, quantities, prices):
-                if desc:
-                    items.append({
-                        'description': desc,
-                        'quantity': float(qty),
-                        'unit_price': float(price)
-                    })
-
-            if not items:
-                flash('At least one invoice item is required', 'danger')
+            items, item_errors = get_item_rows()
+            if item_errors:
+                flash_item_errors(item_errors)
                 return render_template('invoices/edit.html', form=form, invoice=invoice)
 
-            totals = calculate_totals(items, float(form.tax_rate.data))
-            invoice.subtotal = totals['subtotal']
-            invoice.tax_amount = totals['tax_amount']
-            invoice.total = totals['total']
-
-            for item in items:
-                db.session.add(InvoiceItem(
-                    invoice_id=invoice.id,
-                    description=item['description'],
-                    quantity=item['quantity'],
-                    unit_price=item['unit_price'],
-                    amount=item['quantity'] * item['unit_price']
-                ))
-
-            db.session.commit()
+            services.update_invoice(
+                invoice,
+                items,
+                expected_version=form.version.data,
+                customer_id=form.customer_id.data,
+                issue_date=form.issue_date.data,
+                due_date=form.due_date.data,
+                tax_rate=form.tax_rate.data,
+                currency=form.currency.data or invoice.currency,
+                notes=form.notes.data
+            )
             flash('Invoice updated successfully!', 'success')
             return redirect(url_for('invoices.view_invoice', id=invoice.id))
-            
+
+        except services.InvoiceConflict as conflict:
+            logger.info(f"Edit conflict on invoice {invoice.invoice_number}: saved version is {invoice.version}, "
+                        f"editor had {form.version.data}")
+            if wants_json():
+                return conflict_payload(conflict), 409
+            # Start again from the saved invoice; the diff shows what this edit would have changed
+            form = InvoiceForm(formdata=None, obj=invoice)
+            form.customer_id.choices = get_customer_choices(invoice.customer_id)
+            return render_template('invoices/edit.html', form=form, invoice=invoice, conflict=conflict.diff), 409
+        except ValueError as e:
+            db.session.rollback()
+            flash(f"Could not update the invoice: {str(e)}", 'danger')
         except Exception as e:
             logger.error(f"Error updating invoice: {str(e)}")
             flash('Error updating invoice', 'danger')
@@ -274,8 +561,7 @@ def edit_invoice(id):
 def delete_invoice(id):
     try:
         invoice = Invoice.query.get_or_404(id)
-        db.session.delete(invoice)
-        db.session.commit()
+        services.delete_invoice(invoice)
         flash('Invoice deleted successfully!', 'success')
     except Exception as e:
         logger.error(f"Error deleting invoice: {str(e)}")
@@ -286,15 +572,46 @@ def delete_invoice(id):
 def mark_as_paid(id):
     try:
         invoice = Invoice.query.get_or_404(id)
-        invoice.status = 'PAID'
-        invoice.payment_date = datetime.today()
-        db.session.commit()
+        services.mark_paid(invoice)
         flash('Invoice marked as paid!', 'success')
     except Exception as e:
         logger.error(f"Error marking invoice as paid: {str(e)}")
         flash('Error updating invoice status', 'danger')
     return redirect(url_for('invoices.view_invoice', id=id))
 
+@invoice_routes.route('/<int:id>/payments', methods=['POST'])
+def record_payment(id):
+    invoice = Invoice.query.get_or_404(id)
+    try:
+        paid_on = datetime.strptime(request.form['paid_on'], '%Y-%m-%d').date() \
+            if request.form.get('paid_on') else None
+        services.record_payments([{
+            'invoice_id': invoice.id,
+            'amount': money.to_decimal(request.form.get('amount')),
+            'paid_on': paid_on,
+            'method': 'manual',
+            'reference': (request.form.get('reference') or '').strip()[:100] or None
+        }])
+        flash('Payment recorded', 'success')
+    except ValueError as e:
+        flash(f"Could not record the payment: {str(e)}", 'danger')
+    except Exception as e:
+        logger.error(f"Error recording payment for invoice {id}: {str(e)}")
+        flash('Error recording payment', 'danger')
+    return redirect(url_for('invoices.view_invoice', id=id))
+
+@invoice_routes.route('/payments/<int:payment_id>/delete', methods=['POST'])
+def delete_payment(payment_id):
+    payment = Payment.query.get_or_404(payment_id)
+    invoice_id = payment.invoice_id
+    try:
+        services.delete_payment(payment)
+        flash('Payment removed', 'success')
+    except Exception as e:
+        logger.error(f"Error removing payment {payment_id}: {str(e)}")
+        flash('Error removing payment', 'danger')
+    return redirect(url_for('invoices.view_invoice', id=invoice_id))
+
 @invoice_routes.route('/<int:id>/pdf')
 def download_pdf(id):
     try:
@@ -303,21 +620,31 @@ def download_pdf(id):
             joinedload(Invoice.items)
         ).get_or_404(id)
         
-        pdf_buffer = generate_pdf(invoice)
-        
-        # Save to disk for future reference
-        pdf_filename = f"invoice_{invoice.invoice_number}.pdf"
-        pdf_path = os.path.join(PDF_DIR, pdf_filename)
-        
-        with open(pdf_path, 'wb') as f:
-            f.write(pdf_buffer.getbuffer())
-        
-        # Return for download
+        fingerprint = invoice_fingerprint(invoice)
+        if request.if_none_match.contains(fingerprint):
+            response = Response(status=304)
+            response.set_etag(fingerprint)
+            return response
+
+        if pdf_jobs.enabled:
+            pdf_path = pdf_cache.get(invoice.id, fingerprint)
+            if pdf_path is None:
+                job = pdf_jobs.submit(invoice)
+                if request.accept_mimetypes.best == 'application/json':
+                    return _job_response(job, 202)
+                flash('Your PDF is being generated. Please try the download again in a moment.', 'info')
+                return redirect(url_for('invoices.view_invoice', id=id))
+        else:
+            pdf_path = pdf_cache.fetch(invoice, fingerprint)
+
         return send_file(
-            pdf_buffer,
+            pdf_path,
             as_attachment=True,
-            download_name=pdf_filename,
-            mimetype='application/pdf'
+            download_name=f"invoice_{invoice.invoice_number}.pdf",
+            mimetype='application/pdf',
+            etag=fingerprint,
+            conditional=True,
+            max_age=0
         )
         
     except Exception as e:
@@ -325,14 +652,114 @@ def download_pdf(id):
         flash('Error generating PDF. Please try again.', 'danger')
         return redirect(url_for('invoices.view_invoice', id=id))
 
-@invoice_routes.route('/<int:id>/print')
-def print_invoice(id):
+def _job_response(job, status=200):
+    body = job.to_dict()
+    body['status_url'] = url_for('invoices.pdf_job_status', job_id=job.id)
+    body['result_url'] = url_for('invoices.pdf_job_result', job_id=job.id)
+    return body, status, {'Location': body['status_url'], 'Retry-After': '1'}
+
+@invoice_routes.route('/<int:id>/pdf/jobs', methods=['POST'])
+def submit_pdf_job(id):
     try:
         invoice = Invoice.query.options(
             joinedload(Invoice.customer),
             joinedload(Invoice.items)
         ).get_or_404(id)
-        return render_template('invoices/print.html', invoice=invoice)
+        return _job_response(pdf_jobs.submit(invoice), 202)
+    except Exception as e:
+        logger.error(f"Error queueing PDF for invoice {id}: {str(e)}", exc_info=True)
+        return {'error': str(e)}, 500
+
+@invoice_routes.route('/pdf-jobs/<job_id>')
+def pdf_job_status(job_id):
+    job = pdf_jobs.get(job_id)
+    if job is None:
+        return {'error': 'Unknown job'}, 404
+    return _job_response(job)
+
+@invoice_routes.route('/pdf-jobs/<job_id>/result')
+def pdf_job_result(job_id):
+    job = pdf_jobs.get(job_id)
+    if job is None:
+        return {'error': 'Unknown job'}, 404
+    if job.status == 'failed':
+        return {'error': job.error}, 500
+    if job.status != 'done':
+        return _job_response(job, 202)
+    return send_file(
+        job.path,
+        as_attachment=True,
+        download_name=f"invoice_{job.invoice_number}.pdf",
+        mimetype='application/pdf',
+        etag=job.fingerprint,
+        conditional=True,
+        max_age=0
+    )
+
+@invoice_routes.route('/export/pdf')
+def export_pdfs():
+    try:
+        filters = parse_invoice_filters(request.args)
+    except ValueError as e:
+        return {'error': f"Invalid filter: {str(e)}"}, 400
+
+    from app.pdf_export import stream_invoice_zip
+    return Response(
+        stream_with_context(stream_invoice_zip(filters)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=invoices.zip'}
+    )
+
+@invoice_routes.route('/export/<kind>')
+def export_data(kind):
+    """Stream invoices, items or customers as ?format=csv (default) or xlsx; ?currency= for reporting totals"""
+    from app.data_export import EXPORT_COLUMNS, EXPORT_FORMATS, stream_export
+
+    export_format = request.args.get('format', 'csv')
+    if kind not in EXPORT_COLUMNS or export_format not in EXPORT_FORMATS:
+        return {'error': 'Unknown export'}, 404
+    try:
+        filters = parse_invoice_filters(request.args)
+    except ValueError as e:
+        return {'error': f"Invalid filter: {str(e)}"}, 400
+
+    try:
+        stream = stream_export(kind, export_format, filters, current_app.config['EXPORT_CHUNK_SIZE'],
+                               get_report_currency())
+    except ExchangeRateError as e:
+        return {'error': str(e)}, 400
+
+    mimetypes = {
+        'csv': 'text/csv; charset=utf-8',
+        'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    }
+    return Response(
+        stream_with_context(stream),
+        mimetype=mimetypes[export_format],
+        headers={'Content-Disposition': f'attachment; filename={kind}.{export_format}'}
+    )
+
+@invoice_routes.route('/<int:id>/print')
+def print_invoice(id):
+    version = page_cache.invoice_version(id)
+    if version is None:
+        abort(404)  # outside the try below, which turns errors into a flash and redirect
+
+    try:
+        def render():
+            invoice = Invoice.query.options(
+                joinedload(Invoice.customer),
+                joinedload(Invoice.items),
+                selectinload(Invoice.payments)
+            ).filter(Invoice.id == id).one()
+            return render_template('invoices/_print.html', invoice=invoice)
+
+        return page_cache.serve(
+            f"invoice_{id}", 'print', page_cache.key('print', id, version, daily=True),
+            page_cache.last_modified(version), render,
+            lambda body: render_template('invoices/print.html', invoice_number=version.invoice_number,
+                                         body=Markup(body))
+        )
     except Exception as e:
         logger.error(f"Error loading invoice for printing: {str(e)}")
         flash('Error loading invoice', 'danger')
@@ -0,0 +1,576 @@
+import bisect
+import heapq
+import logging
+import math
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import Column, Float, Integer, MetaData, Table, Text, delete, func, insert, literal, select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import column
+
+from app.pagination import KeysetPage, decode_cursor, encode_cursor
+
+logger = logging.getLogger(__name__)
+
+SearchHit = namedtuple('SearchHit', 'invoice score')
+
+# Indexed fields of an invoice document and how much a match in each counts
+FIELDS = ('invoice_number', 'customer', 'notes', 'items')
+WEIGHTS = {'invoice_number': 10.0, 'customer': 4.0, 'notes': 2.0, 'items': 1.0}
+MAX_QUERY_WORDS = 16
+# Rows stamped this long before a sync are assumed committed by then; newer ones are checked again
+SYNC_LAG = timedelta(seconds=60)
+LOAD_CHUNK = 5000
+
+# Same rule as the FTS5 unicode61 tokenizer: runs of letters and digits, underscores separate
+TOKEN = re.compile(r'[^\W_]+')
+
+FTS_TABLE = Table(
+    'invoice_search', MetaData(),  # not in db.metadata: create_all cannot make virtual tables
+    Column('rowid', Integer, primary_key=True),
+    *(Column(field, Text) for field in FIELDS)
+)
+# The prefix option keeps two- and three-letter prefixes as cheap as whole words
+FTS_MODULE = f"fts5({', '.join(FIELDS)}, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+FTS_DDL = f"CREATE VIRTUAL TABLE {FTS_TABLE.name} USING {FTS_MODULE}"
+RANK = column('rank', Float)
+
+# Same table on MySQL: InnoDB, one FULLTEXT index over every field and one per field for its weight
+MYSQL_FULLTEXT = {('ix_invoice_search_all', field) for field in FIELDS} | \
+    {(f'ix_invoice_search_{field}', field) for field in FIELDS}
+MYSQL_DDL = (
+    f"CREATE TABLE {FTS_TABLE.name} (rowid INTEGER NOT NULL PRIMARY KEY, "
+    f"invoice_number TEXT, customer TEXT, notes MEDIUMTEXT, items MEDIUMTEXT, "
+    f"FULLTEXT KEY ix_invoice_search_all ({', '.join(FIELDS)}), "
+    + ', '.join(f"FULLTEXT KEY ix_invoice_search_{field} ({field})" for field in FIELDS)
+    + ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"
+)
+
+
+def normalize(value):
+    """Lower-case value with accents stripped, as remove_diacritics does"""
+    decomposed = unicodedata.normalize('NFKD', value or '')
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+
+
+def tokenize(value):
+    return TOKEN.findall(normalize(value))
+
+
+def parse_query(query):
+    """
+    Split a search box query into words, each a list of tokens.
+
+    Every word must match; the last token of a word matches as a prefix, so
+    'INV-00' finds INV-0012 and 'consult' finds Consulting. Single
+    characters only match whole tokens, as a one-letter prefix matches
+    nearly everything.
+    """
+    words = [tokenize(word) for word in (query or '').split()]
+    return [tokens for tokens in words if tokens][:MAX_QUERY_WORDS]
+
+
+def fts5_available():
+    """Whether the sqlite3 library this Python links against was built with FTS5"""
+    try:
+        connection = sqlite3.connect(':memory:')
+        try:
+            connection.execute('CREATE VIRTUAL TABLE probe USING fts5(value)')
+        finally:
+            connection.close()
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def _match_expression(tokens):
+    phrase = '"' + ' '.join(tokens) + '"'
+    return phrase + '*' if len(tokens[-1]) > 1 else phrase
+
+
+def _boolean_expression(tokens, operator):
+    """A word in MySQL boolean mode: each token prefixed with operator, the last one also a prefix match"""
+    terms = [operator + token for token in tokens]
+    return ' '.join(terms) + '*' if len(tokens[-1]) > 1 else ' '.join(terms)
+
+
+def _customer_text(*values):
+    return ' '.join(value for value in values if value)
+
+
+class TableIndex:
+    """
+    Invoice documents in a table of the database, keyed by invoice id.
+
+    Documents are rewritten by app.services inside the transaction that
+    changes the invoice, so search always agrees with the invoice table.
+    Subclasses supply the table's DDL, create() and search().
+    """
+
+    @staticmethod
+    def _documents():
+        """invoice_search rows for every invoice, built from the invoice, customer and item tables"""
+        from app.models import Customer, Invoice, InvoiceItem
+
+        space = literal(' ')
+        items = select(func.aggregate_strings(InvoiceItem.description, ' ')) \
+            .where(InvoiceItem.invoice_id == Invoice.id).scalar_subquery()
+        return select(
+            Invoice.id, Invoice.invoice_number,
+            func.coalesce(Customer.name, '') + space + func.coalesce(Customer.email, '') + space
+            + func.coalesce(Customer.phone, '') + space + func.coalesce(Customer.address, ''),
+            func.coalesce(Invoice.notes, ''), func.coalesce(items, '')
+        ).select_from(Invoice).outerjoin(Customer, Customer.id == Invoice.customer_id)
+
+    def _write(self, documents):
+        from app import db
+
+        db.session.execute(insert(FTS_TABLE).from_select(['rowid', *FIELDS], documents))
+
+    def _optimize(self):
+        pass
+
+    def rebuild(self):
+        from app import db
+
+        try:
+            db.session.execute(delete(FTS_TABLE))
+            self._write(self._documents())
+            self._optimize()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return db.session.execute(select(func.count()).select_from(FTS_TABLE)).scalar()
+
+    def index_invoices(self, invoice_ids):
+        from app import db
+        from app.models import Invoice
+
+        db.session.flush()  # the documents are read back from the tables
+        ids = list(invoice_ids)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            db.session.execute(delete(FTS_TABLE).where(FTS_TABLE.c.rowid.in_(chunk)))
+            self._write(self._documents().where(Invoice.id.in_(chunk)))
+
+    def index_customer(self, customer_id):
+        from app import db
+        from app.models import Invoice
+
+        db.session.flush()
+        ids = select(Invoice.id).where(Invoice.customer_id == customer_id)
+        db.session.execute(delete(FTS_TABLE).where(FTS_TABLE.c.rowid.in_(ids)))
+        self._write(self._documents().where(Invoice.customer_id == customer_id))
+
+    def remove_invoices(self, invoice_ids):
+        from app import db
+
+        db.session.execute(delete(FTS_TABLE).where(FTS_TABLE.c.rowid.in_(list(invoice_ids))))
+
+    def forget(self, invoice_ids):
+        pass  # the table is kept in step with the invoices; nothing goes missing
+
+
+class Fts5Index(TableIndex):
+    """Invoice documents in an SQLite FTS5 table, ordered by bm25 with the per-field WEIGHTS"""
+    name = 'fts5'
+    ddl = FTS_DDL
+
+    def create(self):
+        """
+        Create the FTS table and fill it; returns True if it was created.
+
+        A table made with a different definition is dropped and rebuilt.
+        """
+        from app import db
+
+        with db.engine.begin() as conn:
+            current = conn.execute(
+                text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {'name': FTS_TABLE.name}
+            ).scalar()
+            if current is not None and current.endswith(FTS_MODULE):
+                return False
+            if current is not None:
+                conn.execute(text(f"DROP TABLE {FTS_TABLE.name}"))
+            conn.execute(text(FTS_DDL))
+        self.rebuild()
+        return True
+
+    def _optimize(self):
+        from app import db
+
+        db.session.execute(text(f"INSERT INTO {FTS_TABLE.name}({FTS_TABLE.name}) VALUES ('optimize')"))
+
+    def search(self, words, after, limit, rank_limit):
+        """
+        (invoice id, rank) of the best matches after the (rank, id) key, lowest rank first.
+
+        Only the rank_limit newest matches are ranked: bm25 is computed for
+        every row it orders, and the newest rows are found cheaply by walking
+        the doclists backwards.
+        """
+        from app import db
+
+        match = ' '.join(_match_expression(tokens) for tokens in words)
+        ranking = f"bm25({', '.join(str(WEIGHTS[field]) for field in FIELDS)})"
+        sql = f"SELECT rowid, rank FROM {FTS_TABLE.name} WHERE {FTS_TABLE.name} MATCH :match AND rank MATCH :ranking"
+        params = {'match': match, 'ranking': ranking, 'limit': limit}
+        oldest = db.session.execute(
+            text(f"SELECT rowid FROM {FTS_TABLE.name} WHERE {FTS_TABLE.name} MATCH :match "
+                 f"ORDER BY rowid DESC LIMIT 1 OFFSET :offset"),
+            {'match': match, 'offset': rank_limit - 1}
+        ).scalar()
+        if oldest is not None:
+            sql += " AND rowid >= :oldest"
+            params['oldest'] = oldest
+        if after:
+            sql += " AND (rank > :rank OR (rank = :rank AND rowid > :id))"
+            params.update(rank=after[0], id=after[1])
+        sql += " ORDER BY rank, rowid LIMIT :limit"
+        return [tuple(row) for row in db.session.execute(text(sql), params)]
+
+
+class MysqlIndex(TableIndex):
+    """
+    Invoice documents in an InnoDB table with FULLTEXT indexes, queried with MATCH ... AGAINST.
+
+    One FULLTEXT index over all fields finds the matches in boolean mode;
+    one per field scores them, and the rank is minus the WEIGHTS-weighted
+    sum of the field scores. The tokens of a word must all occur but need
+    not be adjacent. InnoDB skips words shorter than innodb_ft_min_token_size
+    (3 by default) and its stopwords; set it to 1 to find invoice numbers by
+    their short parts.
+    """
+    name = 'mysql'
+    ddl = MYSQL_DDL
+
+    def create(self):
+        """
+        Create the table and fill it; returns True if it was created.
+
+        A table with different FULLTEXT indexes is dropped and rebuilt.
+        """
+        from app import db
+
+        with db.engine.begin() as conn:
+            exists = conn.execute(
+                text("SELECT COUNT(*) FROM information_schema.tables "
+                     "WHERE table_schema = DATABASE() AND table_name = :name"),
+                {'name': FTS_TABLE.name}
+            ).scalar()
+            indexed = {tuple(row) for row in conn.execute(
+                text("SELECT index_name, column_name FROM information_schema.statistics "
+                     "WHERE table_schema = DATABASE() AND table_name = :name AND index_type = 'FULLTEXT'"),
+                {'name': FTS_TABLE.name}
+            )}
+            if exists and indexed == MYSQL_FULLTEXT:
+                return False
+            if exists:
+                conn.execute(text(f"DROP TABLE {FTS_TABLE.name}"))
+            conn.execute(text(MYSQL_DDL))
+        self.rebuild()
+        return True
+
+    def _write(self, documents):
+        from app import db
+
+        # GROUP_CONCAT cuts the item descriptions at 1024 bytes by default
+        db.session.execute(text("SET SESSION group_concat_max_len = 16777216"))
+        super()._write(documents)
+
+    def search(self, words, after, limit, rank_limit):
+        """
+        (invoice id, rank) of the best matches after the (rank, id) key, lowest rank first.
+
+        Only the rank_limit newest matches are scored, found by id on the
+        FULLTEXT index before any relevance is computed.
+        """
+        from app import db
+
+        match = ' '.join(_boolean_expression(tokens, '+') for tokens in words)
+        terms = ' '.join(_boolean_expression(tokens, '') for tokens in words)
+        matches = f"MATCH({', '.join(FIELDS)}) AGAINST (:match IN BOOLEAN MODE)"
+        score = ' + '.join(f"{WEIGHTS[field]} * MATCH({field}) AGAINST (:terms IN BOOLEAN MODE)"
+                           for field in FIELDS)
+        inner = f"SELECT rowid, -({score}) AS search_rank FROM {FTS_TABLE.name} WHERE {matches}"
+        params = {'match': match, 'terms': terms, 'limit': limit}
+        oldest = db.session.execute(
+            text(f"SELECT rowid FROM {FTS_TABLE.name} WHERE {matches} ORDER BY rowid DESC LIMIT 1 OFFSET :offset"),
+            {'match': match, 'offset': rank_limit - 1}
+        ).scalar()
+        if oldest is not None:
+            inner += " AND rowid >= :oldest"
+            params['oldest'] = oldest
+        sql = f"SELECT rowid, search_rank FROM ({inner}) AS ranked"
+        if after:
+            sql += " WHERE search_rank > :rank OR (search_rank = :rank AND rowid > :id)"
+            params.update(rank=after[0], id=after[1])
+        sql += " ORDER BY search_rank, rowid LIMIT :limit"
+        return [tuple(row) for row in db.session.execute(text(sql), params)]
+
+
+class MemoryIndex:
+    """
+    In-process inverted index, for databases without an in-database one.
+
+    Built from the tables on the first search, then brought up to date
+    before every search from the updated_at stamps of invoices and customers,
+    so edits made by other processes are picked up too. Invoices deleted
+    since they were indexed are dropped when a search comes across them.
+    Scores are a bm25-style sum of field weight x idf over the matched
+    tokens, without length normalization.
+    """
+    name = 'memory'
+    ddl = ''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._postings = {}    # token -> {invoice id: weight}
+        self._vocabulary = []  # sorted tokens, for prefix lookups
+        self._documents = {}   # invoice id -> (stamps, tokens)
+        self._synced_to = None  # every row stamped before this is indexed
+
+    def create(self):
+        return False
+
+    def rebuild(self):
+        with self._lock:
+            self._reset()
+            self._sync()
+            return len(self._documents)
+
+    def index_invoices(self, invoice_ids):
+        pass  # picked up from updated_at by the next search
+
+    def index_customer(self, customer_id):
+        pass
+
+    def remove_invoices(self, invoice_ids):
+        self.forget(invoice_ids)
+
+    def forget(self, invoice_ids):
+        with self._lock:
+            for invoice_id in invoice_ids:
+                self._remove(invoice_id)
+
+    def _remove(self, invoice_id):
+        document = self._documents.pop(invoice_id, None)
+        if document is None:
+            return
+        for token in document[1]:
+            postings = self._postings[token]
+            del postings[invoice_id]
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+
+    def _add(self, invoice_id, stamps, values):
+        self._remove(invoice_id)
+        weights = {}
+        for field, value in zip(FIELDS, values):
+            for token in tokenize(value):
+                weights[token] = weights.get(token, 0.0) + WEIGHTS[field]
+        for token, weight in weights.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                bisect.insort(self._vocabulary, token)
+            postings[invoice_id] = weight
+        self._documents[invoice_id] = (stamps, tuple(weights))
+
+    def _load(self, condition, changed_only):
+        """Index the invoices matching condition, skipping unchanged ones when changed_only"""
+        from app import db
+        from app.models import Customer, Invoice, InvoiceItem
+
+        headers = select(
+            Invoice.id, Invoice.updated_at, Customer.updated_at, Invoice.invoice_number, Invoice.notes,
+            Customer.name, Customer.email, Customer.phone, Customer.address
+        ).select_from(Invoice).outerjoin(Customer, Customer.id == Invoice.customer_id).order_by(Invoice.id)
+        if condition is not None:
+            headers = headers.where(condition)
+
+        last_id = 0
+        while True:
+            rows = db.session.execute(headers.where(Invoice.id > last_id).limit(LOAD_CHUNK)).all()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            if changed_only:
+                rows = [row for row in rows if self._documents.get(row[0], (None,))[0] != tuple(row[1:3])]
+            descriptions = {}
+            ids = [row[0] for row in rows]
+            for start in range(0, len(ids), 500):
+                for invoice_id, description in db.session.execute(
+                        select(InvoiceItem.invoice_id, InvoiceItem.description)
+                        .where(InvoiceItem.invoice_id.in_(ids[start:start + 500]))):
+                    descriptions.setdefault(invoice_id, []).append(description)
+            for invoice_id, invoice_stamp, customer_stamp, number, notes, *customer in rows:
+                self._add(invoice_id, (invoice_stamp, customer_stamp),
+                          (number, _customer_text(*customer), notes, ' '.join(descriptions.get(invoice_id, ()))))
+
+    def _sync(self):
+        from app import db
+        from app.models import Customer, Invoice
+
+        started = datetime.utcnow()
+        if self._synced_to is None:
+            self._load(None, changed_only=False)
+            logger.info(f"Built the in-memory search index: {len(self._documents)} invoices, "
+                        f"{len(self._postings)} tokens")
+        else:
+            since = self._synced_to
+            customers = select(Customer.id).where(Customer.updated_at >= since)
+            changed = select(Invoice.id).where(Invoice.updated_at >= since).union(
+                select(Invoice.id).where(Invoice.customer_id.in_(customers)))
+            ids = db.session.execute(changed).scalars().all()
+            for start in range(0, len(ids), 500):
+                self._load(Invoice.id.in_(ids[start:start + 500]), changed_only=True)
+        self._synced_to = started - SYNC_LAG
+
+    def _term(self, tokens):
+        """invoice id -> score for the invoices containing every token, the last one as a prefix"""
+        total = len(self._documents)
+
+        def idf(postings):
+            return math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+
+        term = None
+        *exact, prefix = tokens if len(tokens[-1]) > 1 else tokens + ['']
+        for token in exact:
+            postings = self._postings.get(token, {})
+            scores = {invoice_id: weight * idf(postings) for invoice_id, weight in postings.items()}
+            term = scores if term is None else {k: v + scores[k] for k, v in term.items() if k in scores}
+
+        scores = {}
+        position = bisect.bisect_left(self._vocabulary, prefix)
+        while position < len(self._vocabulary) and self._vocabulary[position].startswith(prefix):
+            postings = self._postings[self._vocabulary[position]]
+            factor = idf(postings)
+            for invoice_id, weight in postings.items():
+                scores[invoice_id] = scores.get(invoice_id, 0.0) + weight * factor
+            position += 1
+        return scores if term is None else {k: v + scores[k] for k, v in term.items() if k in scores}
+
+    def search(self, words, after, limit, rank_limit):
+        with self._lock:
+            self._sync()
+            scores = None
+            for term in sorted((self._term(tokens) for tokens in words), key=len):
+                scores = term if scores is None else {k: v + term[k] for k, v in scores.items() if k in term}
+                if not scores:
+                    return []
+        newest = heapq.nlargest(rank_limit, scores) if len(scores) > rank_limit else scores
+        ranked = ((-scores[invoice_id], invoice_id) for invoice_id in newest)
+        if after:
+            ranked = (key for key in ranked if key > tuple(after))
+        return [(invoice_id, rank) for rank, invoice_id in sorted(ranked)[:limit]]
+
+
+class InvoiceSearch:
+    """
+    Full-text search over invoice numbers, notes, line items and customer details.
+
+    SEARCH_BACKEND picks the index: 'fts5' (an FTS5 table in the SQLite
+    database), 'mysql' (a FULLTEXT-indexed table in the MySQL database),
+    'memory' (an in-process index) or 'auto', which uses whichever of the
+    first two suits the database. The memory index is only used when asked
+    for: 'auto' refuses other databases rather than fall back to it. Each
+    app gets its own index. Queries matching more than SEARCH_RANK_LIMIT
+    invoices rank only the newest that many. Pages are cut by a (rank, id)
+    cursor like the list views.
+    """
+
+    def init_app(self, app):
+        backend = app.config['SEARCH_BACKEND']
+        if backend not in ('auto', 'fts5', 'mysql', 'memory'):
+            raise ValueError(f"SEARCH_BACKEND must be 'auto', 'fts5', 'mysql' or 'memory', not {backend!r}")
+        database = make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+        fts = database == 'sqlite' and fts5_available()
+        mysql = database in ('mysql', 'mariadb')
+        if backend == 'fts5' and not fts:
+            raise ValueError("SEARCH_BACKEND 'fts5' needs an SQLite database and an sqlite3 library with FTS5")
+        if backend == 'mysql' and not mysql:
+            raise ValueError("SEARCH_BACKEND 'mysql' needs a MySQL or MariaDB database")
+        if backend == 'auto' and not (fts or mysql):
+            raise ValueError(f"No in-database search index for {database} (SQLite needs FTS5); "
+                             f"set SEARCH_BACKEND to 'memory' to index in process instead")
+        if backend == 'memory':
+            app.extensions['search'] = MemoryIndex()
+        else:
+            app.extensions['search'] = Fts5Index() if fts else MysqlIndex()
+
+    @property
+    def index(self):
+        return current_app.extensions['search']
+
+    def schema_ddl(self):
+        """DDL of the index's tables, part of the schema fingerprint"""
+        return self.index.ddl
+
+    def create_index(self):
+        created = self.index.create()
+        if created:
+            logger.info("Created and filled the invoice search index")
+        return created
+
+    def rebuild(self):
+        """Rebuild the index from the tables; returns the number of invoices indexed"""
+        count = self.index.rebuild()
+        logger.info(f"Rebuilt the invoice search index ({self.index.name}): {count} invoices")
+        return count
+
+    def index_invoices(self, invoice_ids):
+        """Re-index invoices inside the caller's transaction"""
+        if invoice_ids:
+            self.index.index_invoices(invoice_ids)
+
+    def index_customer(self, customer_id):
+        """Re-index every invoice of a customer inside the caller's transaction"""
+        self.index.index_customer(customer_id)
+
+    def remove_invoices(self, invoice_ids):
+        if invoice_ids:
+            self.index.remove_invoices(invoice_ids)
+
+    def search(self, query, cursor=None, per_page=20):
+        """
+        One page of invoices matching query as a KeysetPage of SearchHits, best first.
+
+        Raises ValueError for a malformed cursor.
+        """
+        from app.models import Invoice
+
+        words = parse_query(query)
+        if not words:
+            return KeysetPage([], None, per_page)
+        after = decode_cursor(cursor, [RANK, Invoice.id]) if cursor else None
+        ranked = self.index.search(words, after, per_page + 1, current_app.config['SEARCH_RANK_LIMIT'])
+
+        next_cursor = None
+        if len(ranked) > per_page:
+            ranked = ranked[:per_page]
+            next_cursor = encode_cursor(list(reversed(ranked[-1])))
+        ids = [invoice_id for invoice_id, _ in ranked]
+        loaded = {invoice.id: invoice for invoice in
+                  Invoice.query.options(joinedload(Invoice.customer)).filter(Invoice.id.in_(ids))} if ids else {}
+        missing = [invoice_id for invoice_id in ids if invoice_id not in loaded]
+        if missing:
+            self.index.forget(missing)
+        hits = [SearchHit(loaded[invoice_id], -rank) for invoice_id, rank in ranked if invoice_id in loaded]
+        return KeysetPage(hits, next_cursor, per_page)
+
+
+search_index = InvoiceSearch()
@@ -0,0 +1,550 @@
+import logging
+from collections import Counter
+from datetime import date, datetime
+from decimal import Decimal
+
+from sqlalchemy import delete, func, insert, literal, select, update
+from sqlalchemy.orm.exc import StaleDataError
+
+from app import db, money
+from app.currency import default_currency
+from app.models import Customer, Invoice, InvoiceItem, Payment, RecurringInvoiceRun
+from app.page_cache import page_cache
+from app.pdf_cache import pdf_cache
+from app.numbering import invoice_numbers
+from app.search import search_index
+from app.summaries import AMOUNT_FIELDS, SummaryDelta, invoice_state
+from app.utils import calculate_totals, money_settings
+
+logger = logging.getLogger(__name__)
+
+PAID = 'PAID'
+OVERDUE = 'OVERDUE'
+# Statuses the overdue sweep moves to OVERDUE once the due date has passed
+OVERDUE_FROM = ('DRAFT',)
+
+def _money(value):
+    return money.quantize(value, money_settings()['rounding'])
+
+
+def _item_row(item, amount=None):
+    """Normalized column values for an item dict"""
+    rounding = money_settings()['rounding']
+    quantity = money.quantize(item['quantity'], rounding)
+    unit_price = money.quantize(item['unit_price'], rounding)
+    return {
+        'description': item['description'],
+        'quantity': quantity,
+        'unit_price': unit_price,
+        'amount': amount if amount is not None else money.line_amount(quantity, unit_price, rounding)
+    }
+
+
+def _apply_totals(invoice, totals):
+    invoice.subtotal = totals['subtotal']
+    invoice.tax_amount = totals['tax_amount']
+    invoice.total = totals['total']
+
+
+def _settle_status(invoice):
+    """
+    PAID once payments cover the total; a PAID invoice that is no longer
+    covered goes back to OVERDUE or DRAFT depending on its due date.
+    """
+    if invoice.amount_paid and _money(invoice.amount_paid) >= _money(invoice.total):
+        invoice.status = PAID
+    elif invoice.status == PAID:
+        invoice.status = OVERDUE if invoice.due_date < date.today() else OVERDUE_FROM[0]
+
+
+def _allocate_numbers(specs):
+    """Allocate invoice numbers for every spec lacking one, one call per series"""
+    needed = {}
+    for spec in specs:
+        if not spec.get('invoice_number'):
+            series = invoice_numbers.series_for(spec.get('issue_date'))
+            needed[series] = (needed.get(series, (0, None))[0] + 1, spec.get('issue_date'))
+    return {series: invoice_numbers.allocate_many(count, issue_date)
+            for series, (count, issue_date) in needed.items()}
+
+
+def _customer_currencies(specs):
+    """Currencies of the customers of specs that do not name one, in one query"""
+    customer_ids = list({spec['customer_id'] for spec in specs if not spec.get('currency')})
+    currencies = {}
+    for start in range(0, len(customer_ids), 500):
+        currencies.update(db.session.execute(
+            select(Customer.id, Customer.currency).where(Customer.id.in_(customer_ids[start:start + 500]))
+        ).all())
+    return currencies
+
+
+def add_invoices(specs):
+    """
+    Add several invoices and all their items to the session without committing.
+
+    Each spec is a dict of Invoice columns (customer_id, issue_date, due_date,
+    tax_rate, notes, optionally invoice_number, currency and status) plus an
+    'items' list of {description, quantity, unit_price} dicts. Invoices
+    without a currency are billed in their customer's. Totals of the whole batch
+    are computed in one money.batch_totals call. Headers are flushed together
+    to get their ids, then every item is written with a single bulk INSERT
+    and the batch is added to the search index.
+    """
+    invoices = []
+    summaries = SummaryDelta()
+    numbers = _allocate_numbers(specs)
+    currencies = _customer_currencies(specs)
+    batch = money.batch_totals(specs, **money_settings())
+    for spec, totals in zip(specs, batch):
+        fields = {k: v for k, v in spec.items() if k != 'items'}
+        fields.setdefault('status', 'DRAFT')
+        if not fields.get('currency'):
+            fields['currency'] = currencies.get(fields['customer_id']) or default_currency()
+        if not fields.get('invoice_number'):
+            fields['invoice_number'] = numbers[invoice_numbers.series_for(fields.get('issue_date'))].pop(0)
+        invoice = Invoice(**fields)
+        _apply_totals(invoice, totals)
+        invoices.append(invoice)
+        summaries.add(invoice_state(invoice))
+
+    db.session.add_all(invoices)
+    db.session.flush()
+
+    rows = [
+        dict(_item_row(item, amount), invoice_id=invoice.id)
+        for invoice, spec, totals in zip(invoices, specs, batch)
+        for item, amount in zip(spec['items'], totals['amounts'])
+    ]
+    if rows:
+        db.session.execute(insert(InvoiceItem), rows)
+    summaries.apply()
+    search_index.index_invoices([invoice.id for invoice in invoices])
+    return invoices
+
+
+def create_invoices(specs):
+    """Create several invoices with add_invoices in one transaction; nothing is written if any part fails"""
+    try:
+        invoices = add_invoices(specs)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return invoices
+
+
+def create_invoice(items, **fields):
+    """Create one invoice with its items in a single transaction"""
+    return create_invoices([dict(fields, items=items)])[0]
+
+
+class InvoiceConflict(Exception):
+    """An invoice was saved by someone else after the editor loaded it"""
+
+    def __init__(self, invoice, diff):
+        super().__init__(f"Invoice {invoice.invoice_number} was changed by someone else")
+        self.invoice = invoice
+        self.diff = diff
+
+
+def _comparable(value):
+    if value is None:
+        return ''
+    return _money(value) if isinstance(value, (Decimal, float)) else value
+
+
+def invoice_diff(invoice, items, fields):
+    """
+    How an edit differs from the invoice as saved.
+
+    'fields' lists each header field whose value differs; item lines are
+    compared as (description, quantity, unit_price) and listed when they are
+    only in the edit or only in the saved invoice.
+    """
+    changed = [
+        {'field': key, 'yours': value, 'saved': getattr(invoice, key)}
+        for key, value in fields.items()
+        if _comparable(value) != _comparable(getattr(invoice, key))
+    ]
+    yours = Counter((item['description'], _money(item['quantity']), _money(item['unit_price'])) for item in items)
+    saved = Counter((item.description, _money(item.quantity), _money(item.unit_price)) for item in invoice.items)
+    return {
+        'fields': changed,
+        'items_only_yours': sorted((yours - saved).elements()),
+        'items_only_saved': sorted((saved - yours).elements())
+    }
+
+
+def update_invoice(invoice, items, expected_version=None, **fields):
+    """
+    Update an invoice header and reconcile its items in one transaction.
+
+    Incoming items that carry the 'id' of an existing item are matched to it;
+    items without one reuse the remaining existing rows in order, then become
+    new rows. Only rows whose values changed are UPDATEd, new rows are bulk
+    INSERTed and leftover rows are DELETEd by id, so concurrent edits lock
+    just their own invoice row and the item rows they touch.
+
+    expected_version is the version the editor started from. If the invoice
+    was saved since then, whether before this call or by a transaction that
+    commits first, nothing is written and InvoiceConflict is raised with the
+    saved invoice and a diff against it.
+
+    The status follows the new total as it does for payments. ValueError is
+    raised, writing nothing, if the total would fall below the amount paid.
+    """
+    if expected_version not in (None, '') and int(expected_version) != invoice.version:
+        raise InvoiceConflict(invoice, invoice_diff(invoice, items, fields))
+    totals = calculate_totals(items, fields.get('tax_rate', invoice.tax_rate))
+    if _money(invoice.amount_paid or 0) > totals['total']:
+        raise ValueError(f"The new total of {totals['total']} is less than the {_money(invoice.amount_paid)} "
+                         f"already paid on invoice {invoice.invoice_number}")
+
+    summaries = SummaryDelta()
+    try:
+        summaries.remove(invoice_state(invoice))
+        for key, value in fields.items():
+            setattr(invoice, key, value)
+        # Item rows are written directly, so stamp the header even when only items change
+        invoice.updated_at = datetime.utcnow()
+        _apply_totals(invoice, totals)
+        _settle_status(invoice)
+        summaries.add(invoice_state(invoice))
+
+        existing = {item.id: item for item in sorted(invoice.items, key=lambda i: i.id)}
+        claimed = {item.get('id') for item in items if item.get('id') in existing}
+        spare = [item_id for item_id in existing if item_id not in claimed]
+
+        updates, inserts = [], []
+        for item in items:
+            row = _item_row(item)
+            item_id = item.get('id') if item.get('id') in existing else (spare.pop(0) if spare else None)
+            if item_id is None:
+                inserts.append(dict(row, invoice_id=invoice.id))
+                continue
+            current = existing[item_id]
+            if (current.description, _money(current.quantity), _money(current.unit_price)) != \
+                    (row['description'], row['quantity'], row['unit_price']):
+                updates.append(dict(row, id=item_id))
+
+        if updates:
+            db.session.execute(update(InvoiceItem), updates)
+        if inserts:
+            db.session.execute(insert(InvoiceItem), inserts)
+        if spare:
+            db.session.execute(
+                delete(InvoiceItem).where(InvoiceItem.id.in_(spare)),
+                execution_options={'synchronize_session': False}
+            )
+        summaries.apply()
+        search_index.index_invoices([invoice.id])
+        db.session.commit()
+        logger.info(f"Invoice {invoice.invoice_number} updated: {len(updates)} items changed, "
+                    f"{len(inserts)} added, {len(spare)} removed")
+    except StaleDataError:
+        # The header UPDATE is flushed first and matched no row at the version we loaded
+        db.session.rollback()
+        db.session.refresh(invoice)
+        raise InvoiceConflict(invoice, invoice_diff(invoice, items, fields))
+    except Exception:
+        db.session.rollback()
+        raise
+
+    pdf_cache.invalidate(invoice.id)
+
+    page_cache.invalidate_invoices(invoice.id)
+    return invoice
+
+
+def delete_invoice(invoice):
+    """Delete an invoice and its items"""
+    summaries = SummaryDelta()
+    try:
+        summaries.remove(invoice_state(invoice))
+        db.session.execute(
+            update(RecurringInvoiceRun).where(RecurringInvoiceRun.invoice_id == invoice.id).values(invoice_id=None),
+            execution_options={'synchronize_session': False}
+        )
+        db.session.delete(invoice)
+        summaries.apply()
+        search_index.remove_invoices([invoice.id])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    pdf_cache.invalidate(invoice.id)
+    page_cache.invalidate_invoices(invoice.id)
+
+
+def set_invoice_status(invoice, status):
+    """Change the status of an invoice, e.g. to PAID"""
+    summaries = SummaryDelta()
+    try:
+        summaries.remove(invoice_state(invoice))
+        invoice.status = status
+        summaries.add(invoice_state(invoice))
+        summaries.apply()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    pdf_cache.invalidate(invoice.id)
+    page_cache.invalidate_invoices(invoice.id)
+    return invoice
+
+
+def mark_overdue(as_of=None):
+    """
+    Flip every DRAFT invoice due before as_of (default today) to OVERDUE.
+
+    Invoices change with one bulk UPDATE; the summary rollups are moved by
+    the totals of the flipped invoices, read with one grouped query over
+    them before the update. Returns the number of invoices marked.
+    """
+    as_of = as_of or date.today()
+    summaries = SummaryDelta()
+    try:
+        key = (Invoice.issue_date, Invoice.due_date, Invoice.customer_id, Invoice.currency, Invoice.status)
+        rows = db.session.execute(
+            select(*key, func.count(Invoice.id), *(func.sum(getattr(Invoice, field)) for field in AMOUNT_FIELDS))
+            .where(Invoice.status.in_(OVERDUE_FROM), Invoice.due_date < as_of)
+            .group_by(*key)
+        ).all()
+        for row in rows:
+            state, count, amounts = tuple(row[:len(key)]), row[len(key)], row[len(key) + 1:]
+            summaries.move(state, state[:-1] + (OVERDUE,), count, tuple(Decimal(str(amount or 0)) for amount in amounts))
+
+        marked = db.session.execute(
+            update(Invoice)
+            .where(Invoice.status.in_(OVERDUE_FROM), Invoice.due_date < as_of)
+            .values(status=OVERDUE, version=Invoice.version + 1),
+            execution_options={'synchronize_session': False}
+        ).rowcount
+        summaries.apply()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    logger.info(f"Marked {marked} invoices due before {as_of} as {OVERDUE}")
+    return marked
+
+
+def record_payments(payments):
+    """
+    Record several payments in one transaction.
+
+    Each payment is a dict with invoice_id, amount, paid_on and optionally
+    method and reference. The invoices are read once, locked FOR UPDATE, and
+    their amount_paid raised; invoices paid in full become PAID. Raises
+    ValueError, writing nothing, if an invoice is missing or would be
+    overpaid. Returns the affected invoices.
+    """
+    summaries = SummaryDelta()
+    try:
+        ids = {payment['invoice_id'] for payment in payments}
+        invoices = {invoice.id: invoice for invoice in db.session.scalars(
+            select(Invoice).where(Invoice.id.in_(ids)).with_for_update()
+        )}
+        received = {}
+        rows = []
+        for payment in payments:
+            invoice = invoices.get(payment['invoice_id'])
+            if invoice is None:
+                raise ValueError(f"Invoice {payment['invoice_id']} does not exist")
+            amount = _money(payment['amount'])
+            if amount <= 0:
+                raise ValueError(f"Payment for invoice {invoice.invoice_number} must be positive")
+            received[invoice.id] = received.get(invoice.id, 0) + amount
+            rows.append({
+                'invoice_id': invoice.id,
+                'amount': amount,
+                'paid_on': payment.get('paid_on') or date.today(),
+                'method': payment.get('method') or 'manual',
+                'reference': payment.get('reference')
+            })
+
+        for invoice_id, amount in received.items():
+            invoice = invoices[invoice_id]
+            if amount > _money(invoice.balance_due):
+                raise ValueError(f"Payments of {amount} exceed the {_money(invoice.balance_due)} "
+                                 f"due on invoice {invoice.invoice_number}")
+            summaries.remove(invoice_state(invoice))
+            invoice.amount_paid = _money(invoice.amount_paid or 0) + amount
+            _settle_status(invoice)
+            summaries.add(invoice_state(invoice))
+
+        db.session.execute(insert(Payment), rows)
+        summaries.apply()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    pdf_cache.invalidate(*received)
+
+    page_cache.invalidate_invoices(*received)
+    return [invoices[invoice_id] for invoice_id in received]
+
+
+def mark_paid(invoice, paid_on=None, method='manual'):
+    """Record a payment of whatever is still due on an invoice and mark it PAID"""
+    if _money(invoice.balance_due) > 0:
+        record_payments([{'invoice_id': invoice.id, 'amount': invoice.balance_due,
+                          'paid_on': paid_on, 'method': method}])
+        return invoice
+    return set_invoice_status(invoice, PAID)
+
+
+def delete_payment(payment):
+    """
+    Remove a payment, e.g. a bounced one, and lower the invoice's amount_paid.
+
+    An invoice that is no longer paid in full goes back to OVERDUE or DRAFT
+    depending on its due date.
+    """
+    invoice = payment.invoice
+    summaries = SummaryDelta()
+    try:
+        summaries.remove(invoice_state(invoice))
+        invoice.amount_paid = _money(invoice.amount_paid or 0) - _money(payment.amount)
+        _settle_status(invoice)
+        summaries.add(invoice_state(invoice))
+        db.session.delete(payment)
+        summaries.apply()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    pdf_cache.invalidate(invoice.id)
+    page_cache.invalidate_invoices(invoice.id)
+    return invoice
+
+
+def backfill_payments():
+    """
+    Give invoices marked PAID before the payment ledger existed one payment for their total.
+
+    Runs once, when the amount_paid column is first added; the summary store
+    is rebuilt afterwards by the caller.
+    """
+    paid = select(Invoice.id, Invoice.total, Invoice.issue_date, literal('backfill')) \
+        .where(Invoice.status == PAID, Invoice.amount_paid == 0, Invoice.total > 0)
+    try:
+        db.session.execute(insert(Payment).from_select(['invoice_id', 'amount', 'paid_on', 'method'], paid))
+        count = db.session.execute(
+            update(Invoice).where(Invoice.status == PAID, Invoice.amount_paid == 0)
+            .values(amount_paid=Invoice.total, version=Invoice.version + 1),
+            execution_options={'synchronize_session': False}
+        ).rowcount
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    logger.info(f"Backfilled payments for {count} paid invoices")
+    return count
+
+
+def backfill_currency():
+    """
+    Put customers and invoices created before currencies existed in DEFAULT_CURRENCY.
+
+    Runs once, when the currency columns are first added with the 'USD'
+    server default; the summary store is rebuilt afterwards by the caller.
+    """
+    currency = default_currency()
+    if currency == 'USD':
+        return 0
+    try:
+        db.session.execute(update(Customer).values(currency=currency),
+                           execution_options={'synchronize_session': False})
+        count = db.session.execute(
+            update(Invoice).values(currency=currency, version=Invoice.version + 1),
+            execution_options={'synchronize_session': False}
+        ).rowcount
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    logger.info(f"Moved {count} existing invoices to {currency}")
+    return count
+
+
+def update_customer(customer, **fields):
+    """Update a customer, re-index its invoices and drop cached documents that show its details"""
+    try:
+        for key, value in fields.items():
+            setattr(customer, key, value)
+        search_index.index_customer(customer.id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    invoice_ids = [row.id for row in Invoice.query.with_entities(Invoice.id).filter_by(customer_id=customer.id)]
+    pdf_cache.invalidate(*invoice_ids)
+    page_cache.invalidate_invoices(*invoice_ids)
+    page_cache.invalidate_customers(customer.id)
+    return customer
+
+
+def recalculate_totals(filters, chunk_size=500, dry_run=False):
+    """
+    Recompute stored item amounts and invoice totals with the money engine.
+
+    Matching invoices are read in chunks and totalled with one batch_totals
+    call per chunk; only rows whose stored values differ are bulk UPDATEd.
+    Returns (invoices_checked, invoices_changed).
+    """
+    from app.pdf_export import iter_invoice_chunks
+
+    checked = changed = 0
+    for chunk in iter_invoice_chunks(filters, chunk_size):
+        specs = [{
+            'tax_rate': invoice.tax_rate,
+            'items': [
+                {'id': item.id, 'quantity': item.quantity, 'unit_price': item.unit_price, 'amount': item.amount}
+                for item in sorted(invoice.items, key=lambda item: item.id)
+            ]
+        } for invoice in chunk]
+        invoice_rows, item_rows = [], []
+        summaries = SummaryDelta()
+        for invoice, spec, totals in zip(chunk, specs, money.batch_totals(specs, **money_settings())):
+            stale_items = [
+                {'id': item['id'], 'amount': amount}
+                for item, amount in zip(spec['items'], totals['amounts'])
+                if item['amount'] is None or _money(item['amount']) != amount
+            ]
+            current = (invoice.subtotal, invoice.tax_amount, invoice.total)
+            if stale_items or any(value is None for value in current) or \
+                    tuple(_money(value) for value in current) != \
+                    (totals['subtotal'], totals['tax_amount'], totals['total']):
+                invoice_rows.append({'id': invoice.id, 'subtotal': totals['subtotal'],
+                                     'tax_amount': totals['tax_amount'], 'total': totals['total'],
+                                     # Matched against the loaded version and bumped, like an ORM flush
+                                     'version': invoice.version})
+                item_rows += stale_items
+                key, _ = old_state = invoice_state(invoice)
+                summaries.remove(old_state)
+                summaries.add((key, (totals['subtotal'], totals['tax_amount'], totals['total'],
+                                     money.to_decimal(invoice.amount_paid or 0))))
+        checked += len(chunk)
+        changed += len(invoice_rows)
+
+        if dry_run or not invoice_rows:
+            continue
+        try:
+            db.session.execute(update(Invoice), invoice_rows)
+            if item_rows:
+                db.session.execute(update(InvoiceItem), item_rows)
+            summaries.apply()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        pdf_cache.invalidate(*(row['id'] for row in invoice_rows))
+        page_cache.invalidate_invoices(*(row['id'] for row in invoice_rows))
+
+    logger.info(f"Recalculated totals: {checked} invoices checked, {changed} "
+                f"{'would change' if dry_run else 'changed'}")
+    return checked, changed
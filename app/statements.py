@@ -0,0 +1,177 @@
+import logging
+import zipfile
+from concurrent.futures import as_completed
+from datetime import date
+from decimal import Decimal
+from types import SimpleNamespace
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import joinedload, selectinload
+
+from app import db
+from app.currency import exchange_rates
+from app.metrics import metrics
+from app.models import Customer, Invoice, InvoiceCustomerSummary
+from app.pdf_generator import generate_statement_pdf, pdf_money
+from app.summaries import AGING_BUCKETS, PAID
+from app.utils import StreamBuffer
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal('0.00')
+
+
+def open_invoices_query(customer_ids):
+    """
+    Open invoices of the given customers, oldest first.
+
+    Invoices and their items come from one joined query; payments are loaded
+    with one more IN query instead of multiplying the item rows.
+    """
+    return Invoice.query.options(
+        joinedload(Invoice.items),
+        selectinload(Invoice.payments)
+    ).filter(
+        Invoice.customer_id.in_(customer_ids),
+        Invoice.status != PAID,
+        Invoice.total > Invoice.amount_paid
+    ).order_by(Invoice.customer_id, Invoice.issue_date, Invoice.id)
+
+
+def _aging_label(days_late):
+    for label, first, last in AGING_BUCKETS:
+        if (first is None or days_late >= first) and (last is None or days_late <= last):
+            return label
+
+
+def statement_snapshot(customer, invoices, as_of=None):
+    """
+    Everything a statement PDF shows, as a picklable object for the worker pool.
+
+    The ledger lists each open invoice on its issue date, followed by its
+    items, and each payment made on it on its payment date, with the balance
+    carried from line to line. The statement is in the customer's currency;
+    invoices in another one, and their payments, are converted at the rates
+    of the invoice's issue date, while its items are shown as billed.
+    """
+    as_of = as_of or date.today()
+    currency = customer.currency
+    convert = exchange_rates.converter(currency)
+    events = []
+    for invoice in invoices:
+        events.append((invoice.issue_date, 0, invoice.id, invoice, invoice))
+        for payment in invoice.payments:
+            events.append((payment.paid_on, 1, payment.id, payment, invoice))
+    events.sort(key=lambda event: event[:3])
+
+    rows = []
+    balance = charges = payments = ZERO
+    aging = dict.fromkeys((label for label, _, _ in AGING_BUCKETS), ZERO)
+    for day, kind, _, entry, invoice in events:
+        billed = invoice.currency
+        if kind == 0:
+            total = convert(entry.total, billed, invoice.issue_date)
+            charges += total
+            balance += total
+            billed_total = f", {pdf_money(entry.total, billed)}" if billed != currency else ''
+            rows.append((f"{day.isoformat()}  Invoice {entry.invoice_number} "
+                         f"(due {entry.due_date.isoformat()}{billed_total})",
+                         pdf_money(total, currency), '', pdf_money(balance, currency)))
+            rows.extend((f"- {item.description}: {item.quantity} x {pdf_money(item.unit_price, billed)} "
+                         f"= {pdf_money(item.amount, billed)}", '', '', '') for item in entry.items)
+            aging[_aging_label((as_of - entry.due_date).days)] += \
+                total - convert(entry.amount_paid or 0, billed, invoice.issue_date)
+        else:
+            amount = convert(entry.amount, billed, invoice.issue_date)
+            payments += amount
+            balance -= amount
+            reference = f" ({entry.reference})" if entry.reference else ''
+            rows.append((f"{day.isoformat()}  Payment {entry.method}{reference} on {invoice.invoice_number}",
+                         '', pdf_money(amount, currency), pdf_money(balance, currency)))
+
+    return SimpleNamespace(
+        customer=SimpleNamespace(id=customer.id, name=customer.name, email=customer.email,
+                                 phone=customer.phone, address=customer.address),
+        as_of=as_of,
+        currency=currency,
+        invoice_count=len(invoices),
+        rows=rows,
+        total_charges=charges,
+        total_payments=payments,
+        balance_due=balance,
+        aging=aging
+    )
+
+
+def customer_statement(customer, as_of=None):
+    """Statement snapshot of one customer"""
+    return statement_snapshot(customer, open_invoices_query([customer.id]).all(), as_of)
+
+
+def render_statement_bytes(snapshot):
+    """Worker entry point: render a statement snapshot, return (pdf_bytes, timings)"""
+    timings = {}
+    buffer = generate_statement_pdf(snapshot, timings=timings)
+    return buffer.getvalue(), timings
+
+
+def customers_with_balance(customer_ids=None):
+    """Ids of customers that owe money, read from the per-customer summary rollup"""
+    summary = InvoiceCustomerSummary
+    query = select(summary.customer_id).where(summary.status != PAID) \
+        .group_by(summary.customer_id) \
+        .having(func.sum(summary.total - summary.amount_paid) > 0) \
+        .order_by(summary.customer_id)
+    if customer_ids:
+        query = query.where(summary.customer_id.in_(customer_ids))
+    return list(db.session.execute(query).scalars())
+
+
+def render_statements(customer_ids=None, as_of=None, chunk_size=200, timings=None):
+    """
+    Yield (filename, pdf_bytes) for the statement of every customer that owes money.
+
+    Customers are handled chunk_size at a time: one query loads the open
+    invoices and items of the whole chunk, the statements are rendered in
+    parallel on the PDF worker pool and yielded in completion order.
+    """
+    from app.pdf_jobs import pdf_jobs
+
+    if timings is None:
+        timings = {}
+    ids = customers_with_balance(customer_ids)
+    for start in range(0, len(ids), chunk_size):
+        chunk_ids = ids[start:start + chunk_size]
+        customers = {customer.id: customer for customer in Customer.query.filter(Customer.id.in_(chunk_ids))}
+        invoices = {}
+        for invoice in open_invoices_query(chunk_ids):
+            invoices.setdefault(invoice.customer_id, []).append(invoice)
+
+        futures = {}
+        for customer_id in chunk_ids:
+            snapshot = statement_snapshot(customers[customer_id], invoices.get(customer_id, []), as_of)
+            filename = f"statement_{customer_id}_{snapshot.as_of.isoformat()}.pdf"
+            futures[pdf_jobs.executor.submit(render_statement_bytes, snapshot)] = filename
+        for loaded in [*customers.values(), *(invoice for group in invoices.values() for invoice in group)]:
+            db.session.expunge(loaded)
+
+        for future in as_completed(futures):
+            data, render_timings = future.result()
+            metrics.observe_pdf_render(render_timings, 'statement')
+            timings['rendered'] = timings.get('rendered', 0) + 1
+            for stage, seconds in render_timings.items():
+                timings[stage] = timings.get(stage, 0.0) + seconds
+            yield futures[future], data
+
+
+def stream_statement_zip(customer_ids=None, as_of=None, chunk_size=200):
+    """Yield a ZIP archive of customer statements piece by piece as renders finish"""
+    buffer = StreamBuffer()
+    timings = {}
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for filename, data in render_statements(customer_ids, as_of, chunk_size, timings):
+            archive.writestr(filename, data)
+            yield buffer.drain()
+    yield buffer.drain()
+    logger.info(f"Exported {timings.get('rendered', 0)} customer statements "
+                f"({timings.get('total', 0.0):.2f}s worker render time)")
@@ -0,0 +1,360 @@
+import logging
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+
+from sqlalchemy import and_, bindparam, case, delete, func, insert, select, tuple_, update
+from sqlalchemy.exc import IntegrityError
+
+from app import db, money
+from app.currency import exchange_rates
+from app.models import Customer, Invoice, InvoiceCustomerSummary, InvoiceDaySummary, InvoiceDueSummary
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal('0.00')
+AMOUNT_FIELDS = ('subtotal', 'tax_amount', 'total', 'amount_paid')
+PAID = 'PAID'
+# What an invoice's summary state is keyed by; each rollup keeps totals by a few of these
+STATE_FIELDS = ('issue_date', 'due_date', 'customer_id', 'currency', 'status')
+ROLLUPS = (InvoiceDaySummary, InvoiceCustomerSummary, InvoiceDueSummary)
+KEY_CHUNK = 200
+# Aging buckets: label, and first/last day past due (None = unbounded)
+AGING_BUCKETS = (('current', None, 0), ('1-30', 1, 30), ('31-60', 31, 60), ('61-90', 61, 90), ('90+', 91, None))
+# Status as summarized: upper case, DRAFT when unset
+INVOICE_STATUS = func.upper(func.coalesce(Invoice.status, 'DRAFT'))
+
+
+def invoice_state(invoice):
+    """The summary key of an invoice (its STATE_FIELDS) and the amounts it contributes"""
+    key = (invoice.issue_date, invoice.due_date, invoice.customer_id, invoice.currency,
+           (invoice.status or 'DRAFT').upper())
+    return key, tuple(Decimal(str(getattr(invoice, field) or 0)) for field in AMOUNT_FIELDS)
+
+
+def _key_columns(rollup):
+    return [column for column in rollup.__table__.primary_key.columns]
+
+
+def _project(rollup, key):
+    """The rollup's key for an invoice state key"""
+    return tuple(key[STATE_FIELDS.index(column.name)] for column in _key_columns(rollup))
+
+
+class SummaryDelta:
+    """
+    Changes to the summary rollups, applied inside the caller's transaction.
+
+    Record the state of each invoice before and after a change with remove()
+    and add(); changes are summed per rollup row, and rows whose changes
+    cancel out are never written.
+    """
+
+    def __init__(self):
+        self._rows = defaultdict(lambda: [0] + [ZERO] * len(AMOUNT_FIELDS))
+
+    def add(self, state, sign=1):
+        key, amounts = state
+        row = self._rows[key]
+        row[0] += sign
+        for index, amount in enumerate(amounts, 1):
+            row[index] += sign * amount
+
+    def remove(self, state):
+        self.add(state, -1)
+
+    def move(self, old_key, new_key, count, amounts):
+        """Move count invoices, with these summed amounts, from one state key to another"""
+        for key, sign in ((old_key, -1), (new_key, 1)):
+            row = self._rows[key]
+            row[0] += sign * count
+            for index, amount in enumerate(amounts, 1):
+                row[index] += sign * amount
+
+    def apply(self):
+        """
+        Write the accumulated changes to every rollup.
+
+        Per rollup, existing rows are found with one SELECT per 200 keys and
+        incremented with a single executemany UPDATE; missing rows are bulk
+        INSERTed.
+        """
+        states = dict(self._rows)
+        self._rows.clear()
+        for rollup in ROLLUPS:
+            rows = defaultdict(lambda: [0] + [ZERO] * len(AMOUNT_FIELDS))
+            for key, delta in states.items():
+                row = rows[_project(rollup, key)]
+                for index, value in enumerate(delta):
+                    row[index] += value
+            _apply_rollup(rollup, {key: delta for key, delta in rows.items() if any(delta)})
+
+
+def _apply_rollup(rollup, rows):
+    if not rows:
+        return
+    key_columns = _key_columns(rollup)
+    keys = list(rows)
+    existing = set()
+    for start in range(0, len(keys), KEY_CHUNK):
+        existing.update(tuple(row) for row in db.session.execute(
+            select(*key_columns).where(tuple_(*key_columns).in_(keys[start:start + KEY_CHUNK]))
+        ))
+
+    updates = [_row_params(rollup, key, rows[key], 'key_') for key in keys if key in existing]
+    inserts = [_row_params(rollup, key, rows[key]) for key in keys if key not in existing]
+    if updates:
+        db.session.execute(_increment_statement(rollup), updates)
+    if inserts:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(rollup.__table__), inserts)
+        except IntegrityError:
+            # Another transaction created some of the rows first
+            for key in keys:
+                if key not in existing:
+                    _apply_row(rollup, key, *rows[key])
+
+    emptied = [key for key in keys if rows[key][0] < 0]
+    for start in range(0, len(emptied), KEY_CHUNK):
+        db.session.execute(
+            delete(rollup).where(
+                tuple_(*key_columns).in_(emptied[start:start + KEY_CHUNK]),
+                rollup.invoice_count <= 0
+            ),
+            execution_options={'synchronize_session': False}
+        )
+
+
+def _apply_row(rollup, key, count, *amounts):
+    """Add to one rollup row with an atomic UPDATE, creating the row if it is missing"""
+    increment = update(rollup).where(
+        *(column == value for column, value in zip(_key_columns(rollup), key))
+    ).values(
+        invoice_count=rollup.invoice_count + count,
+        **{field: getattr(rollup, field) + amount for field, amount in zip(AMOUNT_FIELDS, amounts)}
+    )
+    options = {'synchronize_session': False}
+    if db.session.execute(increment, execution_options=options).rowcount:
+        return
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(rollup).values(_row_params(rollup, key, (count,) + amounts)))
+    except IntegrityError:
+        # Another transaction created the row first
+        db.session.execute(increment, execution_options=options)
+
+
+def _row_params(rollup, key, delta, key_prefix=''):
+    params = {f"{key_prefix}{column.key}": value for column, value in zip(_key_columns(rollup), key)}
+    params.update(zip(('invoice_count',) + AMOUNT_FIELDS, delta))
+    return params
+
+
+def _increment_statement(rollup):
+    table = rollup.__table__
+    return table.update().where(
+        *(column == bindparam(f"key_{column.key}") for column in _key_columns(rollup))
+    ).values(
+        invoice_count=table.c.invoice_count + bindparam('invoice_count'),
+        **{field: table.c[field] + bindparam(field) for field in AMOUNT_FIELDS}
+    )
+
+
+def rebuild_summaries():
+    """Recompute every summary rollup from the invoice table in one transaction"""
+    try:
+        for rollup in ROLLUPS:
+            names = [column.name for column in _key_columns(rollup)]
+            group = [INVOICE_STATUS if name == 'status' else getattr(Invoice, name) for name in names]
+            rows = select(
+                *group, func.count(Invoice.id),
+                *(func.coalesce(func.sum(getattr(Invoice, field)), 0) for field in AMOUNT_FIELDS)
+            ).group_by(*group)
+            db.session.execute(delete(rollup))
+            db.session.execute(insert(rollup).from_select([*names, 'invoice_count', *AMOUNT_FIELDS], rows))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    count = sum(db.session.query(func.count()).select_from(rollup).scalar() for rollup in ROLLUPS)
+    logger.info(f"Rebuilt invoice summaries: {count} rows")
+    return count
+
+
+def reporting_currencies():
+    """Currencies of the summarized invoices; every rollup holds the same ones"""
+    return db.session.execute(select(InvoiceCustomerSummary.currency).distinct()).scalars().all()
+
+
+def reporting_factor(converter, on, currency_column, currencies=None):
+    """
+    SQL factor converting amounts in currency_column to the converter's currency at the rates of `on`.
+
+    Only the currencies present in the store are looked up, so a missing
+    rate for one of them raises ExchangeRateError before any report runs.
+    """
+    currencies = reporting_currencies() if currencies is None else currencies
+    return converter.sql_factor(currency_column, currencies, on)
+
+
+def _amount(value, rounding):
+    return money.quantize(value or 0, rounding)
+
+
+def dashboard_stats(today=None, days=30, top=5, currency=None):
+    """
+    Figures for the dashboard, read only from the summary rollups.
+
+    Status totals and the daily chart come from the per-day rollup, top
+    customers from the per-customer one and overdue figures from the
+    per-due-date one, so each query reads rows per day or customer rather
+    than per invoice. Amounts are converted to currency (default
+    REPORTING_CURRENCY) at the rates of `today`, inside the grouped queries.
+    """
+    today = today or date.today()
+    converter = exchange_rates.converter(currency)
+    rounding = converter.rounding
+    currencies = reporting_currencies()
+    day, customer, due = InvoiceDaySummary, InvoiceCustomerSummary, InvoiceDueSummary
+
+    def sums(rollup, *columns):
+        factor = reporting_factor(converter, today, rollup.currency, currencies)
+        amounts = {'total': rollup.total, 'paid': rollup.amount_paid, 'balance': rollup.total - rollup.amount_paid}
+        return [func.coalesce(func.sum(rollup.invoice_count), 0)] + \
+            [func.coalesce(func.sum(amounts[column] * factor), 0) for column in columns]
+
+    by_status = db.session.execute(
+        select(day.status, *sums(day, 'total', 'paid')).group_by(day.status).order_by(day.status)
+    ).all()
+    overdue = db.session.execute(
+        select(*sums(due, 'balance')).where(due.status != PAID, due.due_date < today)
+    ).one()
+    daily = db.session.execute(
+        select(day.issue_date, *sums(day, 'total'))
+        .where(day.issue_date > today - timedelta(days=days), day.issue_date <= today)
+        .group_by(day.issue_date).order_by(day.issue_date)
+    ).all()
+    top_count, top_total = sums(customer, 'total')
+    top_customers = db.session.execute(
+        select(Customer, top_count, top_total)
+        .join(Customer, Customer.id == customer.customer_id)
+        .group_by(Customer.id).order_by(top_total.desc()).limit(top)
+    ).all()
+    customers_billed = db.session.execute(
+        select(func.count(func.distinct(customer.customer_id)))
+    ).scalar()
+
+    by_status = [(status, count, _amount(total, rounding), _amount(paid, rounding))
+                 for status, count, total, paid in by_status]
+    return {
+        'currency': converter.currency,
+        'by_status': by_status,
+        'invoice_count': sum(row[1] for row in by_status),
+        'billed': sum((row[2] for row in by_status), ZERO),
+        'revenue': sum((row[3] for row in by_status), ZERO),
+        'outstanding': sum((row[2] - row[3] for row in by_status if row[0] != PAID), ZERO),
+        'outstanding_count': sum(row[1] for row in by_status if row[0] != PAID),
+        'overdue_count': overdue[0],
+        'overdue': _amount(overdue[1], rounding),
+        'daily': [(day, count, _amount(total, rounding)) for day, count, total in daily],
+        'top_customers': [(customer, count, _amount(total, rounding))
+                          for customer, count, total in top_customers],
+        'customers_billed': customers_billed,
+        'days': days
+    }
+
+
+def customer_balance(customer_id):
+    """
+    Invoiced, paid and outstanding amounts of one customer, from the per-customer rollup.
+
+    Invoices in other currencies are converted to the customer's at today's rates.
+    """
+    summary = InvoiceCustomerSummary
+    currency = db.session.execute(select(Customer.currency).where(Customer.id == customer_id)).scalar()
+    converter = exchange_rates.converter(currency)
+    currencies = db.session.execute(
+        select(summary.currency).where(summary.customer_id == customer_id).distinct()
+    ).scalars().all()
+    factor = converter.sql_factor(summary.currency, currencies, date.today())
+    invoiced, paid = db.session.execute(
+        select(func.coalesce(func.sum(summary.total * factor), 0),
+               func.coalesce(func.sum(summary.amount_paid * factor), 0))
+        .where(summary.customer_id == customer_id)
+    ).one()
+    invoiced, paid = _amount(invoiced, converter.rounding), _amount(paid, converter.rounding)
+    return {'customer_id': customer_id, 'currency': converter.currency, 'invoiced': invoiced, 'paid': paid,
+            'balance_due': invoiced - paid}
+
+
+def _aging_buckets(due, as_of, balance):
+    """SUM(CASE) of balance per AGING_BUCKETS bucket of the due date column"""
+    buckets = []
+    for _, first, last in AGING_BUCKETS:
+        conditions = []
+        if first is not None:
+            conditions.append(due <= as_of - timedelta(days=first))
+        if last is not None:
+            conditions.append(due >= as_of - timedelta(days=last))
+        buckets.append(func.coalesce(func.sum(case((and_(*conditions), balance), else_=0)), 0))
+    return buckets
+
+
+def aging_report(as_of=None, customer_id=None, currency=None):
+    """
+    Unpaid balances per customer by days past due, as of a date.
+
+    The bucket totals come from the per-due-date rollup. Ageing needs each
+    invoice's customer and due date together, which no rollup keeps, so the
+    per-customer rows are one grouped query over the unpaid invoices, with a
+    SUM(CASE) column per bucket; customers owing the most come first.
+    Balances are converted to currency (default REPORTING_CURRENCY) at the
+    rates of as_of.
+    """
+    as_of = as_of or date.today()
+    converter = exchange_rates.converter(currency)
+    rounding = converter.rounding
+    currencies = reporting_currencies()
+    labels = [label for label, _, _ in AGING_BUCKETS]
+
+    balance = (Invoice.total - Invoice.amount_paid) * reporting_factor(converter, as_of, Invoice.currency, currencies)
+    outstanding = func.coalesce(func.sum(balance), 0)
+    query = select(Customer.id, Customer.name, func.count(Invoice.id), outstanding,
+                   *_aging_buckets(Invoice.due_date, as_of, balance)) \
+        .join(Customer, Customer.id == Invoice.customer_id) \
+        .where(INVOICE_STATUS != PAID) \
+        .group_by(Customer.id, Customer.name) \
+        .order_by(outstanding.desc(), Customer.id)
+    if customer_id is not None:
+        query = query.where(Invoice.customer_id == customer_id)
+
+    customers = []
+    totals = {'invoice_count': 0, 'outstanding': ZERO, 'buckets': dict.fromkeys(labels, ZERO)}
+    for row_customer_id, name, count, total, *amounts in db.session.execute(query):
+        row = {
+            'customer_id': row_customer_id,
+            'customer_name': name,
+            'invoice_count': count,
+            'outstanding': _amount(total, rounding),
+            'buckets': {label: _amount(amount, rounding) for label, amount in zip(labels, amounts)}
+        }
+        customers.append(row)
+        totals['invoice_count'] += count
+        totals['outstanding'] += row['outstanding']
+        for label in labels:
+            totals['buckets'][label] += row['buckets'][label]
+
+    if customer_id is None:
+        due = InvoiceDueSummary
+        balance = (due.total - due.amount_paid) * reporting_factor(converter, as_of, due.currency, currencies)
+        count, total, *amounts = db.session.execute(
+            select(func.coalesce(func.sum(due.invoice_count), 0), func.coalesce(func.sum(balance), 0),
+                   *_aging_buckets(due.due_date, as_of, balance))
+            .where(due.status != PAID)
+        ).one()
+        totals = {'invoice_count': count, 'outstanding': _amount(total, rounding),
+                  'buckets': {label: _amount(amount, rounding) for label, amount in zip(labels, amounts)}}
+    return {'as_of': as_of, 'currency': converter.currency, 'buckets': labels, 'customers': customers,
+            'totals': totals}
@@ -1,24 +1,116 @@
 from datetime import datetime
-from app import db
-from app.models import Invoice, Customer
+from decimal import Decimal, InvalidOperation
+from flask import current_app, has_app_context
+from app import money
+from app.models import Invoice
+from app.numbering import invoice_numbers
 import os
 
-def generate_invoice_number():
-    last_invoice = Invoice.query.order_by(Invoice.id.desc()).first()
-    return f"INV-{(last_invoice.id + 1) if last_invoice else 1:04d}"
+def generate_invoice_number(issue_date=None):
+    return invoice_numbers.allocate(issue_date)
+
+def money_settings():
+    """Rounding options for app.money, from MONEY_ROUNDING and TAX_PER_LINE"""
+    if not has_app_context():
+        return {'rounding': money.DEFAULT_ROUNDING, 'per_line_tax': False}
+    return {
+        'rounding': current_app.config.get('MONEY_ROUNDING', money.DEFAULT_ROUNDING),
+        'per_line_tax': current_app.config.get('TAX_PER_LINE', False)
+    }
 
 def calculate_totals(items, tax_rate):
-    subtotal = sum(item['quantity'] * item['unit_price'] for item in items)
-    tax_amount = subtotal * (tax_rate / 100)
+    """Exact Decimal subtotal, tax and total of {quantity, unit_price} items"""
+    totals = money.invoice_totals(items, tax_rate, **money_settings())
     return {
-        'subtotal': round(subtotal, 2),
-        'tax_amount': round(tax_amount, 2),
-        'total': round(subtotal + tax_amount, 2)
+        'subtotal': totals['subtotal'],
+        'tax_amount': totals['tax_amount'],
+        'total': totals['total']
     }
 
-def save_pdf_to_disk(invoice):
+def save_pdf_to_disk(invoice, background=None):
+    """
+    Render an invoice PDF into app/static/invoices.
+
+    In background mode (the default when PDF_RENDER_MODE is 'background') the
+    render is queued on the PDF worker pool and the job is returned instead of
+    the path; call job.wait() to block for the result.
+    """
+    from app.pdf_jobs import pdf_jobs
+    if background is None:
+        background = pdf_jobs.enabled
+
     os.makedirs('app/static/invoices', exist_ok=True)
     pdf_path = f'app/static/invoices/invoice_{invoice.invoice_number}.pdf'
+    if background:
+        return pdf_jobs.submit(invoice, output_path=pdf_path)
+
     from app.pdf_generator import generate_pdf
     generate_pdf(invoice, pdf_path)
-    return pdf_path
\ No newline at end of file
+    return pdf_path
+
+def parse_invoice_filters(args):
+    """
+    Read invoice filters from request args (or any mapping).
+
+    Supported keys: start_date, end_date (YYYY-MM-DD, on issue_date),
+    customer_id, status, min_total and max_total. Raises ValueError on
+    malformed input.
+    """
+    filters = {}
+    for key in ('start_date', 'end_date'):
+        value = args.get(key)
+        if value:
+            filters[key] = datetime.strptime(value, '%Y-%m-%d').date()
+    if args.get('customer_id'):
+        filters['customer_id'] = int(args.get('customer_id'))
+    if args.get('status'):
+        filters['status'] = args.get('status').upper()
+    for key in ('min_total', 'max_total'):
+        value = args.get(key)
+        if value:
+            try:
+                filters[key] = Decimal(value)
+            except InvalidOperation:
+                raise ValueError(f"{key} must be a number")
+    return filters
+
+
+def apply_invoice_filters(query, filters):
+    """Narrow an Invoice query by the filters from parse_invoice_filters"""
+    if 'start_date' in filters:
+        query = query.filter(Invoice.issue_date >= filters['start_date'])
+    if 'end_date' in filters:
+        query = query.filter(Invoice.issue_date <= filters['end_date'])
+    if 'customer_id' in filters:
+        query = query.filter(Invoice.customer_id == filters['customer_id'])
+    if 'status' in filters:
+        query = query.filter(Invoice.status == filters['status'])
+    if 'min_total' in filters:
+        query = query.filter(Invoice.total >= filters['min_total'])
+    if 'max_total' in filters:
+        query = query.filter(Invoice.total <= filters['max_total'])
+    return query
+
+
+class StreamBuffer:
+    """
+    Write-only file object that hands back what was written in chunks.
+
+    zipfile.ZipFile accepts it as an unseekable target, which lets an archive
+    be streamed to the client entry by entry instead of built in memory.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
@@ -0,0 +1,87 @@
+"""
+Throughput of the CSV importer.
+
+Usage:
+    python benchmarks/bench_import.py [--rows 100000] [--invoices 20000] [--items 5]
+        [--batch-size 1000] [--database-url sqlite:////tmp/import.db]
+
+Writes a customers CSV with --rows rows (1% duplicate emails, 1% invalid
+rows) and an invoices CSV with --invoices invoices of --items line items each,
+imports both into a fresh database and reports rows per second. Without
+--database-url a temporary SQLite file is used.
+"""
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+
+from common import make_config
+
+
+def write_customers(path, rows, rng):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'email', 'phone', 'address'])
+        for i in range(rows):
+            roll = rng.random()
+            if roll < 0.01:
+                writer.writerow(['', f"missing{i}@example.com", '', ''])
+            elif roll < 0.02:
+                writer.writerow([f"Duplicate {i}", f"customer{rng.randrange(max(i, 1))}@example.com", '', ''])
+            else:
+                writer.writerow([f"Customer {i}", f"customer{i}@example.com", f"555-{i % 10000:04d}",
+                                 f"{i} Main St\nSpringfield"])
+
+
+def write_invoices(path, invoices, items, customers, rng):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['invoice_ref', 'customer_email', 'issue_date', 'due_date', 'tax_rate', 'notes',
+                         'description', 'quantity', 'unit_price'])
+        for i in range(invoices):
+            email = f"customer{rng.randrange(customers)}@example.com"
+            for j in range(items):
+                header = [email, '2026-01-15', '2026-02-15', '7.5', 'Imported'] if j == 0 else [''] * 5
+                writer.writerow([f"REF-{i}"] + header + [f"Service {j}", rng.randint(1, 10),
+                                                         f"{rng.randint(100, 100000) / 100:.2f}"])
+
+
+def run_import(app, kind, path, batch_size):
+    from app.importer import import_csv
+
+    with app.app_context(), open(path, newline='', encoding='utf-8-sig') as f:
+        started = time.perf_counter()
+        result = import_csv(kind, f, batch_size)
+        elapsed = time.perf_counter() - started
+    print(f"{kind:<10} {result.rows:>9} rows {elapsed:>8.2f}s {result.rows / elapsed:>10,.0f} rows/s  "
+          f"created {result.created}, skipped {len(result.skipped)}, errors {len(result.errors)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--invoices', type=int, default=20000)
+    parser.add_argument('--items', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--database-url')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'import.db')}"
+    rng = random.Random(args.seed)
+    customers_csv = os.path.join(workdir, 'customers.csv')
+    invoices_csv = os.path.join(workdir, 'invoices.csv')
+    write_customers(customers_csv, args.rows, rng)
+    write_invoices(invoices_csv, args.invoices, args.items, int(args.rows * 0.98), rng)
+
+    from app import create_app
+    app = create_app(make_config(database_url))
+    run_import(app, 'customers', customers_csv, args.batch_size)
+    run_import(app, 'invoices', invoices_csv, max(args.batch_size // args.items, 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Compare the old float calculate_totals with the Decimal money engine.
+
+Usage:
+    python benchmarks/bench_money.py [--invoices 10000] [--items 10] [--repeat 3] [--seed 1]
+
+Times totalling a batch of random invoices with the previous float
+implementation, app.money.invoice_totals per invoice, and money.batch_totals
+(pure Python ints, and numpy when installed). Also counts invoices where the
+float result differs from the exact one.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import money  # noqa: E402
+
+
+def float_calculate_totals(items, tax_rate):
+    """calculate_totals as it was before app.money, fed floats by the routes"""
+    subtotal = sum(item['quantity'] * item['unit_price'] for item in items)
+    tax_amount = subtotal * (tax_rate / 100)
+    return {
+        'subtotal': round(subtotal, 2),
+        'tax_amount': round(tax_amount, 2),
+        'total': round(subtotal + tax_amount, 2)
+    }
+
+
+def make_invoices(count, items, seed):
+    rng = random.Random(seed)
+    return [{
+        'tax_rate': Decimal(rng.randint(0, 2500)).scaleb(-2),
+        'items': [{
+            'quantity': Decimal(rng.randint(1, 10000)).scaleb(-2),
+            'unit_price': Decimal(rng.randint(1, 1000000)).scaleb(-2)
+        } for _ in range(rng.randint(1, items * 2 - 1))]
+    } for _ in range(count)]
+
+
+def as_floats(invoices):
+    return [{
+        'tax_rate': float(invoice['tax_rate']),
+        'items': [{'quantity': float(i['quantity']), 'unit_price': float(i['unit_price'])} for i in invoice['items']]
+    } for invoice in invoices]
+
+
+def best_of(repeat, fn):
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--invoices', type=int, default=10000)
+    parser.add_argument('--items', type=int, default=10, help='Average items per invoice')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    invoices = make_invoices(args.invoices, args.items, args.seed)
+    floats = as_floats(invoices)
+    line_count = sum(len(invoice['items']) for invoice in invoices)
+
+    runs = [
+        ('float calculate_totals', lambda: [float_calculate_totals(i['items'], i['tax_rate']) for i in floats]),
+        ('money.invoice_totals', lambda: [money.invoice_totals(i['items'], i['tax_rate']) for i in invoices]),
+        ('money.batch_totals (python)', lambda: money.batch_totals(invoices, use_numpy=False)),
+    ]
+    if money.np is not None:
+        runs.append(('money.batch_totals (numpy)', lambda: money.batch_totals(invoices, use_numpy=True)))
+
+    print(f"{args.invoices} invoices, {line_count} line items")
+    print(f"{'implementation':<30} {'seconds':>9} {'lines/s':>12}")
+    results = {}
+    for name, fn in runs:
+        elapsed, results[name] = best_of(args.repeat, fn)
+        print(f"{name:<30} {elapsed:>9.3f} {line_count / elapsed:>12,.0f}")
+
+    exact = results['money.invoice_totals']
+    drifted = sum(
+        1 for old, new in zip(results['float calculate_totals'], exact)
+        if Decimal(str(old['total'])) != new['total']
+    )
+    mismatched = sum(
+        1 for name, result in results.items() if name.startswith('money.batch')
+        for batch, single in zip(result, exact) if batch != single
+    )
+    print(f"float totals differing from exact Decimal totals: {drifted}")
+    print(f"batch results differing from invoice_totals: {mismatched}")
+    return 1 if mismatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+Compare the Platypus Table and LineItemGrid backends of the PDF renderer.
+
+Usage:
+    python benchmarks/bench_pdf_backends.py [--sizes 10 1000 50000] [--repeat 3]
+
+Invoices are built in memory, so no database is needed.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import date
+from decimal import Decimal
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app.pdf_generator import PDFRenderer  # noqa: E402
+
+
+def make_invoice(item_count):
+    items = [
+        SimpleNamespace(
+            id=i,
+            description=f"Consulting services, work package {i} " * (1 + i % 3),
+            quantity=Decimal('1.50'),
+            unit_price=Decimal('120.00'),
+            amount=Decimal('180.00')
+        ) for i in range(item_count)
+    ]
+    subtotal = Decimal('180.00') * item_count
+    return SimpleNamespace(
+        id=1, invoice_number='INV-BENCH', status='DRAFT', notes='Benchmark invoice',
+        issue_date=date(2026, 1, 1), due_date=date(2026, 1, 31),
+        subtotal=subtotal, tax_rate=Decimal('10.00'), tax_amount=subtotal / 10, total=subtotal * Decimal('1.1'),
+        currency='USD',
+        customer=SimpleNamespace(id=1, name='Benchmark Customer', email='bench@example.com',
+                                 phone='555-0100', address='1 Main St\nSpringfield'),
+        items=items
+    )
+
+
+def bench(renderer, invoice, fast_path, repeat):
+    best, size = None, 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        size = len(renderer.render(invoice, fast_path=fast_path).getvalue())
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 50000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    renderer = PDFRenderer()
+    print(f"{'items':>8} {'platypus (s)':>14} {'canvas (s)':>12} {'speedup':>9} {'pdf bytes':>11}")
+    for size in args.sizes:
+        invoice = make_invoice(size)
+        slow, _ = bench(renderer, invoice, False, args.repeat)
+        fast, pdf_bytes = bench(renderer, invoice, True, args.repeat)
+        print(f"{size:>8} {slow:>14.3f} {fast:>12.3f} {slow / fast:>8.1f}x {pdf_bytes:>11}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""
+Benchmark suite for the main routes and the PDF pipeline, with regression baselines.
+
+Usage:
+    python benchmarks/bench_suite.py [--scale small|medium|large] [--customers N] [--invoices N]
+        [--items N] [--database /tmp/bench.db] [--requests 200] [--workers 8]
+        [--scenarios list_invoices view_invoice ...] [--baseline benchmarks/baseline.json | --no-baseline]
+        [--update-baseline] [--tolerance 0.25] [--json results.json]
+
+Seeds a SQLite database through create_app (large = 100k customers, 1M
+invoices, 10M items; reused on later runs when --database points at a file
+seeded with the same sizes), then drives each scenario with --requests
+requests from --workers threads, each with its own Flask test client.
+
+For every scenario it reports throughput, p50/p95/p99 latency, SQL queries
+per request and the peak Python memory of a short tracemalloc pass (run
+separately so tracing does not slow the latency pass). The results are
+compared with the stored run in --baseline (benchmarks/baseline.json, a
+small-scale run, unless told otherwise) and the exit status is 1 if any
+scenario's p95 grew by more than --tolerance or it runs more queries per
+request; --update-baseline stores this run instead. Latency baselines only
+mean something on the machine that recorded them, so re-record it before
+comparing on another; query counts are exact.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from common import make_config, percentile
+from seed import WORDS, seed_database
+
+SCALES = {
+    'small': (1000, 10000, 10),
+    'medium': (10000, 100000, 10),
+    'large': (100000, 1000000, 10),
+}
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+MEMORY_REQUESTS = 20
+QUERY_SLACK = 0.5  # queries per request a scenario may add before it counts as a regression
+
+
+def scenarios(sizes):
+    """name -> function(rng) returning (method, path, form data)"""
+    customers, invoices, _ = sizes
+    invoice = lambda rng: rng.randint(1, invoices)  # noqa: E731
+
+    def create_invoice(rng):
+        return 'POST', '/invoices/create', {
+            'customer_id': rng.randint(1, customers), 'issue_date': '2026-01-15', 'due_date': '2026-02-15',
+            'tax_rate': '7.5', 'description': ['Benchmark item', 'Second item'], 'quantity': ['2', '1'],
+            'unit_price': ['10.00', '99.95']
+        }
+
+    return {
+        'list_invoices': lambda rng: ('GET', '/invoices/', None),
+        'list_invoices_filtered': lambda rng: ('GET', f"/invoices/?status=PAID&customer_id={rng.randint(1, customers)}",
+                                               None),
+        'view_invoice': lambda rng: ('GET', f"/invoices/{invoice(rng)}", None),
+        'print_invoice': lambda rng: ('GET', f"/invoices/{invoice(rng)}/print", None),
+        'download_pdf': lambda rng: ('GET', f"/invoices/{invoice(rng)}/pdf", None),
+        'create_invoice': create_invoice,
+        'dashboard': lambda rng: ('GET', '/dashboard', None),
+        'aging': lambda rng: ('GET', '/reports/aging?format=json', None),
+        'customer_search': lambda rng: ('GET', f"/customers/search?q=Customer {rng.randint(1, 999)}", None),
+        'invoice_search': lambda rng: ('GET', f"/invoices/search?q={rng.choice(WORDS)[:5]} {rng.randint(1, 10)}",
+                                       None),
+        'invoice_search_number': lambda rng: ('GET', f"/invoices/search?q=INV-{invoice(rng):04d}", None),
+        'api_list_invoices': lambda rng: ('GET', '/api/v1/invoices?per_page=50', None),
+        'api_get_invoice': lambda rng: ('GET', f"/api/v1/invoices/{invoice(rng)}", None),
+    }
+
+
+class QueryCounter:
+    """SQL statements executed by the current thread"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def __call__(self, *args):
+        self._local.count = getattr(self._local, 'count', 0) + 1
+
+    def take(self):
+        count = getattr(self._local, 'count', 0)
+        self._local.count = 0
+        return count
+
+
+def run_scenario(app, name, make_request, requests, workers, queries, seed):
+    local = threading.local()
+    rngs = iter(random.Random(seed + i) for i in range(workers * 2))
+    lock = threading.Lock()
+
+    def one(_):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+            with lock:
+                local.rng = next(rngs)
+        method, path, data = make_request(local.rng)
+        queries.take()
+        started = time.perf_counter()
+        response = local.client.open(path, method=method, data=data)
+        elapsed = time.perf_counter() - started
+        # Form posts answer with a redirect; a redirected GET means the page failed
+        return elapsed, queries.take(), response.status_code < (400 if method == 'POST' else 300)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(workers) as pool:
+        samples = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+
+    # Peak Python memory of a few requests in this thread, traced separately
+    rng = random.Random(seed)
+    client = app.test_client()
+    tracemalloc.start()
+    for _ in range(MEMORY_REQUESTS):
+        method, path, data = make_request(rng)
+        client.open(path, method=method, data=data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = [elapsed for elapsed, _, _ in samples]
+    counts = [count for _, count, _ in samples]
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, _, ok in samples if not ok),
+        'throughput': requests / wall,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': statistics.mean(latencies) * 1000,
+        'queries_mean': statistics.mean(counts),
+        'queries_max': max(counts),
+        'peak_memory_kb': peak / 1024,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Regression messages for results that are worse than the baseline"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']:.1f}ms vs baseline {base['p95_ms']:.1f}ms")
+        if result['queries_mean'] > base['queries_mean'] + QUERY_SLACK:
+            regressions.append(f"{name}: {result['queries_mean']:.1f} queries/request vs baseline "
+                               f"{base['queries_mean']:.1f}")
+        if result['errors'] > base.get('errors', 0):
+            regressions.append(f"{name}: {result['errors']} failed requests")
+    return regressions
+
+
+def prepare_database(path, sizes, seed):
+    """Create and seed the database, or reuse it if it was seeded with the same sizes"""
+    from app import create_app
+
+    marker = path + '.seed.json'
+    wanted = {'customers': sizes[0], 'invoices': sizes[1], 'items': sizes[2], 'seed': seed}
+    if os.path.exists(path):
+        if os.path.exists(marker):
+            with open(marker) as f:
+                if json.load(f) == wanted:
+                    print(f"Reusing {path}")
+                    return create_app(make_config(f"sqlite:///{path}", METRICS_ENABLED=False))
+        sys.exit(f"{path} exists but was not seeded with these sizes; remove it or pick another --database")
+
+    app = create_app(make_config(f"sqlite:///{path}", METRICS_ENABLED=False))
+    seed_database(app, *sizes, seed=seed)
+    with open(marker, 'w') as f:
+        json.dump(wanted, f)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--customers', type=int)
+    parser.add_argument('--invoices', type=int)
+    parser.add_argument('--items', type=int, help='Items per invoice')
+    parser.add_argument('--database', help='SQLite file to seed, or reuse (default: a temporary file)')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--scenarios', nargs='+')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline JSON to compare with (or to write)')
+    parser.add_argument('--no-baseline', action='store_const', const=None, dest='baseline',
+                        help='Skip the comparison')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed p95 growth (0.25 = 25%%)')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    defaults = SCALES[args.scale]
+    sizes = (args.customers or defaults[0], args.invoices or defaults[1], args.items or defaults[2])
+    available = scenarios(sizes)
+    names = args.scenarios or list(available)
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)} (choose from {', '.join(available)})")
+
+    import logging
+    logging.disable(logging.INFO)
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    database = args.database or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = prepare_database(database, sizes, args.seed)
+    queries = QueryCounter()
+    event.listen(Engine, 'before_cursor_execute', queries)
+
+    results = {}
+    print(f"{'scenario':<24} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'queries':>8} {'peak KB':>9} errors")
+    for name in names:
+        result = run_scenario(app, name, available[name], args.requests, args.workers, queries, args.seed)
+        results[name] = result
+        print(f"{name:<24} {result['throughput']:>8.1f} {result['p50_ms']:>7.1f}ms {result['p95_ms']:>7.1f}ms "
+              f"{result['p99_ms']:>7.1f}ms {result['queries_mean']:>8.1f} {result['peak_memory_kb']:>9,.0f} "
+              f"{result['errors']}")
+
+    run = {
+        'sizes': dict(zip(('customers', 'invoices', 'items'), sizes)),
+        'requests': args.requests,
+        'workers': args.workers,
+        'python': sys.version.split()[0],
+        'scenarios': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(run, f, indent=2)
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(run, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('sizes') != run['sizes']:
+            print(f"Warning: baseline was recorded with {baseline.get('sizes')}, this run used {run['sizes']}")
+        regressions = compare(results, baseline, args.tolerance)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+    if any(result['errors'] for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
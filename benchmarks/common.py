@@ -0,0 +1,33 @@
+"""
+Helpers shared by the benchmark scripts.
+
+Importing this module also puts the project root on sys.path, so the
+scripts can import config and app when run as `python benchmarks/<script>.py`.
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from config import Config  # noqa: E402
+
+
+def make_config(database_url, **settings):
+    """A Config subclass for a benchmark run against database_url; settings override its attributes"""
+    attributes = {
+        'SQLALCHEMY_DATABASE_URI': database_url,
+        'WTF_CSRF_ENABLED': False,
+        'PDF_CACHE_DIR': tempfile.mkdtemp(),
+    }
+    if database_url.startswith('sqlite'):
+        # Concurrent writers wait for the database lock instead of failing at once
+        attributes['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 60}}
+    attributes.update(settings)
+    return type('BenchConfig', (Config,), attributes)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values, fraction between 0 and 1"""
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
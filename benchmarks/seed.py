@@ -0,0 +1,112 @@
+"""
+Bulk seeding of a benchmark database.
+
+Rows are written with executemany INSERTs straight through the app's engine,
+bypassing the services layer, so millions of invoices load in minutes. The
+data is consistent with what the app writes itself: totals match the items,
+paid invoices have a payment, the invoice number series continues after the
+seeded numbers and the summary store and search index are rebuilt at the end.
+"""
+import random
+import time
+from datetime import date, datetime, timedelta
+from decimal import ROUND_HALF_UP, Decimal
+
+from sqlalchemy import event, insert
+
+CENT = Decimal('0.01')
+STATUSES = (('PAID', 0.6), ('DRAFT', 0.3), ('OVERDUE', 0.1))
+WORDS = ('Consulting', 'Design', 'Hosting', 'Support', 'Licence', 'Training', 'Audit', 'Maintenance',
+         'Development', 'Review', 'Migration', 'Monitoring')
+
+
+def _sqlite_bulk_pragmas(dbapi_connection, connection_record):
+    # Seeding only: a crash leaves a half-written benchmark database, which is rebuilt anyway
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=OFF')
+    cursor.close()
+
+
+def seed_database(app, customers, invoices, items, seed=1, chunk_size=20000, log=print):
+    """Fill the app's (empty) database with customers, invoices, items and payments"""
+    from app import db
+    from app.models import Customer, Invoice, InvoiceItem, InvoiceSequence, Payment
+    from app.search import search_index
+    from app.summaries import rebuild_summaries
+
+    rng = random.Random(seed)
+    prefix = app.config['INVOICE_NUMBER_PREFIX']
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    today = date.today()
+    statuses = [status for status, _ in STATUSES]
+    weights = [weight for _, weight in STATUSES]
+
+    with app.app_context():
+        if db.engine.dialect.name == 'sqlite':
+            event.listen(db.engine, 'connect', _sqlite_bulk_pragmas)
+            db.engine.dispose()
+
+        with db.engine.begin() as conn:
+            for start in range(1, customers + 1, chunk_size):
+                conn.execute(insert(Customer), [{
+                    'id': i, 'name': f"Customer {i}", 'email': f"customer{i}@example.com",
+                    'phone': f"555-{i % 10000:04d}", 'address': f"{i} Main St\nSpringfield",
+                    'created_at': now, 'updated_at': now
+                } for i in range(start, min(start + chunk_size, customers + 1))])
+        log(f"  customers: {customers:,} in {time.perf_counter() - started:.1f}s")
+
+        invoice_chunk = max(chunk_size // max(items, 1), 1)
+        for start in range(1, invoices + 1, invoice_chunk):
+            invoice_rows, item_rows, payment_rows = [], [], []
+            for invoice_id in range(start, min(start + invoice_chunk, invoices + 1)):
+                issued = today - timedelta(days=rng.randrange(730))
+                status = rng.choices(statuses, weights)[0]
+                tax_rate = Decimal(rng.choice(('0', '5', '7.5', '20')))
+                subtotal = Decimal('0.00')
+                for line in range(items):
+                    quantity = Decimal(rng.randint(1, 20))
+                    unit_price = Decimal(rng.randint(100, 250000)) / 100
+                    amount = (quantity * unit_price).quantize(CENT, ROUND_HALF_UP)
+                    subtotal += amount
+                    item_rows.append({
+                        'invoice_id': invoice_id, 'description': f"{rng.choice(WORDS)} {line + 1}",
+                        'quantity': quantity, 'unit_price': unit_price, 'amount': amount
+                    })
+                tax_amount = (subtotal * tax_rate / 100).quantize(CENT, ROUND_HALF_UP)
+                total = subtotal + tax_amount
+                invoice_rows.append({
+                    'id': invoice_id, 'invoice_number': f"{prefix}-{invoice_id:04d}",
+                    'customer_id': rng.randint(1, customers), 'issue_date': issued,
+                    'due_date': issued + timedelta(days=30), 'subtotal': subtotal, 'tax_rate': tax_rate,
+                    'tax_amount': tax_amount, 'total': total,
+                    'amount_paid': total if status == 'PAID' else Decimal('0.00'),
+                    'notes': f"Seeded invoice {invoice_id}" if invoice_id % 10 == 0 else None,
+                    'status': status, 'created_at': now, 'updated_at': now, 'version': 1
+                })
+                if status == 'PAID' and total > 0:
+                    payment_rows.append({
+                        'invoice_id': invoice_id, 'amount': total, 'paid_on': issued + timedelta(days=rng.randrange(30)),
+                        'method': 'bank', 'reference': f"SEED-{invoice_id}", 'created_at': now
+                    })
+            with db.engine.begin() as conn:
+                conn.execute(insert(Invoice), invoice_rows)
+                conn.execute(insert(InvoiceItem), item_rows)
+                if payment_rows:
+                    conn.execute(insert(Payment), payment_rows)
+            done = min(start + invoice_chunk - 1, invoices)
+            if done % (invoice_chunk * 25) < invoice_chunk or done == invoices:
+                log(f"  invoices: {done:,}/{invoices:,} ({done * items:,} items) "
+                    f"in {time.perf_counter() - started:.1f}s")
+
+        with db.engine.begin() as conn:
+            conn.execute(insert(InvoiceSequence), [{'name': prefix, 'next_value': invoices + 1}])
+        rebuild_summaries()
+        search_index.rebuild()
+
+        if db.engine.dialect.name == 'sqlite':
+            event.remove(db.engine, 'connect', _sqlite_bulk_pragmas)
+            db.engine.dispose()
+    log(f"Seeded {customers:,} customers, {invoices:,} invoices, {invoices * items:,} items "
+        f"in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,94 @@
+"""
+Stress test for the invoice number allocator.
+
+Creates invoices through POST /invoices/create from many threads in each of
+several processes at once, all sharing one database, then checks that every
+invoice got a distinct number and reports any gaps in the sequence.
+
+Usage:
+    python benchmarks/stress_invoice_numbers.py [--processes 4] [--threads 8] [--invoices 25]
+        [--block-size 10] [--database-url sqlite:////tmp/stress.db]
+
+Exits non-zero on duplicate numbers, failed requests, or more gaps than
+processes x block size. Gaps are expected only at the end of blocks
+reserved by a process that did not use them up.
+"""
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import threading
+
+from common import make_config
+
+
+def worker_process(database_url, block_size, threads, invoices, failures):
+    from app import create_app
+    app = create_app(make_config(database_url, INVOICE_NUMBER_BLOCK_SIZE=block_size))
+
+    def run():
+        client = app.test_client()
+        for _ in range(invoices):
+            response = client.post('/invoices/create', data={
+                'customer_id': 1, 'issue_date': '2026-01-15', 'due_date': '2026-02-15', 'tax_rate': '0',
+                'description': ['Stress item'], 'quantity': ['1'], 'unit_price': ['1.00']
+            })
+            if response.status_code != 302:
+                with failures.get_lock():
+                    failures.value += 1
+
+    pool = [threading.Thread(target=run) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--invoices', type=int, default=25, help='Invoices per thread')
+    parser.add_argument('--block-size', type=int, default=10)
+    parser.add_argument('--database-url', default=None)
+    args = parser.parse_args()
+
+    database_url = args.database_url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'stress.db')
+
+    from app import create_app, db
+    from app.models import Customer, Invoice
+    app = create_app(make_config(database_url, INVOICE_NUMBER_BLOCK_SIZE=args.block_size))
+    with app.app_context():
+        if db.session.get(Customer, 1) is None:
+            db.session.add(Customer(id=1, name='Stress Customer'))
+            db.session.commit()
+
+    failures = multiprocessing.Value('i', 0)
+    processes = [
+        multiprocessing.Process(target=worker_process,
+                                args=(database_url, args.block_size, args.threads, args.invoices, failures))
+        for _ in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    with app.app_context():
+        numbers = [row.invoice_number for row in Invoice.query.with_entities(Invoice.invoice_number)]
+    values = sorted(int(re.search(r'(\d+)$', number).group(1)) for number in numbers)
+    duplicates = len(values) - len(set(values))
+    gaps = sorted(set(range(values[0], values[-1] + 1)) - set(values)) if values else []
+
+    expected = args.processes * args.threads * args.invoices
+    allowed_gaps = args.processes * args.block_size  # one unused block tail per process at most
+    print(f"requested {expected}, created {len(values)}, failed requests {failures.value}")
+    print(f"duplicates {duplicates}, gaps {len(gaps)} (at most {allowed_gaps} allowed)")
+    if duplicates or failures.value or len(values) != expected or len(gaps) > allowed_gaps:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,7 @@ document.addEventListener('DOMContentLoaded', function() {
         const newRow = itemsTable.insertRow();
         
         newRow.innerHTML = `
-            <td><input type="text" name="description" class="form-control" required></td>
+            <td><input type="hidden" name="item_id" value=""><input type="text" name="description" class="form-control" required></td>
             <td><input type="number" name="quantity" class="form-control calc-total" min="0" step="0.01" required></td>
             <td><input type="number" name="unit_price" class="form-control calc-total" min="0" step="0.01" required></td>
             <td><input type="number" name="amount" class="form-control" readonly></td>
@@ -59,4 +59,29 @@ document.addEventListener('DOMContentLoaded', function() {
         btn.addEventListener('click', removeRow);
     });
     document.getElementById('tax_rate')?.addEventListener('input', calculateInvoiceTotals);
+
+    // Type-ahead customer search for the invoice form
+    const customerSearch = document.getElementById('customer-search');
+    const customerSelect = document.getElementById('customer_id');
+    if (customerSearch && customerSelect) {
+        let searchTimer;
+        customerSearch.addEventListener('input', function() {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(searchCustomers, 250);
+        });
+
+        function searchCustomers() {
+            const url = customerSearch.dataset.url + '?q=' + encodeURIComponent(customerSearch.value.trim());
+            fetch(url)
+                .then(response => response.json())
+                .then(data => {
+                    const selected = customerSelect.value;
+                    customerSelect.innerHTML = '';
+                    customerSelect.add(new Option('-- Select Customer --', 0));
+                    data.results.forEach(customer => {
+                        customerSelect.add(new Option(customer.text, customer.id, false, String(customer.id) === selected));
+                    });
+                });
+        }
+    }
 });
\ No newline at end of file